@@ -0,0 +1,130 @@
+"""Memory used to upload one attachment to many wormholes
+
+Compares downloading the attachment for every wormhole (`Attachment.read()` per
+upload) with `SharedFile`, downloaded once and read by every upload from the same
+buffer, held in memory or spooled to a temporary file. The attachment is served by a
+local HTTP server. Every variant runs in its own process; the reported value is the
+growth of its peak RSS while all uploads are open at once.
+
+    python3 -m benchmarks.attachment_memory [megabytes] [wormholes]
+"""
+import asyncio
+import io
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+MEGABYTES = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+WORMHOLES = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+FILENAME = "attachment.bin"
+
+
+def rss() -> int:
+    """Peak RSS in kB (Linux)"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def upload(file) -> int:
+    """Read the file the way an upload would"""
+    size = 0
+    while True:
+        chunk = file.fp.read(64 * 1024)
+        if not chunk:
+            break
+        size += len(chunk)
+    file.close()
+    return size
+
+
+async def per_wormhole(url: str) -> int:
+    import aiohttp
+    import discord
+
+    before = rss()
+    async with aiohttp.ClientSession() as session:
+
+        async def read() -> bytes:
+            async with session.get(url) as response:
+                return await response.read()
+
+        datas = await asyncio.gather(*[read() for _ in range(WORMHOLES)])
+        files = [discord.File(io.BytesIO(data), filename=FILENAME) for data in datas]
+        sum(upload(f) for f in files)
+    return rss() - before
+
+
+async def shared(url: str, memory: int) -> int:
+    import aiohttp
+
+    from core.files import SharedFile
+
+    attachment = types.SimpleNamespace(
+        url=url, filename=FILENAME, size=MEGABYTES << 20, is_spoiler=lambda: False
+    )
+    before = rss()
+    async with aiohttp.ClientSession() as session:
+        buffer = await SharedFile.download(session, attachment, limit=1 << 40, memory=memory)
+        files = [buffer.file() for _ in range(WORMHOLES)]
+        sum(upload(f) for f in files)
+        buffer.close()
+    return rss() - before
+
+
+def run(variant: str, url: str) -> int:
+    if variant == "download":
+        return asyncio.run(per_wormhole(url))
+    if variant == "shared":
+        return asyncio.run(shared(url, memory=1 << 40))
+    return asyncio.run(shared(url, memory=0))
+
+
+def main():
+    if len(sys.argv) > 3:
+        print(run(sys.argv[3], sys.argv[4]))
+        return
+
+    with tempfile.TemporaryDirectory() as directory:
+        with open(os.path.join(directory, FILENAME), "wb") as handle:
+            handle.write(os.urandom(MEGABYTES << 20))
+
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            port = s.getsockname()[1]
+        server = subprocess.Popen(
+            [sys.executable, "-m", "http.server", str(port), "-b", "127.0.0.1", "-d", directory],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        time.sleep(1)
+        url = f"http://127.0.0.1:{port}/{FILENAME}"
+
+        print(f"{MEGABYTES} MB attachment uploaded to {WORMHOLES} wormholes")
+        try:
+            for variant in ("download", "shared", "spooled"):
+                result = subprocess.run(
+                    [
+                        sys.executable,
+                        "-m",
+                        "benchmarks.attachment_memory",
+                        str(MEGABYTES),
+                        str(WORMHOLES),
+                        variant,
+                        url,
+                    ],
+                    capture_output=True,
+                    text=True,
+                    check=True,
+                )
+                kb = int(result.stdout)
+                print(f"{variant:>9}: {kb / 1024:8.1f} MB")
+        finally:
+            server.terminate()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""Event loop lag during a burst of messages
+
+Each simulated message reads three hashes, as `on_message` does. The ticker task
+measures how late it is woken up; with the synchronous client every round trip
+blocks the loop, with `redis.asyncio` the loop keeps running.
+
+Requires Redis on localhost:6379, uses database 15.
+
+    python3 -m benchmarks.event_loop_lag [messages]
+"""
+import asyncio
+import statistics
+import sys
+import time
+
+import redis
+import redis.asyncio
+
+MESSAGES = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+TICK = 0.001
+
+KEYS = ["wormhole:1", "beam:main", "user:1"]
+
+
+async def ticker(lags: list, stop: asyncio.Event):
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(TICK)
+        lags.append(time.perf_counter() - start - TICK)
+
+
+async def run(name: str, handle):
+    lags = []
+    stop = asyncio.Event()
+    task = asyncio.create_task(ticker(lags, stop))
+    await asyncio.sleep(TICK)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[handle() for _ in range(MESSAGES)])
+    elapsed = time.perf_counter() - start
+
+    stop.set()
+    await task
+    lags = lags or [0.0]
+    print(
+        f"{name:>6}: {MESSAGES} messages in {elapsed:.3f} s, "
+        f"loop lag mean {statistics.mean(lags) * 1000:.2f} ms, "
+        f"max {max(lags) * 1000:.2f} ms"
+    )
+
+
+async def main():
+    sync_db = redis.Redis(db=15, decode_responses=True)
+    pool = redis.asyncio.BlockingConnectionPool(db=15, decode_responses=True, max_connections=16)
+    async_db = redis.asyncio.Redis(connection_pool=pool)
+
+    sync_db.flushdb()
+    sync_db.hset("wormhole:1", mapping={"beam": "main", "active": 1, "messages": 0})
+    sync_db.hset("beam:main", mapping={"active": 1, "replace": 1, "timeout": 0})
+    sync_db.hset("user:1", mapping={"nickname": "user", "home_id:main": 1})
+
+    async def handle_sync():
+        for key in KEYS:
+            sync_db.hgetall(key)
+
+    async def handle_async():
+        for key in KEYS:
+            await async_db.hgetall(key)
+
+    await run("sync", handle_sync)
+    await run("async", handle_async)
+
+    sync_db.flushdb()
+    await async_db.close()
+    await pool.disconnect()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
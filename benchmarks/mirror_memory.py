@@ -0,0 +1,133 @@
+"""Memory held by sent messages
+
+Compares the previous `Wormcog.sent` layout (a list of `discord.Message` objects for
+every relayed message) with `MirrorStore` holding only IDs and the message template,
+rendered in every wormhole as the bot does. Beams with webhooks hold a second template
+per message, see `Mirror.plain`. Every variant runs in its own process; the reported
+value is the growth of its peak RSS.
+
+Run from the repository root (config.json has to exist):
+
+    python3 -m benchmarks.mirror_memory [messages] [wormholes]
+"""
+import asyncio
+import resource
+import subprocess
+import sys
+
+MESSAGES = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+WORMHOLES = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+
+def rss() -> int:
+    """Peak RSS in kB (Linux)"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def payload(message_id: int, channel_id: int) -> dict:
+    return {
+        "id": str(message_id),
+        "channel_id": str(channel_id),
+        "type": 0,
+        "content": f"**__nickname__**: relayed message number {message_id}",
+        "author": {
+            "id": "800000000000000000",
+            "username": "Wormhole",
+            "discriminator": "0001",
+            "avatar": None,
+            "bot": True,
+        },
+        "attachments": [],
+        "embeds": [],
+        "mentions": [],
+        "mention_roles": [],
+        "pinned": False,
+        "mention_everyone": False,
+        "tts": False,
+        "timestamp": "2021-05-01T10:00:00.000000+00:00",
+        "edited_timestamp": None,
+        "flags": 0,
+    }
+
+
+def messages():
+    import discord
+    from discord.state import ConnectionState
+
+    state = ConnectionState(
+        dispatch=lambda *args: None,
+        handlers={},
+        hooks={},
+        syncer=None,
+        http=None,
+        loop=asyncio.new_event_loop(),
+    )
+    channels = [discord.Object(id=700000000000000000 + i) for i in range(WORMHOLES)]
+
+    before = rss()
+    sent = []
+    message_id = 900000000000000000
+    for _ in range(MESSAGES):
+        record = []
+        for channel in channels:
+            message_id += 1
+            record.append(
+                discord.Message(state=state, channel=channel, data=payload(message_id, channel.id))
+            )
+        sent.append(record)
+    return rss() - before
+
+
+def ids():
+    from core.mirror import Mirror, MirrorStore
+    from core.template import Template
+
+    channels = [700000000000000000 + i for i in range(WORMHOLES)]
+
+    before = rss()
+    sent = MirrorStore(limit=MESSAGES)
+    message_id = 900000000000000000
+    for _ in range(MESSAGES):
+        message_id += 1
+        # processed text, see Wormhole._process()
+        text = f"**__nickname__**: relayed message number {message_id}\n"
+        mirror = Mirror(
+            message_id=message_id,
+            channel_id=channels[0],
+            author_id=1,
+            template=Template(text, "main", []),
+        )
+        for channel_id in channels[1:]:
+            mirror.template.render(channel_id)
+            message_id += 1
+            mirror.add_replica(channel_id, message_id)
+        sent.add(mirror, timeout=3600)
+    return rss() - before
+
+
+def main():
+    if len(sys.argv) > 3:
+        print({"messages": messages, "ids": ids}[sys.argv[3]]())
+        return
+
+    print(f"{MESSAGES} messages relayed to {WORMHOLES} wormholes")
+    for variant in ("messages", "ids"):
+        result = subprocess.run(
+            [
+                sys.executable,
+                "-m",
+                "benchmarks.mirror_memory",
+                str(MESSAGES),
+                str(WORMHOLES),
+                variant,
+            ],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        kb = int(result.stdout)
+        print(f"{variant:>9}: {kb / 1024:8.1f} MB, {kb * 1024 / MESSAGES:6.0f} B per message")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""Tag rewriting in Wormhole._process
+
+Compares the previous implementation (four `re.findall` scans, `str.replace` for every
+match, one nickname lookup per mention) with the single-pass `TAGS.sub()` rewriter.
+Database and Discord lookups are replaced by dictionaries; the number of nickname
+lookups, which are Redis round trips in the bot, is reported separately.
+
+Run from the repository root (config.json has to exist):
+
+    python3 -m benchmarks.process_tags [repetitions]
+"""
+import random
+import re
+import sys
+import timeit
+
+from cogs.wormhole import TAGS, USER_TAGS
+
+REPETITIONS = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+
+rng = random.Random(0)
+NICKNAMES = {i: f"user{i}" for i in range(100, 600)}
+ROLES = {i: f"role{i}" for i in range(10, 20)}
+CHANNELS = {i: f"guild/channel{i}" for i in range(30, 40)}
+EMOJIS = set(range(50, 60))
+WORDS = "the wormhole sends a message to every channel in the beam and back again".split()
+
+
+def user():
+    return f"<@!{rng.randint(100, 700)}>"
+
+
+def emoji():
+    return f"<:emoji{rng.randint(0, 9)}:{rng.randint(50, 70)}>"
+
+
+def text(words: int, tags: int, make) -> str:
+    result = [rng.choice(WORDS) for _ in range(words)]
+    for _ in range(tags):
+        result.insert(rng.randint(0, len(result)), make())
+    return " ".join(result)
+
+
+CORPORA = {
+    "plain": [text(20, 0, user) for _ in range(50)],
+    "reply": [text(15, 1, user) for _ in range(50)],
+    "emojis": [text(10, 8, emoji) for _ in range(50)],
+    "mixed": [
+        text(40, 6, lambda: rng.choice([user(), emoji(), "<@&12>", "<#33>"])) for _ in range(50)
+    ],
+    "tag-heavy": [text(100, 80, user) for _ in range(10)],
+}
+
+
+def previous(content: str, lookups: list) -> str:
+    users = re.findall(r"<@!?[0-9]+>", content)
+    roles = re.findall(r"<@&[0-9]+>", content)
+    channels = re.findall(r"<#[0-9]+>", content)
+    emojis = re.findall(r"<:[a-zA-Z0-9_]+:[0-9]+>", content)
+
+    for u in users:
+        user_id = int(u.replace("<@!", "").replace("<@", "").replace(">", ""))
+        lookups.append(user_id)
+        nickname = NICKNAMES.get(user_id)
+        content = content.replace(u, f"(({nickname}))" if nickname else "None")
+    for r in roles:
+        content = content.replace(r, ROLES.get(int(r.replace("<@&", "").replace(">", ""))))
+    for channel in channels:
+        name = CHANNELS.get(int(channel.replace("<#", "").replace(">", "")))
+        content = content.replace(channel, f"__**{name}**__")
+    for e in emojis:
+        e_ = e.replace("<:", "").replace(">", "")
+        if int(e_.split(":")[1]) not in EMOJIS:
+            content = content.replace(e, ":" + e_.split(":")[0] + ":")
+    return content
+
+
+def current(content: str, lookups: list) -> str:
+    user_ids = list({int(i) for i in USER_TAGS.findall(content)})
+    if user_ids:
+        # one pipelined query
+        lookups.append(user_ids)
+    nicknames = {i: NICKNAMES[i] for i in user_ids if i in NICKNAMES}
+
+    def replace(match) -> str:
+        if match["user"]:
+            nickname = nicknames.get(int(match["user"]))
+            return f"(({nickname}))" if nickname else "None"
+        if match["role"]:
+            return ROLES.get(int(match["role"]))
+        if match["channel"]:
+            return f"__**{CHANNELS.get(int(match['channel']))}**__"
+        if int(match["emoji"]) not in EMOJIS:
+            return f":{match['name']}:"
+        return match[0]
+
+    return TAGS.sub(replace, content)
+
+
+def main():
+    print(f"{'corpus':>10} {'previous':>12} {'single pass':>12} {'lookups':>14}")
+    for name, corpus in CORPORA.items():
+        for message in corpus:
+            assert previous(message, []) == current(message, []), message
+
+        times = []
+        lookups = []
+        for function in (previous, current):
+            calls = []
+            times.append(
+                timeit.timeit(lambda: [function(m, calls) for m in corpus], number=REPETITIONS)
+                / REPETITIONS
+                / len(corpus)
+            )
+            lookups.append(len(calls) // REPETITIONS)
+        print(
+            f"{name:>10} {times[0] * 1e6:>9.1f} us {times[1] * 1e6:>9.1f} us "
+            f"{lookups[0]:>6} -> {lookups[1]:<6}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,17 @@
 import re
 import json
+from collections import defaultdict
+from datetime import datetime
 
 import discord
 from discord.ext import commands
 
-from core import checks, errors, wormcog
+from core import checks, database, errors, wormcog
 from core.database import repo_b, repo_u, repo_w
+from core.mirror import sent
+from core.registry import registry
+from core.relay import relay
+from core.stats import RESOLUTIONS, counters
 
 config = json.load(open("config.json"))
 
@@ -29,7 +35,8 @@ class Admin(wormcog.Wormcog):
     @commands.command(name="announce")
     async def announce_(self, ctx, *, message):
         """Send announcement"""
-        await self.announce(beam=repo_w.get_attribute(ctx.channel.id, "beam"), message=message)
+        beam_name = await repo_w.get_attribute(ctx.channel.id, "beam")
+        await self.announce(beam=beam_name, message=message)
 
     @commands.check(checks.in_wormhole)
     @commands.check(checks.is_mod)
@@ -37,14 +44,33 @@ class Admin(wormcog.Wormcog):
     async def block(self, ctx, member: discord.Member):
         """Block discord user from sending messages"""
         nickname = self.sanitise(member.name, limit=16).replace(")", "").replace("(", "")
-        nickname = self.get_free_nickname(nickname)
+        nickname = await self.get_free_nickname(nickname)
 
-        if not repo_u.exists(discord_id=member.id):
-            self.user_add(ctx, member_id=member.id, nickname=nickname)
+        if not await repo_u.exists(discord_id=member.id):
+            await self.user_add(ctx, member_id=member.id, nickname=nickname)
 
-        repo_u.set(discord_id=member.id, key="readonly", value=1)
+        await repo_u.set(discord_id=member.id, key="readonly", value=1)
         await self.event.sudo(ctx, f"User **{nickname}** blocked.")
 
+    @commands.check(checks.in_wormhole)
+    @commands.check(checks.is_mod)
+    @commands.command(name="purge")
+    async def purge(self, ctx, user: discord.User, count: int = 1):
+        """Delete last messages of the user in all wormholes of the beam
+
+        The user may have left the guild already, they can be given by ID.
+        """
+        await self.delete(ctx.message)
+
+        beam_name = await repo_w.get_attribute(ctx.channel.id, "beam")
+        channel_ids = set(await repo_w.list_ids(beam=beam_name))
+        mirrors = sent.list_latest(user.id, count, channel_ids)
+        for mirror in mirrors:
+            await self.forget_mirror(mirror)
+        await self.delete_mirrors(mirrors, original=True)
+
+        await self.event.sudo(ctx, f"Purged {len(mirrors)} messages of **{user}**.")
+
     @commands.check(checks.is_admin)
     @commands.check(checks.not_in_wormhole)
     @commands.group(name="beam")
@@ -65,6 +91,8 @@ class Admin(wormcog.Wormcog):
             "edit <name> anonymity [none, guild, full]",
             "edit <name> replace [0, 1]",
             "edit <name> timeout <int>",
+            "edit <name> coalesce <int>",
+            "edit <name> attachments <int>",
             "list",
         ]
 
@@ -85,31 +113,31 @@ class Admin(wormcog.Wormcog):
         if re.fullmatch(pattern, name) is None:
             raise errors.BadArgument(f"Beam name must match `{pattern}`")
 
-        repo_b.add(name=name, admin_id=ctx.author.id)
+        await repo_b.add(name=name, admin_id=ctx.author.id)
         await self.event.sudo(ctx, f"Beam **{name}** created.")
         await self.feedback(ctx, private=False, message=f"Beam **{name}** created and opened.")
 
     @beam.command(name="open", aliases=["enable"])
     async def beam_open(self, ctx, name: str):
         """Open closed beam"""
-        repo_b.set(name=name, key="active", value=1)
+        await repo_b.set(name=name, key="active", value=1)
         await self.event.sudo(ctx, f"Beam **{name}** opened.")
         await self.announce(beam=name, message="Beam opened!")
 
     @beam.command(name="close", aliases=["disable"])
     async def beam_close(self, ctx, name: str):
         """Close beam"""
-        repo_b.set(name=name, key="active", value=0)
+        await repo_b.set(name=name, key="active", value=0)
         await self.event.sudo(ctx, f"Beam **{name}** closed.")
         await self.announce(beam=name, message="Beam closed.")
 
     @beam.command(name="edit", aliases=["set"])
     async def beam_edit(self, ctx, name: str, key: str, value: str):
         """Edit beam"""
-        if not repo_b.exists(name):
+        if not await repo_b.exists(name):
             raise errors.BadArgument("Invalid beam")
 
-        if key in ("active", "admin_id", "replace", "timeout"):
+        if key in ("active", "admin_id", "replace", "timeout", "coalesce", "attachments"):
             try:
                 value = int(value)
             except ValueError:
@@ -119,7 +147,7 @@ class Admin(wormcog.Wormcog):
         if key in ("admin_id"):
             announce = False
 
-        repo_b.set(name=name, key=key, value=value)
+        await repo_b.set(name=name, key=key, value=value)
 
         await self.event.sudo(ctx, f"Beam **{name}** updated: {key} = {value}.")
         if not announce:
@@ -131,12 +159,16 @@ class Admin(wormcog.Wormcog):
         """List all wormholes"""
         embed = discord.Embed(title="Beam list")
 
-        beam_names = repo_b.list_names()
-        for beam_name in beam_names:
-            beam = repo_b.get(beam_name)
-            ws = len(repo_w.list_ids(beam=beam.name))
+        counts = defaultdict(int)
+        for db_w in await repo_w.list_objects():
+            counts[db_w.beam] += 1
+
+        for beam in await repo_b.list_objects():
+            ws = counts[beam.name]
             name = f"**{beam.name}** ({'in' if not beam.active else ''}active) | {ws} wormholes"
             value = f"Anonymity _{beam.anonymity}_, " + f"timeout _{beam.timeout} s_ "
+            if beam.coalesce:
+                value += f", coalesce _{beam.coalesce} s_"
             embed.add_field(name=name, value=value, inline=False)
         await ctx.send(embed=embed)
 
@@ -160,6 +192,7 @@ class Admin(wormcog.Wormcog):
             "edit <channel ID> logo <string>",
             "edit <channel ID> readonly [0, 1]",
             "edit <channel ID> messages <int>",
+            "edit <channel ID> webhook [0, 1]",
             "edit <channel ID> invite <invite link>" "list",
         ]
 
@@ -179,7 +212,8 @@ class Admin(wormcog.Wormcog):
         if channel is None:
             raise errors.BadArgument("No such channel")
 
-        repo_w.add(beam=beam, discord_id=channel.id)
+        await repo_w.add(beam=beam, discord_id=channel.id)
+        await registry.load(beam)
         await self.event.sudo(
             ctx,
             f"{self._w2str_log(channel)} added. {ctx.author.mention}, can you set the local admin?",
@@ -198,8 +232,9 @@ class Admin(wormcog.Wormcog):
 
         channel = self._get_channel(ctx=ctx, channel_id=channel_id)
         if channel is not None:
-            beam_name = repo_w.get_attribute(channel_id, "beam")
-            repo_w.delete(discord_id=channel_id)
+            beam_name = await repo_w.get_attribute(channel_id, "beam")
+            await repo_w.delete(discord_id=channel_id)
+            registry.remove_channel(channel_id)
             await self.event.sudo(ctx, f"{self._w2str_log(channel)} removed.")
             await self.announce(
                 beam=beam_name, message=f"Wormhole closed: {self._w2str_out(channel)}."
@@ -208,10 +243,11 @@ class Admin(wormcog.Wormcog):
             return
 
         # channel is not available
-        wormhole = repo_w.get(channel_id)
+        wormhole = await repo_w.get(channel_id)
         if wormhole is not None:
             await self.event.sudo(ctx, f"Wormhole {channel_id} removed.")
-            repo_w.delete(discord_id=channel_id)
+            await repo_w.delete(discord_id=channel_id)
+            registry.remove_channel(channel_id)
             return
 
         await ctx.send("Not found.")
@@ -219,22 +255,28 @@ class Admin(wormcog.Wormcog):
     @wormhole.command(name="edit", aliases=["set"])
     async def wormhole_edit(self, ctx, channel_id: int, key: str, value: str):
         """Edit wormhole"""
-        if key in ("admin_id", "active", "readonly", "messages"):
+        if key in ("admin_id", "active", "readonly", "messages", "webhook"):
             try:
                 value = int(value)
             except ValueError:
                 raise errors.BadArgument("Value has to be integer.")
 
         announce = True
-        if key in ("invite", "messages", "admin_id"):
+        if key in ("invite", "messages", "admin_id", "webhook"):
             announce = False
 
         channel = self._get_channel(ctx=ctx, channel_id=channel_id)
 
-        beam_name = repo_w.get_attribute(channel_id, "beam")
-        repo_w.set(discord_id=channel.id, key=key, value=value)
+        beam_name = await repo_w.get_attribute(channel_id, "beam")
+        await repo_w.set(discord_id=channel.id, key=key, value=value)
         await self.event.sudo(ctx, f"{self._w2str_log(channel)}: {key} = {value}.")
 
+        if key in ("beam", "webhook"):
+            # webhooks are looked up when the wormholes are loaded
+            await registry.load(beam_name)
+            if key == "beam":
+                await registry.load(value)
+
         if not announce:
             return
         await self.announce(
@@ -249,23 +291,33 @@ class Admin(wormcog.Wormcog):
         embed = self.get_embed(ctx=ctx, title="Wormholes")
         template = "**{mention}** ({guild}): active {active}, readonly {readonly}"
 
-        beams = repo_b.list_names()
+        wormholes = defaultdict(list)
+        for db_w in await repo_w.list_objects():
+            wormholes[db_w.beam].append(db_w)
+
+        beams = await repo_b.list_names()
         for beam in beams:
-            wormholes = repo_w.list_objects(beam=beam)
             value = []
-            for db_w in wormholes:
+            for db_w in wormholes[beam]:
                 wormhole = self.bot.get_channel(db_w.discord_id)
                 if wormhole is None:
                     value.append("Missing: " + str(db_w))
                     continue
-                value.append(
-                    template.format(
-                        mention=wormhole.mention,
-                        guild=wormhole.guild.name,
-                        active=db_w.active,
-                        readonly=db_w.readonly,
-                    )
+                line = template.format(
+                    mention=wormhole.mention,
+                    guild=wormhole.guild.name,
+                    active=db_w.active,
+                    readonly=db_w.readonly,
                 )
+                missing = registry.missing(wormhole)
+                if missing:
+                    line += ", missing " + ", ".join(p.replace("_", " ") for p in missing)
+                # messages sent through a webhook are queued under its ID
+                destination = registry.webhooks.get(wormhole.id, wormhole)
+                breaker = relay.breakers.get(destination.id)
+                if breaker is not None and breaker.failures:
+                    line += f", circuit {breaker.state} ({breaker.failures} failures)"
+                value.append(line)
             value = "\n".join(value)
             if len(value) == 0:
                 value = "No wormholes"
@@ -307,24 +359,30 @@ class Admin(wormcog.Wormcog):
     @user.command(name="add")
     async def user_add(self, ctx, member_id: int, nickname: str):
         """Add user"""
-        repo_u.add(discord_id=member_id, nickname=nickname)
-        self.event.sudo(ctx, f"{str(repo_u.get(member_id))}.")
+        await repo_u.add(discord_id=member_id, nickname=nickname)
+        await self.event.sudo(ctx, f"{str(await repo_u.get(member_id))}.")
 
     @user.command(name="remove", alises=["delete"])
     async def user_remove(self, ctx, member_id: int):
         """Remove user"""
-        if ctx.author.id != config["admin id"] and repo_u.get_attribute(member_id, "mod") == 1:
+        if (
+            ctx.author.id != config["admin id"]
+            and await repo_u.get_attribute(member_id, "mod") == 1
+        ):
             return await ctx.send("> You do not have permission to alter mod accounts")
         if ctx.author.id != config["admin id"] and member_id == config["admin id"]:
             return await ctx.send("> You do not have permission to alter admin account")
 
-        repo_u.delete(member_id)
+        await repo_u.delete(member_id)
         await self.event.sudo(ctx, f"User **{member_id}** removed.")
 
     @user.command(name="edit", aliases=["set"])
     async def user_edit(self, ctx, member_id: int, key: str, value: str):
         """Edit user"""
-        if ctx.author.id != config["admin id"] and repo_u.get_attribute(member_id, "mod") == 1:
+        if (
+            ctx.author.id != config["admin id"]
+            and await repo_u.get_attribute(member_id, "mod") == 1
+        ):
             return await ctx.send("> You do not have permission to alter mod accounts")
         if ctx.author.id != config["admin id"] and member_id == config["admin id"]:
             return await ctx.send("> You do not have permission to alter admin account")
@@ -340,7 +398,7 @@ class Admin(wormcog.Wormcog):
             except ValueError:
                 raise errors.BadArgument("Value has to be integer.")
 
-        repo_u.set(discord_id=member_id, key=key, value=value)
+        await repo_u.set(discord_id=member_id, key=key, value=value)
         await self.event.sudo(ctx, f"{member_id} updated: {key} = {value}.")
 
     @user.command(name="list")
@@ -350,13 +408,13 @@ class Admin(wormcog.Wormcog):
         restraint: beam name, wormhole ID or user attribute
         """
         if restraint is None:
-            db_users = repo_u.list_objects()
-        elif repo_b.exists(restraint):
-            db_users = repo_u.list_objects_by_beam(restraint)
+            db_users = await repo_u.list_objects()
+        elif await repo_b.exists(restraint):
+            db_users = await repo_u.list_objects_by_beam(restraint)
         elif restraint in ("restricted", "readonly", "mod"):
-            db_users = repo_u.list_objects_by_attribute(restraint)
-        elif is_id(restraint) and repo_w.exists(int(restraint)):
-            db_users = repo_u.list_objects_by_wormhole(int(restraint))
+            db_users = await repo_u.list_objects_by_attribute(restraint)
+        elif is_id(restraint) and await repo_w.exists(int(restraint)):
+            db_users = await repo_u.list_objects_by_wormhole(int(restraint))
         else:
             raise errors.BadArgument("Value is not beam name nor wormhole ID.")
 
@@ -398,7 +456,7 @@ class Admin(wormcog.Wormcog):
                 result.append("- " + ", ".join(attrs))
 
         async def send_output(output: str):
-            if hasattr(ctx.channel, "id") and repo_w.exists(ctx.channel.id):
+            if hasattr(ctx.channel, "id") and await repo_w.exists(ctx.channel.id):
                 await ctx.author.send("```" + output + "```")
             else:
                 await ctx.send("```" + output + "```")
@@ -414,6 +472,170 @@ class Admin(wormcog.Wormcog):
             output = "No users."
         await send_output(output)
 
+    @commands.check(checks.is_admin)
+    @commands.check(checks.not_in_wormhole)
+    @commands.command(name="relay")
+    async def relay(self, ctx):
+        """Display send queue statistics"""
+        busiest = sorted(relay.queues.items(), key=lambda item: -len(item[1].deliveries))[:5]
+        result = [
+            f"**Queued**: {relay.queued} messages in {len(relay.queues)} channels, "
+            f"up to {relay.max_depth} in one",
+            f"**Delivered**: {relay.delivered}, **dropped**: {relay.dropped}, "
+            f"**retried**: {relay.retried}",
+            f"**Circuits**: {sum(not b.allows() for b in relay.breakers.values())} open, "
+            f"{relay.rejected} messages rejected",
+            f"**Wait**: {relay.wait_average:.2f} s on average, {relay.wait_max:.2f} s max",
+        ]
+        for channel_id, queue in busiest:
+            if not queue.deliveries:
+                break
+            channel = self.bot.get_channel(channel_id)
+            name = f"{channel.guild.name}/{channel.name}" if channel else str(channel_id)
+            result.append(f"{self.sanitise(name)}: {len(queue.deliveries)} queued")
+        await ctx.send(">>> " + "\n".join(result))
+
+    @commands.check(checks.is_admin)
+    @commands.check(checks.not_in_wormhole)
+    @commands.command(name="traffic")
+    async def traffic(self, ctx, resolution: str = "hour", count: int = 24):
+        """Display message traffic of beams and wormholes
+
+        resolution: minute, hour or day
+        count: Number of minutes, hours or days
+        """
+        if resolution not in RESOLUTIONS:
+            raise errors.BadArgument(f"Resolution has to be one of: {', '.join(RESOLUTIONS)}.")
+        length, keep = RESOLUTIONS[resolution]
+        count = max(1, min(count, keep // length))
+
+        # subject -> [messages, bytes]
+        totals = defaultdict(lambda: [0, 0])
+        # beam -> (messages, bucket start) of the busiest bucket
+        peaks = defaultdict(lambda: (0, 0))
+        for start, data in await counters.history(resolution, count):
+            for field, amount in data.items():
+                subject, metric = field.rsplit(":", 1)
+                totals[subject][metric == "bytes"] += amount
+                if subject.startswith("beam:") and metric == "messages":
+                    peaks[subject] = max(peaks[subject], (amount, start))
+
+        result = [f"**Last {count} {resolution}s**"]
+        for subject, (messages, size) in sorted(totals.items()):
+            if not subject.startswith("beam:"):
+                continue
+            peak, start = peaks[subject]
+            result.append(
+                f"{self.sanitise(subject[5:])}: {messages} messages, {size / 1024:.1f} kB; "
+                f"peak {peak} per {resolution} at "
+                f"{datetime.utcfromtimestamp(start):%Y-%m-%d %H:%M} UTC"
+            )
+
+        # every message is copied to all wormholes of the beam
+        beam_sizes = defaultdict(int)
+        beams = {}
+        for db_w in await repo_w.list_objects():
+            beam_sizes[db_w.beam] += 1
+            beams[db_w.discord_id] = db_w.beam
+        fanout = []
+        for subject, (messages, size) in totals.items():
+            if not subject.startswith("wormhole:"):
+                continue
+            wormhole_id = int(subject[9:])
+            copies = beam_sizes[beams.get(wormhole_id)]
+            fanout.append((size * copies, messages * copies, messages, wormhole_id))
+
+        if fanout:
+            result.append("**Wormholes by fan-out volume**")
+        for volume, copies, messages, wormhole_id in sorted(fanout, reverse=True)[:10]:
+            channel = self.bot.get_channel(wormhole_id)
+            name = f"{channel.guild.name}/{channel.name}" if channel else str(wormhole_id)
+            result.append(
+                f"{self.sanitise(name)}: {messages} messages, "
+                f"{copies} copies, {volume / 1024:.1f} kB relayed"
+            )
+        await ctx.send(">>> " + "\n".join(result))
+
+    @commands.check(checks.is_admin)
+    @commands.check(checks.not_in_wormhole)
+    @commands.group(name="database", aliases=["db"])
+    async def database(self, ctx):
+        """Manage the database"""
+        await self.delete(ctx)
+
+        if ctx.invoked_subcommand is not None:
+            return
+
+        description = config["prefix"] + "database…"
+        values = [
+            "migrate",
+            "verify",
+            "reindex",
+            "cache",
+        ]
+
+        embed = self.get_embed(ctx=ctx, title="Database", description=description)
+        embed.add_field(name="Commands", value="```" + "\n".join(values) + "```")
+        embed.add_field(
+            name="Online help",
+            value="https://sinus-x.github.io/discord-wormhole/administration#database",
+            inline=False,
+        )
+        await ctx.send(embed=embed)
+
+    @database.command(name="migrate")
+    async def database_migrate(self, ctx):
+        """Convert old database keys to the current layout"""
+        result = await database.migrate()
+        counts = ", ".join(f"{count} {kind}" for kind, count in result.items())
+        await self.event.sudo(ctx, f"Database migrated: {counts}.")
+        await ctx.send(f"> Converted {counts}.")
+
+    @database.command(name="verify")
+    async def database_verify(self, ctx):
+        """Check the index sets"""
+        await self._send_index_report(ctx, await database.reindex(repair=False), repaired=False)
+
+    @database.command(name="reindex")
+    async def database_reindex(self, ctx):
+        """Rebuild the index sets"""
+        result = await database.reindex()
+        await self.event.sudo(ctx, f"Database reindexed, {len(result)} problems fixed.")
+        await self._send_index_report(ctx, result, repaired=True)
+
+    @database.command(name="cache")
+    async def database_cache(self, ctx):
+        """Display cache statistics"""
+        template = "**{name}**: {size} objects, {hits} hits, {misses} misses ({rate:.1%} hit rate)"
+        result = []
+        for repository in (repo_b, repo_w, repo_u):
+            cache = repository.cache
+            result.append(
+                template.format(
+                    name=cache.name,
+                    size=len(cache.data),
+                    hits=cache.hits,
+                    misses=cache.misses,
+                    rate=cache.hit_rate,
+                )
+            )
+            for members in repository.members.values():
+                size = "not loaded" if members.ids is None else f"{len(members.ids)} IDs"
+                result.append(f"**{members.key}**: {size}, {members.rejected} lookups rejected")
+        await ctx.send(">>> " + "\n".join(result))
+
+    async def _send_index_report(self, ctx, problems: list, *, repaired: bool):
+        if len(problems) == 0:
+            return await ctx.send("> Indexes are consistent.")
+
+        output = f"{len(problems)} problems {'fixed' if repaired else 'found'}:"
+        for line in problems:
+            if len(output) + len(line) > 1900:
+                await ctx.send("```" + output + "```")
+                output = ""
+            output += "\n" + line
+        await ctx.send("```" + output + "```")
+
     def _get_channel(self, *, ctx: commands.Context, channel_id: int = None) -> discord.TextChannel:
         if channel_id:
             return self.bot.get_channel(channel_id)
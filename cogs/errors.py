@@ -45,7 +45,7 @@ class Errors(wormcog.Wormcog):
         # handle messages with prefix
         if isinstance(error, commands.CommandNotFound):
             # Only send in DMs and Wormhole channels
-            if hasattr(ctx.channel, "id") and not repo_w.exists(ctx.channel.id):
+            if hasattr(ctx.channel, "id") and not await repo_w.exists(ctx.channel.id):
                 return
 
             message = "Your message was not recognised as a command.\n>>> " + ctx.message.content
@@ -106,7 +106,7 @@ class Errors(wormcog.Wormcog):
             return
 
         prefix = "> **Error:** "
-        if hasattr(ctx.channel, "id") and repo_w.get(ctx.channel.id) is not None:
+        if hasattr(ctx.channel, "id") and await repo_w.get(ctx.channel.id) is not None:
             # do not leave errors in wormhole
             await ctx.send(prefix + text, delete_after=20.0)
         else:
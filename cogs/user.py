@@ -21,7 +21,7 @@ class User(wormcog.Wormcog):
     @commands.command()
     async def register(self, ctx):
         """Add yourself to the database"""
-        if repo_u.exists(ctx.author.id):
+        if await repo_u.exists(ctx.author.id):
             return await ctx.author.send("You are already registered.")
 
         nickname = (
@@ -30,13 +30,13 @@ class User(wormcog.Wormcog):
             .replace("(", "")
             .replace("_", "")
         )
-        nickname = self.get_free_nickname(nickname)
+        nickname = await self.get_free_nickname(nickname)
 
         # register
-        repo_u.add(discord_id=ctx.author.id, nickname=nickname)
-        if isinstance(ctx.channel, discord.TextChannel) and repo_w.get(ctx.channel.id):
-            beam_name = repo_w.get(ctx.channel.id).beam
-            repo_u.set(ctx.author.id, key=f"home_id:{beam_name}", value=ctx.channel.id)
+        await repo_u.add(discord_id=ctx.author.id, nickname=nickname)
+        if isinstance(ctx.channel, discord.TextChannel) and await repo_w.get(ctx.channel.id):
+            beam_name = (await repo_w.get(ctx.channel.id)).beam
+            await repo_u.set(ctx.author.id, key=f"home_id:{beam_name}", value=ctx.channel.id)
 
         await self.event.user(ctx, f"Registered as **{nickname}**.")
         await ctx.author.send(
@@ -56,7 +56,7 @@ class User(wormcog.Wormcog):
 
         description = (
             f"**NOTE**: _You have to register first with_ `{self.p}register`"
-            if repo_u.get(ctx.author.id) is None
+            if await repo_u.get(ctx.author.id) is None
             else ""
         )
         # fmt: off
@@ -82,15 +82,17 @@ class User(wormcog.Wormcog):
     @set.command(name="home")
     async def set_home(self, ctx):
         """Set current channel as your home wormhole"""
-        if not repo_u.exists(ctx.author.id):
+        if not await repo_u.exists(ctx.author.id):
             return await ctx.author.send(f"Register with `{self.p}register`")
-        if repo_u.get_attribute(ctx.author.id, "restricted") == 1:
+        if await repo_u.get_attribute(ctx.author.id, "restricted") == 1:
             return await ctx.author.send("You are forbidden to alter your settings.")
-        if not isinstance(ctx.channel, discord.TextChannel) or not repo_w.exists(ctx.channel.id):
+        if not isinstance(ctx.channel, discord.TextChannel):
+            return await ctx.author.send("Home has to be a wormhole")
+        if not await repo_w.exists(ctx.channel.id):
             return await ctx.author.send("Home has to be a wormhole")
 
-        beam_name = repo_w.get(ctx.channel.id).beam
-        repo_u.set(ctx.author.id, key=f"home_id:{beam_name}", value=ctx.channel.id)
+        beam_name = (await repo_w.get(ctx.channel.id)).beam
+        await repo_u.set(ctx.author.id, key=f"home_id:{beam_name}", value=ctx.channel.id)
         await ctx.author.send("Home set to " + ctx.channel.mention)
         await self.event.user(
             ctx,
@@ -101,12 +103,12 @@ class User(wormcog.Wormcog):
     @set.command(name="name", aliases=["nick", "nickname"])
     async def set_name(self, ctx, *, name: str):
         """Set new display name"""
-        if not repo_u.exists(ctx.author.id):
+        if not await repo_u.exists(ctx.author.id):
             return await ctx.author.send(f"Register with `{self.p}register`")
-        if repo_u.get_attribute(ctx.author.id, "restricted") == 1:
+        if await repo_u.get_attribute(ctx.author.id, "restricted") == 1:
             return await ctx.author.send("You are forbidden to alter your settings.")
         name = self.sanitise(name, limit=32)
-        u = repo_u.get_by_nickname(name)
+        u = await repo_u.get_by_nickname(name)
         if u is not None:
             return await ctx.author.send("This name is already used by someone.")
         # fmt: off
@@ -121,8 +123,8 @@ class User(wormcog.Wormcog):
             if char in name:
                 return await ctx.author.send("The name contains forbidden characters.")
 
-        before = repo_u.get_attribute(ctx.author.id, "nickname")
-        repo_u.set(ctx.author.id, key="nickname", value=name)
+        before = await repo_u.get_attribute(ctx.author.id, "nickname")
+        await repo_u.set(ctx.author.id, key="nickname", value=name)
         await ctx.author.send(f"Your nickname was changed to **{name}**")
         await self.event.user(ctx, f"Nickname changed from **{before}** to **{name}**.")
 
@@ -131,7 +133,7 @@ class User(wormcog.Wormcog):
     async def me(self, ctx):
         """See your information"""
         await self.delete(ctx.message)
-        db_u = repo_u.get(ctx.author.id)
+        db_u = await repo_u.get(ctx.author.id)
         if db_u is None:
             return await ctx.author.send("You are not registered.")
         await self.display_user_info(ctx, db_u)
@@ -142,7 +144,7 @@ class User(wormcog.Wormcog):
         """Get information about member"""
         await self.delete(ctx.message)
 
-        u = repo_u.get_by_nickname(member)
+        u = await repo_u.get_by_nickname(member)
         if u is not None:
             await self.event.user(ctx, f"Whois lookup for **{member}**.")
             return await self.display_user_info(ctx, u)
@@ -201,7 +203,8 @@ class User(wormcog.Wormcog):
 
         result = []
         template = "{logo} **{guild}**, {name}: {link}"
-        for wormhole in repo_w.list_objects(repo_w.get_attribute(ctx.channel.id, "beam")):
+        beam_name = await repo_w.get_attribute(ctx.channel.id, "beam")
+        for wormhole in await repo_w.list_objects(beam_name):
             if wormhole.invite is None:
                 continue
             channel = self.bot.get_channel(wormhole.discord_id)
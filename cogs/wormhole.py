@@ -2,17 +2,32 @@ import asyncio
 import json
 import re
 from datetime import datetime
+from typing import Tuple
 
 import discord
 from discord.ext import commands
 
-from core import checks, wormcog
+from core import checks, database, wormcog
+from core.cache import Memo
 from core.database import repo_b, repo_u, repo_w
+from core.mirror import sent
+from core.registry import registry
+from core.stats import counters
 
 started = datetime.today().strftime("%Y-%m-%d %H:%M:%S")
 
 config = json.load(open("config.json"))
 
+# Discord markup rewritten before the message is relayed, matched in a single pass
+TAGS = re.compile(
+    r"<@!?(?P<user>[0-9]+)>"
+    r"|<@&(?P<role>[0-9]+)>"
+    r"|<#(?P<channel>[0-9]+)>"
+    r"|<:(?P<name>[a-zA-Z0-9_]+):(?P<emoji>[0-9]+)>"
+)
+USER_TAGS = re.compile(r"<@!?([0-9]+)>")
+BACKTICKS = re.compile(r"```[a-z0-9]*")
+
 
 class Wormhole(wormcog.Wormcog):
     """Transfer messages between guilds"""
@@ -23,6 +38,64 @@ class Wormhole(wormcog.Wormcog):
         # Global message counter
         self.transferred = {}
 
+        # Message prefixes, dropped when the user, wormhole or beam changes
+        self.prefixes = Memo("prefixes")
+        for repository in (repo_b, repo_w, repo_u):
+            repository.cache.listeners.append(self.prefixes.drop)
+
+    def cog_unload(self):
+        for repository in (repo_b, repo_w, repo_u):
+            repository.cache.listeners.remove(self.prefixes.drop)
+        asyncio.ensure_future(registry.close())
+        asyncio.ensure_future(counters.flush())
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        # channel objects are replaced when the gateway connection is established again
+        await registry.load()
+
+    @commands.Cog.listener()
+    async def on_resumed(self):
+        await registry.load()
+
+    @commands.Cog.listener()
+    async def on_guild_channel_delete(self, channel: discord.abc.GuildChannel):
+        registry.remove_channel(channel.id)
+
+    @commands.Cog.listener()
+    async def on_guild_channel_update(
+        self, before: discord.abc.GuildChannel, after: discord.abc.GuildChannel
+    ):
+        # overwrites of a category apply to its channels as well
+        registry.refresh(after.guild.id)
+
+    @commands.Cog.listener()
+    async def on_guild_role_create(self, role: discord.Role):
+        registry.refresh(role.guild.id)
+
+    @commands.Cog.listener()
+    async def on_guild_role_delete(self, role: discord.Role):
+        registry.refresh(role.guild.id)
+
+    @commands.Cog.listener()
+    async def on_guild_role_update(self, before: discord.Role, after: discord.Role):
+        registry.refresh(after.guild.id)
+
+    @commands.Cog.listener()
+    async def on_member_update(self, before: discord.Member, after: discord.Member):
+        # roles of the bot
+        if after.id == self.bot.user.id:
+            registry.refresh(after.guild.id)
+
+    @commands.Cog.listener()
+    async def on_guild_join(self, guild: discord.Guild):
+        # the guild may have had wormholes before the bot left it
+        await registry.load()
+
+    @commands.Cog.listener()
+    async def on_guild_remove(self, guild: discord.Guild):
+        registry.remove_guild(guild.id)
+
     @commands.Cog.listener()
     async def on_message(self, message: discord.Message):
         # ignore non-textchannel sources
@@ -33,72 +106,79 @@ class Wormhole(wormcog.Wormcog):
         if message.author.bot:
             return
 
-        # get wormhole
-        db_w = repo_w.get(message.channel.id)
+        # get wormhole and check for attributes
+        db_w, db_b, admitted = await database.admit(message.channel.id, message.author.id)
 
         if db_w is None:
             return
-
-        # get additional information
-        db_b = repo_b.get(db_w.beam)
-
-        # check for attributes
-        # fmt: off
-        if db_b.active == 0 \
-        or db_w.active == 0 \
-        or repo_u.get_attribute(message.author.id, "readonly") == 1:
+        if not admitted:
             return await self.delete(message)
-        # fmt: on
 
         # do not act if message is bot command
         if message.content.startswith(config["prefix"]):
             return await self.delete(message)
 
-        # get wormhole channel objects
-        if db_b.name not in self.wormholes or len(self.wormholes[db_b.name]) == 0:
-            self.reconnect(db_b.name)
-
-        # process incoming message
-        content = await self._process(message)
-
-        # convert attachments to links
-        first_line = True
-        if message.attachments:
-            for f in message.attachments:
-                # don't add newline if message has only attachments
-                if first_line:
-                    content += " " + f.url
-                    first_line = False
-                else:
-                    content += "\n" + f.url
-
-        if len(content) < 1:
+        # process incoming message; attachments are handled by send()
+        content, body = await self._process(message)
+
+        if len(content) < 1 and not message.attachments:
             return
 
         # count the message
-        self._update_stats(message)
+        await self._update_stats(message)
 
         # send the message
-        await self.send(message=message, text=content, files=message.attachments)
+        await self.send(
+            message=message,
+            text=content,
+            files=message.attachments,
+            body=body,
+            db_w=db_w,
+            db_b=db_b,
+        )
 
     @commands.Cog.listener()
     async def on_message_edit(self, before: discord.Message, after: discord.Message):
         if before.content == after.content:
             return
+        await self._edit(after)
 
+    @commands.Cog.listener()
+    async def on_raw_message_edit(self, payload: discord.RawMessageUpdateEvent):
+        # messages in discord.py's cache are handled by on_message_edit; others (sent
+        # before a restart, or seen by another process) are only known from the index
+        if payload.cached_message is not None or "content" not in payload.data:
+            return
+        if repo_w.excludes(payload.channel_id):
+            return
+        channel = self.bot.get_channel(payload.channel_id)
+        if channel is None:
+            return
+        try:
+            message = discord.Message(state=channel._state, channel=channel, data=payload.data)
+        except KeyError:
+            # partial update, not an edit of the text
+            return
+        # without the previous text, changes like pinning can't be told apart from edits
+        await self._edit(message, confirm=False)
+
+    async def _edit(self, after: discord.Message, *, confirm: bool = True):
+        """Edit replicas of the message
+
+        The author is told about the result with a reaction, unless `confirm` is False
+        and the message is not a mirror.
+        """
         if after.author.bot:
             return
 
-        if not repo_w.exists(after.channel.id):
+        if not await repo_w.exists(after.channel.id):
             return
 
         # get forwarded messages
-        forwarded = None
-        for m in self.sent:
-            if m[0].id == after.id:
-                forwarded = m
-                break
-        if not forwarded:
+        mirror = await self.get_mirror(after.id)
+        if mirror is None:
+            if not confirm:
+                return
             try:
                 await after.add_reaction("❎")
                 await asyncio.sleep(1)
@@ -107,18 +187,12 @@ class Wormhole(wormcog.Wormcog):
                 await after.channel.sent("_Edit not successful_ ❎", delete_after=1)
             return
 
-        content = await self._process(after)
-        beam_name = repo_w.get_attribute(after.channel.id, "beam")
-        users = self._get_users_from_tags(beam_name=beam_name, text=content)
-        for message in forwarded[1:]:
-            await message.edit(
-                content=self._process_tags(
-                    beam_name=beam_name,
-                    wormhole_id=after.channel.id,
-                    users=users,
-                    text=content,
-                )
-            )
+        content, body = await self._process(after)
+        beam_name = await repo_w.get_attribute(after.channel.id, "beam")
+        if mirror.template is None or mirror.template.text != content:
+            template = await self._get_template(beam_name=beam_name, text=content)
+            plain = await self._get_template(beam_name=beam_name, text=body)
+            await self.edit_mirror(after, mirror, template, plain)
         try:
             await after.add_reaction("✅")
             await asyncio.sleep(1)
@@ -127,17 +201,24 @@ class Wormhole(wormcog.Wormcog):
             await after.channel.sent("_Edit successful_ ✅", delete_after=1)
 
     @commands.Cog.listener()
-    async def on_message_delete(self, message: discord.Message):
+    async def on_raw_message_delete(self, payload: discord.RawMessageDeleteEvent):
+        # unlike on_message_delete, dispatched for messages discord.py doesn't hold, too;
+        # neither originals nor replicas are outside wormholes
+        if repo_w.excludes(payload.channel_id):
+            return
+
+        # replica removed by someone else, it can't be edited anymore
+        sent.remove_replica(payload.message_id)
+
         # get forwarded messages
-        forwarded = None
-        for m in self.sent:
-            if m[0].id == message.id:
-                forwarded = m
-                break
-        if not forwarded:
+        mirror = await self.get_mirror(payload.message_id)
+        if mirror is None:
+            return
+        # the bot has deleted the original itself, the replicas stand in for it
+        if mirror.replaced and payload.message_id == mirror.message_id:
             return
-        for m in forwarded[1:]:
-            await m.delete()
+        await self.forget_mirror(mirror)
+        await self.delete_mirrors([mirror])
 
     @commands.command()
     async def help(self, ctx: commands.Context):
@@ -152,7 +233,7 @@ class Wormhole(wormcog.Wormcog):
         embed.add_field(name=f"**{p}link**",              value="Link to GitHub repository")
         embed.add_field(name=f"**{p}invite**",            value="Bot invite link")
 
-        db_u = repo_u.get(ctx.author.id)
+        db_u = await repo_u.get(ctx.author.id)
         if "User" in self.bot.cogs and db_u is None:
             embed.add_field(name=f"**{p}register**",      value="Register your username")
             embed.add_field(name=f"**{p}whois**",         value="Get information about user")
@@ -188,23 +269,13 @@ class Wormhole(wormcog.Wormcog):
     @commands.command(name="remove", aliases=["d", "delete", "r"])
     async def remove(self, ctx: commands.Context):
         """Delete last sent message"""
-        if len(self.sent) == 0:
+        mirror = sent.get_latest(ctx.author.id)
+        if mirror is None:
             return
 
-        for msgs in self.sent[::-1]:
-            # fmt: off
-            if isinstance(msgs[0], discord.Member) and ctx.author.id == msgs[0].id \
-            or isinstance(msgs[0], discord.Message) and ctx.author.id == msgs[0].author.id:
-                await self.delete(ctx.message)
-                for m in msgs:
-                    try:
-                        await self.delete(m)
-                    except discord.NotFound:
-                        pass
-                break
-            # fmt: on
-
-        # TODO Remove from self.sent
+        await self.forget_mirror(mirror)
+        await self.delete(ctx.message)
+        await self.delete_mirrors([mirror], original=True)
 
     @commands.guild_only()
     @commands.check(checks.in_wormhole)
@@ -214,72 +285,51 @@ class Wormhole(wormcog.Wormcog):
 
         text: A new text
         """
-        if len(self.sent) == 0:
+        mirror = sent.get_latest(ctx.author.id)
+        if mirror is None:
             return
 
-        for msgs in self.sent[::-1]:
-            # fmt: off
-            if isinstance(msgs[0], discord.Member)  and ctx.author.id == msgs[0].id \
-            or isinstance(msgs[0], discord.Message) and ctx.author.id == msgs[0].author.id:
-                await self.delete(ctx.message)
-                m = ctx.message
-                m.content = m.content.split(" ", 1)[1]
-                content = await self._process(m)
-
-                beam_name = repo_w.get_attribute(m.channel.id, "beam")
-                users = self._get_users_from_tags(beam_name=beam_name, text=content)
-                # FIXME This is causing a cascade of "Not found" messages for every wormhole.
-                # It should be rewritten so it is
-                for message in msgs[1:]:
-                    try:
-                        await message.edit(
-                            content=self._process_tags(
-                                beam_name=beam_name,
-                                wormhole_id=message.channel.id,
-                                users=users,
-                                text=content,
-                            )
-                        )
-                    except Exception as e:
-                        await self.event.user(
-                            ctx, (
-                                f"Could not edit message in {self.sanitise(message.guild.name)}"
-                                f"/{self.sanitise(message.channel.name)}:\n>>> {e}"
-                            )
-                        )
-                        await ctx.channel.send(
-                            f"> **{self.sanitise(ctx.author.name)}**: " +
-                            f"Could not replicate edit in **{self.sanitise(message.guild.name)}**.",
-                            delete_after=0.5,
-                        )
-                break
-            # fmt: on
+        await self.delete(ctx.message)
+        m = ctx.message
+        m.content = m.content.split(" ", 1)[1]
+        content, body = await self._process(m)
+
+        beam_name = await repo_w.get_attribute(m.channel.id, "beam")
+        template = await self._get_template(beam_name=beam_name, text=content)
+        plain = await self._get_template(beam_name=beam_name, text=body)
+        failed = await self.edit_mirror(ctx, mirror, template, plain)
+        if failed:
+            guilds = ", ".join(f"**{self.sanitise(message.guild.name)}**" for message in failed)
+            await ctx.channel.send(
+                f"> **{self.sanitise(ctx.author.name)}**: Could not replicate edit in {guilds}.",
+                delete_after=0.5,
+            )
 
     @commands.cooldown(rate=1, per=20, type=commands.BucketType.channel)
     @commands.command(aliases=["stat", "stats"])
     async def info(self, ctx: commands.Context):
         """Display information about wormholes"""
-        public = hasattr(ctx.channel, "id") and repo_w.get(ctx.channel.id) is not None
+        public = hasattr(ctx.channel, "id") and await repo_w.get(ctx.channel.id) is not None
 
         if public:
             await ctx.send(
-                self._get_info(repo_w.get_attribute(ctx.channel.id, "beam")),
+                await self._get_info(await repo_w.get_attribute(ctx.channel.id, "beam")),
                 delete_after=self.delay(),
             )
             return
 
-        user_beams = repo_u.get_home(ctx.author.id).keys()
+        user_beams = (await repo_u.get_home(ctx.author.id)).keys()
         for beam_name in user_beams:
-            await ctx.send(self._get_info(beam_name, title=True))
+            await ctx.send(await self._get_info(beam_name, title=True))
 
     @commands.guild_only()
     @commands.check(checks.in_wormhole)
     @commands.command()
     async def settings(self, ctx: commands.Context):
         """Display settings for current beam"""
-        db_w = repo_w.get(ctx.channel.id)
-        db_b = repo_b.get(db_w.beam)
-        db_u = repo_u.get(ctx.author.id)
+        db_w = await repo_w.get(ctx.channel.id)
+        db_b = await repo_b.get(db_w.beam)
+        db_u = await repo_u.get(ctx.author.id)
 
         msg = ">>> **Settings**:\n"
         # beam settings
@@ -336,17 +386,44 @@ class Wormhole(wormcog.Wormcog):
             await ctx.send(text)
         await self.delete(ctx.message)
 
-    def _get_prefix(self, message: discord.Message, first_line: bool = True):
+    async def _get_prefix(self, message: discord.Message, first_line: bool = True) -> str:
         """Get prefix for message"""
-        db_w = repo_w.get(message.channel.id)
-        db_b = repo_b.get(db_w.beam)
-        db_u = repo_u.get(message.author.id)
+        if not database.CACHE:
+            # changes made by other processes would not be noticed
+            return (await self._build_prefix(message, first_line))[0]
+
+        # names are part of the key, Discord changes are not reported by the database
+        key = (
+            message.author.id,
+            message.author.name,
+            message.channel.id,
+            message.guild.name,
+            first_line,
+        )
+        prefix = self.prefixes.get(key)
+        if prefix is None:
+            token = self.prefixes.token()
+            prefix, dependencies = await self._build_prefix(message, first_line)
+            self.prefixes.put(key, prefix, dependencies, token)
+        return prefix
+
+    async def _build_prefix(self, message: discord.Message, first_line: bool) -> tuple:
+        """Get prefix and keys of database objects it depends on"""
+        db_w = await repo_w.get(message.channel.id)
+        db_b = await repo_b.get(db_w.beam)
+        db_u = await repo_u.get(message.author.id)
+        dependencies = [
+            f"wormhole:{db_w.discord_id}",
+            f"beam:{db_b.name}",
+            f"user:{message.author.id}",
+        ]
 
         # get user nickname
         if db_u is not None:
             if db_b.name in db_u.home_ids:
                 # user has home wormhole
-                home = repo_w.get(db_u.home_ids[db_b.name])
+                home = await repo_w.get(db_u.home_ids[db_b.name])
+                dependencies.append(f"wormhole:{db_u.home_ids[db_b.name]}")
             else:
                 # user is registered without home
                 home = None
@@ -382,76 +459,38 @@ class Wormhole(wormcog.Wormcog):
             # wrong configuration or full anonymity
             prefix = ""
 
-        return prefix
-
-    async def _process(self, message: discord.Message):
-        """Escape mentions and apply anonymity"""
-        content = message.content
+        return prefix, dependencies
 
-        users = re.findall(r"<@!?[0-9]+>", content)
-        roles = re.findall(r"<@&[0-9]+>", content)
-        channels = re.findall(r"<#[0-9]+>", content)
-        emojis = re.findall(r"<:[a-zA-Z0-9_]+:[0-9]+>", content)
+    async def _process(self, message: discord.Message) -> Tuple[str, str]:
+        """Escape mentions and apply anonymity
 
-        # prevent tagging
-        for u in users:
-            try:
-                # Get discord user tags. If they're registered, translate to
-                # their ((nickname)); it will be converted on send.
-                user_id = int(u.replace("<@!", "").replace("<@", "").replace(">", ""))
-                nickname = repo_u.get_attribute(user_id, "nickname")
-                if nickname is not None:
-                    user = "((" + nickname + "))"
-                else:
-                    user = str(self.bot.get_user(user_id))
-            except Exception as e:  # noqa: F841
-                user = "unknown-user"
-                await self.event.user(message, "Problem in user retrieval:\n>>>{e}")
-            content = content.replace(u, user)
-        for r in roles:
-            try:
-                role = message.guild.get_role(int(r.replace("<@&", "").replace(">", ""))).name
-            except Exception as e:  # noqa: F841
-                role = "unknown-role"
-                await self.event.user(message, "Problem in role retrieval:\n>>>{e}")
-            content = content.replace(r, role)
-        # convert channel tags to universal names
-        for channel in channels:
-            try:
-                ch = self.bot.get_channel(int(channel.replace("<#", "").replace(">", "")))
-                channel_name = self.sanitise(ch.name)
-                guild_name = self.sanitise(ch.guild.name)
-                content = content.replace(channel, f"__**{guild_name}/{channel_name}**__")
-            except Exception as e:  # noqa: F841
-                await self.event.user(message, "Problem in channel retrieval:\n>>>{e}")
-        # remove unavailable emojis
-        for emoji in emojis:
-            emoji_ = emoji.replace("<:", "").replace(">", "")
-            emoji_name = emoji_.split(":")[0]
-            emoji_id = int(emoji_.split(":")[1])
-            if self.bot.get_emoji(emoji_id) is None:
-                content = content.replace(emoji, ":" + emoji_name + ":")
+        Returns the text with prefixes and without them, for wormholes that relay
+        through a webhook.
+        """
+        content = await self._replace_tags(message, message.content)
 
         # line preprocessor for codeblocks
         if "```" in content:
-            backticks = re.findall(r"```[a-z0-9]*", content)
+            backticks = BACKTICKS.findall(content)
             for b in backticks:
                 content = content.replace(f" {b}", f"\n{b}", 1)
                 content = content.replace(f"{b} ", f"{b}\n", 1)
 
+        body = content
+
         # apply prefixes
         content_ = content.split("\n")
         content = ""
-        p = self._get_prefix(message)
+        p = await self._get_prefix(message)
         code = False
         for i in range(len(content_)):
             if i == 1:
                 # use fill icon instead of guild one
-                p = self._get_prefix(message, first_line=False)
+                p = await self._get_prefix(message, first_line=False)
             line = content_[i]
             # add prefix if message starts with code block
             if i == 0 and line.startswith("```"):
-                content += self._get_prefix(message) + "\n"
+                content += await self._get_prefix(message) + "\n"
             if line.startswith("```"):
                 code = True
             if code:
@@ -461,27 +500,76 @@ class Wormhole(wormcog.Wormcog):
             if line.endswith("```") and code:
                 code = False
 
-        return content.replace("@", "@\u200b")
+        return content.replace("@", "@\u200b"), body.replace("@", "@\u200b")
+
+    async def _replace_tags(self, message: discord.Message, content: str) -> str:
+        """Translate user, role, channel and emoji tags
+
+        Registered users are translated to their ((nickname)); it will be converted on send.
+        """
+        user_ids = list({int(i) for i in USER_TAGS.findall(content)})
+        nicknames = {u.discord_id: u.nickname for u in await repo_u.get_many(user_ids) if u}
+        problems = []
 
-    def _update_stats(self, message: discord.Message):
-        """Increment wormhole's statistics"""
+        def replace(match) -> str:
+            try:
+                if match["user"]:
+                    user_id = int(match["user"])
+                    if user_id in nicknames:
+                        return f"(({nicknames[user_id]}))"
+                    return str(self.bot.get_user(user_id))
+                if match["role"]:
+                    return message.guild.get_role(int(match["role"])).name
+                if match["channel"]:
+                    channel = self.bot.get_channel(int(match["channel"]))
+                    return (
+                        f"__**{self.sanitise(channel.guild.name)}"
+                        f"/{self.sanitise(channel.name)}**__"
+                    )
+                # remove unavailable emojis
+                if self.bot.get_emoji(int(match["emoji"])) is None:
+                    return f":{match['name']}:"
+                return match[0]
+            except Exception as e:
+                problems.append(f"Problem in {match.lastgroup} retrieval:\n>>>{e}")
+                return {"user": "unknown-user", "role": "unknown-role"}.get(
+                    match.lastgroup, match[0]
+                )
+
+        content = TAGS.sub(replace, content)
+        for problem in problems:
+            await self.event.user(message, problem)
+        return content
+
+    async def _update_stats(self, message: discord.Message):
+        """Increment wormhole's statistics
+
+        The counters are written to the database in batches, see core.stats.
+        """
         # try to get author's home wormhole
-        beam_name = repo_w.get_attribute(message.channel.id, "beam")
-        channel_id = repo_u.get_attribute(message.author.id, f"home_id:{beam_name}")
+        beam_name = await repo_w.get_attribute(message.channel.id, "beam")
+        db_u = await repo_u.get(message.author.id)
+        channel_id = db_u.home_ids.get(beam_name) if db_u is not None else None
         if channel_id is None:
             # user is not registered, use current wormhole
             channel_id = message.channel.id
 
-        current = repo_w.get_attribute(channel_id, "messages")
-        repo_w.set(channel_id, "messages", current + 1)
+        counters.count(beam=beam_name, wormhole_id=channel_id, user_id=message.author.id)
+        # traffic is recorded for the wormhole it came from
+        size = len(message.content.encode()) + sum(a.size for a in message.attachments)
+        counters.record(
+            size,
+            beam=beam_name,
+            wormhole_id=message.channel.id,
+            user_id=message.author.id if db_u is not None else None,
+        )
 
-        beam_name = repo_w.get_attribute(message.channel.id, "beam")
         if beam_name in self.transferred:
             self.transferred[beam_name] += 1
         else:
             self.transferred[beam_name] = 1
 
-    def _get_info(self, beam_name: str, title: bool = False) -> str:
+    async def _get_info(self, beam_name: str, title: bool = False) -> str:
         """Get beam statistics.
 
         If title is True, the message has beam information.
@@ -490,15 +578,23 @@ class Wormhole(wormcog.Wormcog):
         msg = ["**Beam __" + beam_name + "__**"] if title else []
 
         since = self.transferred[beam_name] if beam_name in self.transferred else 0
+        field = f"beam:{beam_name}:messages"
+        minutes = [d.get(field, 0) for _, d in await counters.history("minute", 60, field)]
+        today = (await counters.history("day", 1, field))[0][1].get(field, 0)
         msg += [
             f">>> **[[total]]** messages sent in total "
             f"(**{since}** since {started}); "
             f"ping **{self.bot.latency:.2f}s**",
+            f"**{sum(minutes)}** messages in the last hour (up to **{max(minutes)}** "
+            f"per minute), **{today}** today",
             "",
             "Currently opened wormholes:",
         ]
 
-        wormholes = repo_w.list_objects(beam_name)
+        wormholes = await repo_w.list_objects(beam_name)
+        # include messages that have not been written yet
+        for wormhole in wormholes:
+            wormhole.messages += counters.wormholes.get(wormhole.discord_id, 0)
         wormholes.sort(key=lambda x: x.messages, reverse=True)
 
         # loop over wormholes in current beam
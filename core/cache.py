@@ -0,0 +1,203 @@
+from typing import Any, Callable, Dict, Hashable, Iterable, List, Optional, Set
+
+
+class Cache:
+    """In-memory copy of database hashes
+
+    Entries are keyed by their database key (e.g. `wormhole:123`). Repositories write
+    through on every change; changes made by other processes are picked up from Redis
+    keyspace notifications, which drop the entry.
+
+    Own writes are notified as well. Repositories announce them with `expect()`, so
+    their notifications are recognised by `confirm()` and the written entry is kept.
+    Notifications arrive in the order of the writes; if another process writes the
+    key meanwhile, one of the notifications is still taken for foreign.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.data: Dict[str, Dict[str, str]] = {}
+
+        # increased on every invalidation, see `token()`
+        self.version = 0
+
+        self.hits = 0
+        self.misses = 0
+
+        # called with the changed key, or None if everything was dropped
+        self.listeners: List[Callable[[Optional[str]], None]] = []
+
+        # key -> notifications of own writes that have not arrived yet
+        self.expected: Dict[str, int] = {}
+
+    def __repr__(self):
+        return (
+            f"Cache {self.name}: "
+            f"{len(self.data)} entries, {self.hits} hits, {self.misses} misses"
+        )
+
+    def get(self, key: str) -> Optional[Dict[str, str]]:
+        result = self.data.get(key)
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return result
+
+    def token(self) -> int:
+        """Get token to be passed to `put()` after the data are loaded.
+
+        If the key is invalidated while the database is being read, the loaded data
+        may already be outdated and they won't be stored.
+        """
+        return self.version
+
+    def put(self, key: str, data: Dict[str, str], token: int = None):
+        if token is not None and token != self.version:
+            return
+        self.data[key] = data
+
+    def update(self, key: str, mapping: Dict[str, str], notify: bool = True):
+        """Write changed attributes through, if the object is cached"""
+        if key in self.data:
+            self.data[key] = {**self.data[key], **{k: str(v) for k, v in mapping.items()}}
+        if notify:
+            self.notify(key)
+
+    def remove(self, key: str, field: str):
+        if key in self.data:
+            self.data[key] = {k: v for k, v in self.data[key].items() if k != field}
+        self.notify(key)
+
+    def invalidate(self, key: str = None):
+        """Drop the entry; drop everything if the key is omitted"""
+        self.version += 1
+        if key is None:
+            self.data = {}
+            self.expected = {}
+        else:
+            self.data.pop(key, None)
+            self.expected.pop(key, None)
+        self.notify(key)
+
+    def expect(self, key: str):
+        """Announce a write of the key, its notification will not drop the entry"""
+        self.expected[key] = self.expected.get(key, 0) + 1
+
+    def confirm(self, key: str) -> bool:
+        """Whether the notification is of an own write, see `expect()`"""
+        count = self.expected.get(key, 0)
+        if count == 0:
+            return False
+        if count == 1:
+            del self.expected[key]
+        else:
+            self.expected[key] = count - 1
+        return True
+
+    def notify(self, key: Optional[str]):
+        """Tell listeners the object has changed"""
+        for listener in self.listeners:
+            listener(key)
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+class Members:
+    """In-memory copy of a database index set
+
+    Lookups of IDs that are not members are answered without a round trip. Until the
+    set is loaded, and after another process changes it until it is loaded again, the
+    answer is unknown and the caller has to ask the database.
+    """
+
+    def __init__(self, key: str):
+        self.key = key
+        self.ids: Optional[Set[str]] = None
+
+        # increased on every invalidation, see `Cache.token()`
+        self.version = 0
+
+        # lookups answered from memory
+        self.rejected = 0
+
+    def __repr__(self):
+        size = "not loaded" if self.ids is None else f"{len(self.ids)} members"
+        return f"Members {self.key}: {size}, {self.rejected} rejected"
+
+    def token(self) -> int:
+        return self.version
+
+    def load(self, ids: Iterable, token: int = None):
+        if token is not None and token != self.version:
+            return
+        self.ids = {str(i) for i in ids}
+
+    def excludes(self, identifier) -> bool:
+        """Whether the ID is known not to be a member"""
+        if self.ids is None or str(identifier) in self.ids:
+            return False
+        self.rejected += 1
+        return True
+
+    def add(self, identifier):
+        if self.ids is not None:
+            self.ids.add(str(identifier))
+
+    def discard(self, identifier):
+        if self.ids is not None:
+            self.ids.discard(str(identifier))
+
+    def invalidate(self):
+        """Forget the members until they are loaded again"""
+        self.version += 1
+        self.ids = None
+
+
+class Memo:
+    """Values computed from database objects
+
+    Every value remembers keys of the objects it was computed from and it is dropped
+    when any of them changes; register `drop()` as a listener of repository caches.
+    """
+
+    def __init__(self, name: str, limit: int = 10000):
+        self.name = name
+        self.limit = limit
+        self.data: Dict[Hashable, Any] = {}
+        # database key -> memo keys computed from it
+        self.dependents: Dict[str, Set[Hashable]] = {}
+
+        # increased on every drop, see `Cache.token()`
+        self.version = 0
+
+    def __repr__(self):
+        return f"Memo {self.name}: {len(self.data)} entries"
+
+    def get(self, key: Hashable) -> Any:
+        return self.data.get(key)
+
+    def token(self) -> int:
+        return self.version
+
+    def put(self, key: Hashable, value: Any, dependencies: Iterable[str], token: int = None):
+        if token is not None and token != self.version:
+            return
+        if len(self.data) >= self.limit:
+            self.drop()
+        self.data[key] = value
+        for dependency in dependencies:
+            self.dependents.setdefault(dependency, set()).add(key)
+
+    def drop(self, dependency: str = None):
+        """Drop values computed from the key; drop everything if the key is omitted"""
+        self.version += 1
+        if dependency is None:
+            self.data = {}
+            self.dependents = {}
+            return
+        for key in self.dependents.pop(dependency, ()):
+            self.data.pop(key, None)
@@ -1,85 +1,426 @@
+import asyncio
+import json
 import redis
-from typing import Union, Optional, List, Dict
+import redis.asyncio
+from collections import defaultdict
+from typing import Any, Union, Optional, List, Dict, Set, Tuple
 
-from core import objects
+from core import objects, output
+from core.cache import Cache, Members
 from core.errors import DatabaseException
 
-db = redis.Redis(host="localhost", port=6379, db=0, decode_responses=True)
+config = json.load(open("config.json"))
+
+# Connections are opened on demand; if all of them are busy, callers wait for a free one
+db = redis.asyncio.Redis(
+    connection_pool=redis.asyncio.BlockingConnectionPool(
+        host="localhost",
+        port=6379,
+        db=0,
+        decode_responses=True,
+        max_connections=config.get("database connections", 16),
+    )
+)
+
+# Packed binary values can't be decoded as text, they are read by a separate client
+db_raw = redis.asyncio.Redis(
+    connection_pool=redis.asyncio.BlockingConnectionPool(
+        host="localhost",
+        port=6379,
+        db=0,
+        max_connections=config.get("database connections", 16),
+    )
+)
+
+# Entities are stored as one hash per object: `beam:main`, `wormhole:123`, `user:456`.
+# With "legacy database" enabled, the old `type:identifier:attribute` keys are read
+# as a fallback and converted on first write, so the bot can run during migration.
+LEGACY = config.get("legacy database", False)
+
+# Objects are held in memory and refreshed when Redis reports a change of their key
+CACHE = config.get("database cache", True)
+
+
+class Repository:
+    """Shared storage logic of the hash-per-entity layout
+
+    Every object is also a member of index sets (`index:...` keys), so lists can be
+    read without scanning the keyspace. Attributes listed in `unique` are mapped back
+    to the object in an index hash. Indexes are maintained in the same transaction
+    as the object itself; see `_indexes()`.
+    """
+
+    def __init__(
+        self,
+        prefix: str,
+        attributes: tuple,
+        integers: tuple,
+        marker: str,
+        unique: Dict[str, str] = None,
+        members: Tuple[str, ...] = (),
+    ):
+        self.prefix = prefix
+        self.attributes = attributes
+        self.integers = integers
+        # attribute every legacy object has, used for existence checks
+        self.marker = marker
+        # attribute -> key of index hash
+        self.unique = unique or {}
+
+        self.cache = Cache(prefix)
+        # index sets held in memory, loaded by `listen()`
+        self.members: Dict[str, Members] = {key: Members(key) for key in members}
 
+    ##
+    ## Storage
+    ##
+
+    def _key(self, identifier) -> str:
+        return f"{self.prefix}:{identifier}"
+
+    async def _exists(self, identifier) -> bool:
+        if CACHE and self._key(identifier) in self.cache.data:
+            return True
+        if self._excludes(f"index:{self.prefix}s", identifier):
+            return False
+        if await db.exists(self._key(identifier)):
+            return True
+        return LEGACY and await db.exists(f"{self.prefix}:{identifier}:{self.marker}")
+
+    async def _load(self, identifier) -> Dict[str, str]:
+        if self._excludes(f"index:{self.prefix}s", identifier):
+            return {}
+        key = self._key(identifier)
+        if CACHE:
+            data = self.cache.get(key)
+            if data is not None:
+                return data
+            token = self.cache.token()
+
+        data = await db.hgetall(key)
+        if not data and LEGACY:
+            data = await self._load_legacy(identifier)
+
+        if CACHE and data:
+            self.cache.put(key, data, token)
+        return data
+
+    async def _load_many(self, identifiers: list) -> List[Dict[str, str]]:
+        """Load several objects in one round trip
+
+        Cached objects are served from memory, the rest is read in a pipeline.
+        """
+        result = {}
+        missing = []
+        for identifier in identifiers:
+            if self._excludes(f"index:{self.prefix}s", identifier):
+                result[identifier] = {}
+                continue
+            data = self.cache.get(self._key(identifier)) if CACHE else None
+            if data is None:
+                missing.append(identifier)
+            else:
+                result[identifier] = data
+        if not missing:
+            return [result[i] for i in identifiers]
+
+        token = self.cache.token()
+        pipe = db.pipeline(transaction=False)
+        for identifier in missing:
+            pipe.hgetall(self._key(identifier))
+        for identifier, data in zip(missing, await pipe.execute()):
+            if not data and LEGACY:
+                data = await self._load_legacy(identifier)
+            if CACHE and data:
+                self.cache.put(self._key(identifier), data, token)
+            result[identifier] = data
+        return [result[i] for i in identifiers]
+
+    async def _load_field(self, identifier, field: str) -> Optional[str]:
+        if CACHE:
+            # load the whole object, so it is cached for the next time
+            return (await self._load(identifier)).get(field)
+
+        result = await db.hget(self._key(identifier), field)
+        if result is None and LEGACY:
+            result = await db.get(f"{self.prefix}:{identifier}:{field}")
+        return result
+
+    async def _load_members(self, key: str) -> Set[str]:
+        return await db.smembers(key)
+
+    async def _create(self, pipe, identifier, mapping: Dict[str, Union[str, int]]):
+        await self._unique_check(identifier, mapping)
+
+        pipe.hset(self._key(identifier), mapping=mapping)
+        self._expect(identifier)
+        for index in self._indexes(identifier, mapping):
+            self._index_add(pipe, index, identifier)
+        for attribute, index in self.unique.items():
+            if attribute in mapping:
+                pipe.hset(index, mapping[attribute], identifier)
+        if CACHE:
+            self.cache.put(self._key(identifier), {k: str(v) for k, v in mapping.items()})
+        self.cache.notify(self._key(identifier))
+
+    async def _store(self, pipe, identifier, mapping: Dict[str, Union[str, int]]):
+        await self._unique_check(identifier, mapping)
+
+        before = await self._load(identifier)
+        after = {**before, **{k: str(v) for k, v in mapping.items()}}
+
+        pipe.hset(self._key(identifier), mapping=mapping)
+        self._expect(identifier)
+        self._reindex(pipe, identifier, before, after)
+        await self._reindex_unique(pipe, identifier, before, after)
+        self.cache.update(self._key(identifier), mapping)
+
+    async def _unset(self, pipe, identifier, field: str):
+        before = await self._load(identifier)
+        after = {k: v for k, v in before.items() if k != field}
+
+        pipe.hdel(self._key(identifier), field)
+        # removing a missing field is not notified
+        if field in before:
+            self._expect(identifier)
+        self._reindex(pipe, identifier, before, after)
+        await self._reindex_unique(pipe, identifier, before, after)
+        self.cache.remove(self._key(identifier), field)
+
+    async def _increment(self, attribute: str, amounts: Dict[Any, int]):
+        """Add to an integer attribute of several objects in one round trip"""
+        # HINCRBY would create an incomplete hash for objects that have been deleted
+        identifiers = [i for i, data in zip(amounts, await self._load_many(list(amounts))) if data]
+        if not identifiers:
+            return
+        for identifier in identifiers:
+            await self._prepare_write(identifier)
+
+        pipe = db.pipeline()
+        for identifier in identifiers:
+            pipe.hincrby(self._key(identifier), attribute, amounts[identifier])
+            self._expect(identifier)
+        values = await self._execute(pipe, *identifiers)
+        # counters are not used by computed values, see Memo
+        for identifier, value in zip(identifiers, values):
+            self.cache.update(self._key(identifier), {attribute: value}, notify=False)
+
+    async def _drop(self, pipe, identifier):
+        data = await self._load(identifier)
+        for index in self._indexes(identifier, data):
+            self._index_remove(pipe, index, identifier)
+        for attribute, index in self.unique.items():
+            if attribute in data:
+                await self._unique_remove(pipe, index, data[attribute], identifier)
+        pipe.delete(self._key(identifier))
+        if LEGACY:
+            pipe.delete(*[f"{self.prefix}:{identifier}:{a}" for a in self.attributes])
+        self.cache.invalidate(self._key(identifier))
+
+    def _expect(self, identifier):
+        """Keep the written object when its keyspace notification arrives"""
+        if CACHE:
+            self.cache.expect(self._key(identifier))
+
+    async def _execute(self, pipe, *identifiers) -> list:
+        try:
+            return await pipe.execute()
+        except redis.exceptions.RedisError:
+            # written values may not have been stored
+            for identifier in identifiers:
+                self.cache.invalidate(self._key(identifier))
+            raise
+
+    async def _load_legacy(self, identifier) -> Dict[str, str]:
+        keys = [f"{self.prefix}:{identifier}:{a}" for a in self.attributes]
+        return {a: v for a, v in zip(self.attributes, await db.mget(keys)) if v is not None}
+
+    async def _prepare_write(self, identifier):
+        """Convert legacy object before it is altered"""
+        if LEGACY and not await db.exists(self._key(identifier)):
+            await self._migrate_one(identifier)
+
+    def _convert(self, field: str, value: Optional[str]) -> Optional[Union[str, int]]:
+        if field.split(":")[0] in self.integers and value:
+            return int(value)
+        return value
+
+    ##
+    ## Indexes
+    ##
 
-class BeamRepository:
+    def _indexes(self, identifier, data: Dict[str, str]) -> List[str]:
+        """Get keys of index sets the object is a member of"""
+        raise NotImplementedError()
+
+    def _reindex(self, pipe, identifier, before: Dict[str, str], after: Dict[str, str]):
+        before = set(self._indexes(identifier, before))
+        after = set(self._indexes(identifier, after))
+        for index in before - after:
+            self._index_remove(pipe, index, identifier)
+        for index in after - before:
+            self._index_add(pipe, index, identifier)
+
+    def _index_add(self, pipe, index: str, identifier):
+        pipe.sadd(index, identifier)
+        if index in self.members:
+            self.members[index].add(identifier)
+
+    def _index_remove(self, pipe, index: str, identifier):
+        pipe.srem(index, identifier)
+        if index in self.members:
+            self.members[index].discard(identifier)
+
+    def _excludes(self, index: str, identifier) -> bool:
+        """Whether the object is known not to be in the index, without a round trip"""
+        return index in self.members and self.members[index].excludes(identifier)
+
+    async def _reindex_unique(
+        self, pipe, identifier, before: Dict[str, str], after: Dict[str, str]
+    ):
+        for attribute, index in self.unique.items():
+            if before.get(attribute) == after.get(attribute):
+                continue
+            if attribute in before:
+                await self._unique_remove(pipe, index, before[attribute], identifier)
+            if attribute in after:
+                pipe.hset(index, after[attribute], identifier)
+
+    async def _unique_remove(self, pipe, index: str, value: str, identifier):
+        # the value may be owned by another object, if the index was inconsistent
+        if await db.hget(index, value) == str(identifier):
+            pipe.hdel(index, value)
+
+    async def _unique_check(self, identifier, mapping: Dict[str, Union[str, int]]):
+        for attribute, index in self.unique.items():
+            if attribute not in mapping:
+                continue
+            owner = await db.hget(index, mapping[attribute])
+            if owner is not None and owner != str(identifier):
+                raise DatabaseException(f"The {attribute} `{mapping[attribute]}` is already used.")
+
+    async def _scan_ids(self) -> Set[str]:
+        """Find all objects in the keyspace, without using the indexes"""
+        result = set()
+        async for r in db.scan_iter(match=f"{self.prefix}:*"):
+            if r.count(":") == 1 or LEGACY and r.endswith(f":{self.marker}"):
+                result.add(r.split(":")[1])
+        return result
+
+    ##
+    ## Migration
+    ##
+
+    async def migrate(self) -> int:
+        """Convert all `type:identifier:attribute` keys to hashes"""
+        identifiers = {k.split(":")[1] async for k in db.scan_iter(match=f"{self.prefix}:*:*")}
+        for identifier in identifiers:
+            await self._migrate_one(identifier)
+        return len(identifiers)
+
+    async def _migrate_one(self, identifier):
+        keys = [k async for k in db.scan_iter(match=f"{self.prefix}:{identifier}:*")]
+        if not keys:
+            return
+        mapping = {
+            k.split(":", 2)[2]: v for k, v in zip(keys, await db.mget(keys)) if v is not None
+        }
+
+        pipe = db.pipeline()
+        if mapping:
+            pipe.hset(self._key(identifier), mapping=mapping)
+            for index in self._indexes(identifier, mapping):
+                pipe.sadd(index, identifier)
+            for attribute, index in self.unique.items():
+                if attribute in mapping:
+                    pipe.hset(index, mapping[attribute], identifier)
+        pipe.delete(*keys)
+        await pipe.execute()
+        self.cache.invalidate(self._key(identifier))
+
+
+class BeamRepository(Repository):
     def __init__(self):
-        self.attributes = ("active", "admin_id", "anonymity", "replace", "timeout")
+        super().__init__(
+            prefix="beam",
+            attributes=(
+                "active",
+                "admin_id",
+                "anonymity",
+                "replace",
+                "timeout",
+                "coalesce",
+                "attachments",
+            ),
+            integers=("active", "admin_id", "replace", "timeout", "coalesce", "attachments"),
+            marker="active",
+        )
 
     ##
     ## Interface
     ##
 
-    def exists(self, name: str) -> bool:
-        return db.exists(f"beam:{name}:active")
+    async def exists(self, name: str) -> bool:
+        return await self._exists(name)
 
-    def add(self, *, name: str, admin_id: int):
+    async def add(self, *, name: str, admin_id: int):
         self._name_check(name)
-        self._availability_check(name)
+        await self._availability_check(name)
 
-        db.mset(
+        pipe = db.pipeline()
+        await self._create(
+            pipe,
+            name,
             {
-                f"beam:{name}:active": 1,
-                f"beam:{name}:admin_id": admin_id,
-                f"beam:{name}:anonymity": "none",
-                f"beam:{name}:replace": 1,
-                f"beam:{name}:timeout": 60,
-            }
+                "active": 1,
+                "admin_id": admin_id,
+                "anonymity": "none",
+                "replace": 1,
+                "timeout": 60,
+            },
         )
+        await self._execute(pipe, name)
 
-    def get(self, name: str) -> Optional[objects.Beam]:
-        if not self.exists(name):
-            return None
+    async def get(self, name: str) -> Optional[objects.Beam]:
+        return self._object(name, await self._load(name))
 
-        result = objects.Beam(name)
-        result.active = self.get_attribute(name, "active")
-        result.admin_id = self.get_attribute(name, "admin_id")
-        result.anonymity = self.get_attribute(name, "anonymity")
-        result.replace = self.get_attribute(name, "replace")
-        result.timeout = self.get_attribute(name, "timeout")
-
-        return result
+    async def get_many(self, names: List[str]) -> List[Optional[objects.Beam]]:
+        return [self._object(n, d) for n, d in zip(names, await self._load_many(names))]
 
-    def get_attribute(self, name: str, attribute: str) -> Optional[Union[str, int]]:
+    async def get_attribute(self, name: str, attribute: str) -> Optional[Union[str, int]]:
         if attribute not in self.attributes:
             raise DatabaseException(f"Invalid beam attribute: {attribute}.")
-        result = db.get(f"beam:{name}:{attribute}")
-        if attribute in ("active", "admin_id", "replace", "timeout") and result:
-            result = int(result)
-        return result
+        return self._convert(attribute, await self._load_field(name, attribute))
 
-    def list_names(self) -> List[str]:
-        result = []
-        for r in db.scan_iter(match="beam:*:active"):
-            result.append(r)
-        return [x.split(":")[1] for x in result]
+    async def list_names(self) -> List[str]:
+        if LEGACY:
+            return list(await self._scan_ids())
+        return list(await self._load_members("index:beams"))
 
-    def list_objects(self) -> List[objects.Beam]:
-        names = self.list_names()
-        return [self.get(x) for x in names]
+    async def list_objects(self) -> List[objects.Beam]:
+        return [b for b in await self.get_many(await self.list_names()) if b is not None]
 
-    def set(self, name: str, key: str, value):
-        self._existence_check(name)
+    async def set(self, name: str, key: str, value):
+        await self._existence_check(name)
 
         if not self.is_valid_attribute(key, value):
             raise DatabaseException(f"Invalid beam attribute: {key} = {value}.")
 
-        db.set(f"beam:{name}:{key}", value)
+        await self._prepare_write(name)
+        pipe = db.pipeline()
+        await self._store(pipe, name, {key: value})
+        await self._execute(pipe, name)
 
-    def delete(self, name: str):
-        self._existence_check(name)
+    async def delete(self, name: str):
+        await self._existence_check(name)
 
-        wormholes = [db.get(x) for x in db.scan(match="wormhole:*:beam")[1]]
-        if name in wormholes:
+        wormholes = await repo_w.list_ids(beam=name)
+        if len(wormholes):
             raise DatabaseException(f"Found {len(wormholes)} linked wormholes, halting.")
 
-        for attribute in self.attributes:
-            db.delete(f"beam:{name}:{attribute}")
+        pipe = db.pipeline()
+        await self._drop(pipe, name)
+        await self._execute(pipe, name)
 
     ##
     ## Logic
@@ -88,10 +429,11 @@ class BeamRepository:
     def is_valid_attribute(self, key: str, value) -> bool:
         # fmt: off
         if key not in self.attributes \
-        or key in ("active", "replace")   and value not in (0, 1) \
-        or key in ("anonymity")           and value not in ("none", "guild", "full") \
-        or key in ("admin_id", "timeout") and type(value) != int \
-        or key in ("name", "invite")      and type(value) != str:
+        or key in ("active", "replace")       and value not in (0, 1) \
+        or key in ("anonymity")               and value not in ("none", "guild", "full") \
+        or key in ("admin_id", "timeout")     and type(value) != int \
+        or key in ("coalesce", "attachments") and (type(value) != int or value < 0) \
+        or key in ("name", "invite")          and type(value) != str:
             return False
         return True
         # fmt:on
@@ -100,6 +442,20 @@ class BeamRepository:
     ## Helpers
     ##
 
+    def _object(self, name: str, data: Dict[str, str]) -> Optional[objects.Beam]:
+        if not data:
+            return None
+
+        result = objects.Beam(name)
+        for attribute in self.attributes:
+            if attribute in data:
+                setattr(result, attribute, self._convert(attribute, data[attribute]))
+
+        return result
+
+    def _indexes(self, name: str, data: Dict[str, str]) -> List[str]:
+        return ["index:beams"] if data else []
+
     def _get_beam_name(self, string: str) -> str:
         return string.split(":")[1]
 
@@ -107,107 +463,124 @@ class BeamRepository:
         if ":" in name:
             raise DatabaseException(f"Beam name `{name}` contains semicolon.")
 
-    def _availability_check(self, name: str):
-        result = db.get(f"beam:{name}:active")
-        if result is not None:
+    async def _availability_check(self, name: str):
+        if await self._exists(name):
             raise DatabaseException(f"Beam name `{name}` already exists.")
 
-    def _existence_check(self, name: str):
-        result = db.get(f"beam:{name}:active")
-        if result is None:
+    async def _existence_check(self, name: str):
+        if not await self._exists(name):
             raise DatabaseException(f"Beam name `{name}` not found.")
 
 
-class WormholeRepository:
+class WormholeRepository(Repository):
     def __init__(self):
-        self.attributes = (
-            "beam",
-            "admin_id",
-            "active",
-            "logo",
-            "readonly",
-            "messages",
-            "invite",
+        super().__init__(
+            prefix="wormhole",
+            attributes=(
+                "beam",
+                "admin_id",
+                "active",
+                "logo",
+                "readonly",
+                "messages",
+                "invite",
+                "webhook",
+            ),
+            integers=("active", "admin_id", "messages", "readonly", "webhook"),
+            marker="active",
+            members=("index:wormholes",),
         )
 
     ##
     ## Interface
     ##
 
-    def exists(self, discord_id: int) -> bool:
-        return db.exists(f"wormhole:{discord_id}:active")
+    async def exists(self, discord_id: int) -> bool:
+        return await self._exists(discord_id)
 
-    def add(self, *, beam: str, discord_id: int):
-        self._check_availability(beam, discord_id)
+    def excludes(self, discord_id: int) -> bool:
+        """Whether the channel is known not to be a wormhole, without a round trip"""
+        return self._excludes("index:wormholes", discord_id)
 
-        db.mset(
+    async def add(self, *, beam: str, discord_id: int):
+        await self._check_availability(beam, discord_id)
+
+        pipe = db.pipeline()
+        await self._create(
+            pipe,
+            discord_id,
             {
-                f"wormhole:{discord_id}:beam": beam,
-                f"wormhole:{discord_id}:admin_id": 0,
-                f"wormhole:{discord_id}:active": 1,
-                f"wormhole:{discord_id}:logo": "",
-                f"wormhole:{discord_id}:readonly": 0,
-                f"wormhole:{discord_id}:messages": 0,
-                f"wormhole:{discord_id}:invite": "",
-            }
+                "beam": beam,
+                "admin_id": 0,
+                "active": 1,
+                "logo": "",
+                "readonly": 0,
+                "messages": 0,
+                "invite": "",
+            },
         )
+        await self._execute(pipe, discord_id)
 
-    def get(self, discord_id: int) -> Optional[objects.Wormhole]:
-        if not self.exists(discord_id):
-            return None
+    async def get(self, discord_id: int) -> Optional[objects.Wormhole]:
+        return self._object(discord_id, await self._load(discord_id))
 
-        result = objects.Wormhole(discord_id)
-        result.active = self.get_attribute(discord_id, "active")
-        result.admin_id = self.get_attribute(discord_id, "admin_id")
-        result.beam = self.get_attribute(discord_id, "beam")
-        result.logo = self.get_attribute(discord_id, "logo")
-        result.messages = self.get_attribute(discord_id, "messages")
-        result.readonly = self.get_attribute(discord_id, "readonly")
-        result.invite = self.get_attribute(discord_id, "invite")
-
-        return result
+    async def get_many(self, discord_ids: List[int]) -> List[Optional[objects.Wormhole]]:
+        return [self._object(i, d) for i, d in zip(discord_ids, await self._load_many(discord_ids))]
 
-    def get_attribute(self, discord_id: int, attribute: str) -> Optional[Union[str, int]]:
+    async def get_attribute(self, discord_id: int, attribute: str) -> Optional[Union[str, int]]:
         if attribute not in self.attributes:
             raise DatabaseException(f"Invalid wormhole attribute: {attribute}.")
-        result = db.get(f"wormhole:{discord_id}:{attribute}")
+        return self._convert(attribute, await self._load_field(discord_id, attribute))
 
-        # get data types
-        if attribute in ("active", "admin_id", "messages", "readonly") and result:
-            result = int(result)
+    async def list_ids(self, beam: str = None) -> List[int]:
+        if LEGACY:
+            result = [int(x) for x in await self._scan_ids()]
+            if beam is None:
+                return result
+            return [w for w in result if await self.get_attribute(w, "beam") == beam]
 
-        return result
-
-    def list_ids(self, beam: str = None) -> List[int]:
-        result = []
-        for r in db.scan_iter(match="wormhole:*:active"):
-            result.append(r)
-
-        result = [int(x.split(":")[1]) for x in result]
         if beam is None:
-            return result
-        return [w for w in result if self.get_attribute(w, "beam") == beam]
+            return [int(x) for x in await self._load_members("index:wormholes")]
+        return [int(x) for x in await self._load_members(f"index:beam:{beam}:wormholes")]
 
-    def list_objects(self, beam: str = None) -> List[objects.Wormhole]:
-        return [self.get(x) for x in self.list_ids(beam)]
+    async def list_objects(self, beam: str = None) -> List[objects.Wormhole]:
+        return [w for w in await self.get_many(await self.list_ids(beam)) if w is not None]
 
-    def set(self, discord_id: int, key: str, value):
-        self._check_existance(discord_id)
+    async def set(self, discord_id: int, key: str, value):
+        await self._check_existance(discord_id)
 
         if not self.is_valid_attribute(key, value):
             raise DatabaseException(f"Invalid wormhole attribute: {key} = {value}.")
 
-        db.set(f"wormhole:{discord_id}:{key}", value)
+        await self._prepare_write(discord_id)
+        pipe = db.pipeline()
+        await self._store(pipe, discord_id, {key: value})
+        await self._execute(pipe, discord_id)
 
-    def delete(self, discord_id: int):
-        self._check_existance(discord_id)
-        for attribute in self.attributes:
-            db.delete(f"wormhole:{discord_id}:{attribute}")
+    async def add_messages(self, amounts: Dict[int, int]):
+        """Increase message counters of several wormholes"""
+        await self._increment("messages", amounts)
 
+    async def delete(self, discord_id: int):
+        await self._check_existance(discord_id)
+
+        pipe = db.pipeline()
         # reset homes
-        for home in db.scan_iter(match="user:*:home_id:*"):
-            if str(discord_id) == db.get(home):
-                db.delete(home)
+        user_ids = await repo_u.list_ids_by_wormhole(discord_id)
+        for user_id in user_ids:
+            await repo_u._prepare_write(user_id)
+            for beam, home_id in (await repo_u.get_home(user_id)).items():
+                if home_id == discord_id:
+                    await repo_u._unset(pipe, user_id, f"home_id:{beam}")
+        await self._drop(pipe, discord_id)
+        pipe.delete(f"index:wormhole:{discord_id}:users")
+
+        try:
+            await self._execute(pipe, discord_id)
+        except redis.exceptions.RedisError:
+            for user_id in user_ids:
+                repo_u.cache.invalidate(repo_u._key(user_id))
+            raise
 
     ##
     ## Logic
@@ -216,9 +589,9 @@ class WormholeRepository:
     def is_valid_attribute(self, key: str, value) -> bool:
         # fmt: off
         if key not in self.attributes \
-        or key in ("active", "readonly")   and value not in (0, 1) \
-        or key in ("admin_id", "messages") and type(value) != int \
-        or key in ("beam", "logo")         and type(value) != str:
+        or key in ("active", "readonly", "webhook") and value not in (0, 1) \
+        or key in ("admin_id", "messages")          and type(value) != int \
+        or key in ("beam", "logo")                  and type(value) != str:
             return False
         return True
         # fmt: on
@@ -227,150 +600,196 @@ class WormholeRepository:
     ## Helpers
     ##
 
+    def _object(self, discord_id: int, data: Dict[str, str]) -> Optional[objects.Wormhole]:
+        if not data:
+            return None
+
+        result = objects.Wormhole(discord_id)
+        for attribute in self.attributes:
+            if attribute in data:
+                setattr(result, attribute, self._convert(attribute, data[attribute]))
+
+        return result
+
+    def _indexes(self, discord_id: int, data: Dict[str, str]) -> List[str]:
+        if not data:
+            return []
+        return ["index:wormholes", f"index:beam:{data.get('beam')}:wormholes"]
+
     def _get_wormhole_discord_id(self, string: str) -> int:
         return int(string.split(":")[1])
 
-    def _check_availability(self, beam: str, discord_id: int):
-        if not db.exists(f"beam:{beam}:active"):
+    async def _check_availability(self, beam: str, discord_id: int):
+        if not await repo_b.exists(beam):
             raise DatabaseException(f"Beam {beam} does not exist.")
-        if db.exists(f"wormhole:{discord_id}:active"):
+        if await self._exists(discord_id):
             raise DatabaseException(f"Channel `{discord_id}` is already a wormhole.")
 
-    def _check_existance(self, discord_id: int):
-        result = db.get(f"wormhole:{discord_id}:active")
-        if result is None:
+    async def _check_existance(self, discord_id: int):
+        if not await self._exists(discord_id):
             raise DatabaseException(f"Channel `{discord_id}` is not a wormhole.")
 
 
-class UserRepository:
+class UserRepository(Repository):
     def __init__(self):
-        self.attributes = (
-            "discord_id",
-            "home_id",
-            "mod",
-            "nickname",
-            "readonly",
-            "restricted",
+        super().__init__(
+            prefix="user",
+            attributes=(
+                "discord_id",
+                "home_id",
+                "mod",
+                "nickname",
+                "readonly",
+                "restricted",
+            ),
+            integers=("home_id", "mod", "readonly", "restricted"),
+            marker="readonly",
+            unique={"nickname": "index:nicknames"},
+            # most authors are not registered, they are rejected without a round trip
+            members=("index:users", "index:user:readonly"),
         )
 
     ##
     ## Interface
     ##
 
-    def exists(self, discord_id: int) -> bool:
-        return db.exists(f"user:{discord_id}:readonly")
+    async def exists(self, discord_id: int) -> bool:
+        return await self._exists(discord_id)
 
-    def add(self, *, discord_id: int, nickname: str):
-        self._availability_check(discord_id)
+    async def add(self, *, discord_id: int, nickname: str):
+        await self._availability_check(discord_id)
 
-        db.mset(
+        pipe = db.pipeline()
+        await self._create(
+            pipe,
+            discord_id,
             {
-                f"user:{discord_id}:mod": 0,
-                f"user:{discord_id}:nickname": nickname,
-                f"user:{discord_id}:readonly": 0,
-                f"user:{discord_id}:restricted": 0,
-            }
+                "mod": 0,
+                "nickname": nickname,
+                "readonly": 0,
+                "restricted": 0,
+            },
         )
+        await self._execute(pipe, discord_id)
+
+    async def get(self, discord_id: int) -> Optional[objects.User]:
+        return self._object(discord_id, await self._load(discord_id))
 
-    def get(self, discord_id: int) -> Optional[objects.User]:
-        if not self.exists(discord_id):
+    async def get_many(self, discord_ids: List[int]) -> List[Optional[objects.User]]:
+        return [self._object(i, d) for i, d in zip(discord_ids, await self._load_many(discord_ids))]
+
+    async def get_by_nickname(self, nickname: str) -> Optional[objects.User]:
+        if LEGACY:
+            for discord_id in await self.list_ids():
+                if await self.get_attribute(discord_id, "nickname") == nickname:
+                    return await self.get(discord_id)
             return None
 
-        result = objects.User(discord_id)
-        result.home_ids = self.get_home(discord_id)
-        result.mod = self.get_attribute(discord_id, "mod")
-        result.nickname = self.get_attribute(discord_id, "nickname")
-        result.readonly = self.get_attribute(discord_id, "readonly")
-        result.restricted = self.get_attribute(discord_id, "restricted")
+        discord_id = await db.hget("index:nicknames", nickname)
+        return await self.get(int(discord_id)) if discord_id is not None else None
 
-        return result
+    async def get_many_by_nickname(self, nicknames: List[str]) -> List[objects.User]:
+        """Get users in one round trip; unknown nicknames are skipped"""
+        if not nicknames:
+            return []
+        if LEGACY:
+            users = [await self.get_by_nickname(n) for n in nicknames]
+            return [u for u in users if u is not None]
 
-    def get_by_nickname(self, nickname: str) -> Optional[objects.User]:
-        for r in db.scan_iter(match="user:*:nickname"):
-            if db.get(r) == nickname:
-                return self.get(int(r.split(":")[1]))
-        return None
+        discord_ids = await db.hmget("index:nicknames", nicknames)
+        users = await self.get_many([int(i) for i in discord_ids if i is not None])
+        return [u for u in users if u is not None]
 
-    def get_attribute(self, discord_id: int, attribute: str) -> Optional[Union[str, int]]:
+    async def get_attribute(self, discord_id: int, attribute: str) -> Optional[Union[str, int]]:
         attr = attribute if ":" not in attribute else attribute.split(":")[0]
         if attr not in self.attributes:
             raise DatabaseException(f"Invalid user attribute: {attribute}.")
 
-        result = db.get(f"user:{discord_id}:{attribute}")
-        if attr in ("home_id", "mod", "readonly", "restricted") and result:
-            result = int(result)
-        return result
+        return self._convert(attribute, await self._load_field(discord_id, attribute))
+
+    async def is_readonly(self, discord_id: int) -> bool:
+        if self._excludes("index:user:readonly", discord_id):
+            return False
+        return await self.get_attribute(discord_id, "readonly") == 1
 
-    def get_home(self, discord_id: int, beam: str = None) -> Dict[str, int]:
-        match = f"user:{discord_id}:home_id:" + ("*" if beam is None else beam)
+    async def get_home(self, discord_id: int, beam: str = None) -> Dict[str, int]:
+        result = self._get_home_ids(await self._load(discord_id))
+        if beam is None:
+            return result
+        return {beam: result[beam]} if beam in result else {}
 
-        result = {}
-        for r in db.scan_iter(match=match):
-            result[r.split(":")[-1]] = int(db.get(r))
-        return result
+    async def list_ids(self) -> List[int]:
+        if LEGACY:
+            return [int(x) for x in await self._scan_ids()]
+        return [int(x) for x in await self._load_members("index:users")]
 
-    def list_ids(self) -> List[int]:
-        result = []
-        for r in db.scan_iter(match="user:*:readonly"):
-            result.append(r)
-        return [int(x.split(":")[1]) for x in result]
-
-    def list_ids_by_beam(self, beam: str) -> List[int]:
-        result = []
-        for r in db.scan_iter(match=f"user:*:home_id:{beam}"):
-            result.append(r)
-        return [int(x.split(":")[1]) for x in result]
-
-    def list_ids_by_wormhole(self, discord_id: int) -> List[int]:
-        result = []
-        users = []
-        for r in db.scan_iter(match="user:*:home_id:*"):
-            user = r.split(":")[1]
-            if user not in users:
-                users.append(user)
-                result.append(r)
-        return [int(x.split(":")[1]) for x in result if db.get(x) == str(discord_id)]
-
-    def list_ids_by_attribute(self, attribute: str) -> List[int]:
-        result = []
-        for r in db.scan_iter(match=f"user:*:{attribute}"):
-            if db.get(r) == "1":
-                result.append(r)
-        return [int(x.split(":")[1]) for x in result]
-
-    def list_objects(self) -> List[objects.User]:
-        return [self.get(x) for x in self.list_ids()]
-
-    def list_objects_by_beam(self, beam: str) -> List[objects.User]:
-        return [self.get(x) for x in self.list_ids_by_beam(beam)]
-
-    def list_objects_by_wormhole(self, discord_id: int) -> List[objects.User]:
-        return [self.get(x) for x in self.list_ids_by_wormhole(discord_id)]
-
-    def list_objects_by_attribute(self, attribute: str) -> List[objects.User]:
-        return [self.get(x) for x in self.list_ids_by_attribute(attribute)]
-
-    def set(self, discord_id: int, key: str, value):
-        self._existence_check(discord_id)
+    async def list_ids_by_beam(self, beam: str) -> List[int]:
+        if LEGACY:
+            return [u for u in await self.list_ids() if beam in await self.get_home(u)]
+        return [int(x) for x in await self._load_members(f"index:beam:{beam}:users")]
+
+    async def list_ids_by_wormhole(self, discord_id: int) -> List[int]:
+        if LEGACY:
+            return [
+                u for u in await self.list_ids() if discord_id in (await self.get_home(u)).values()
+            ]
+        return [int(x) for x in await self._load_members(f"index:wormhole:{discord_id}:users")]
+
+    async def list_ids_by_attribute(self, attribute: str) -> List[int]:
+        if LEGACY:
+            return [u for u in await self.list_ids() if await self.get_attribute(u, attribute) == 1]
+        return [int(x) for x in await self._load_members(f"index:user:{attribute}")]
+
+    async def list_objects(self) -> List[objects.User]:
+        return [u for u in await self.get_many(await self.list_ids()) if u is not None]
+
+    async def list_objects_by_beam(self, beam: str) -> List[objects.User]:
+        return [u for u in await self.get_many(await self.list_ids_by_beam(beam)) if u is not None]
+
+    async def list_objects_by_wormhole(self, discord_id: int) -> List[objects.User]:
+        ids = await self.list_ids_by_wormhole(discord_id)
+        return [u for u in await self.get_many(ids) if u is not None]
+
+    async def list_objects_by_attribute(self, attribute: str) -> List[objects.User]:
+        ids = await self.list_ids_by_attribute(attribute)
+        return [u for u in await self.get_many(ids) if u is not None]
+
+    async def set(self, discord_id: int, key: str, value):
+        await self._existence_check(discord_id)
 
         k = key if ":" not in key else key.split(":")[0]
         if not self.is_valid_attribute(k, value):
             raise DatabaseException(f"Invalid user attribute: {key} = {value}.")
         if k == "home_id":
             beam = key.split(":")[1]
-            if not db.exists(f"beam:{beam}:active"):
+            if not await repo_b.exists(beam):
                 raise DatabaseException(f"Beam not found: {beam}.")
 
-        db.set(f"user:{discord_id}:{key}", value)
+        await self._prepare_write(discord_id)
+        pipe = db.pipeline()
+        await self._store(pipe, discord_id, {key: value})
+        await self._execute(pipe, discord_id)
+
+    async def unset_home(self, discord_id: int, beam: str):
+        await self._prepare_write(discord_id)
+        pipe = db.pipeline()
+        await self._unset(pipe, discord_id, f"home_id:{beam}")
+        await self._execute(pipe, discord_id)
 
-    def delete(self, discord_id: int):
-        self._existence_check(discord_id)
+    async def delete(self, discord_id: int):
+        await self._existence_check(discord_id)
 
-        for item in db.scan_iter(match=f"user:{discord_id}:*"):
-            db.delete(item)
+        pipe = db.pipeline()
+        await self._drop(pipe, discord_id)
+        if LEGACY:
+            async for item in db.scan_iter(match=f"user:{discord_id}:*"):
+                pipe.delete(item)
+        await self._execute(pipe, discord_id)
 
-    def is_nickname_used(self, nickname: str) -> bool:
-        return nickname in [db.get(x) for x in db.scan(match="user:*:nickname")[1]]
+    async def is_nickname_used(self, nickname: str) -> bool:
+        if LEGACY:
+            return await self.get_by_nickname(nickname) is not None
+        return await db.hexists("index:nicknames", nickname)
 
     ##
     ## Logic
@@ -390,17 +809,317 @@ class UserRepository:
     ## Helpers
     ##
 
-    def _availability_check(self, discord_id: int):
-        result = db.get(f"user:{discord_id}:readonly")
-        if result is not None:
+    def _object(self, discord_id: int, data: Dict[str, str]) -> Optional[objects.User]:
+        if not data:
+            return None
+
+        result = objects.User(discord_id)
+        result.home_ids = self._get_home_ids(data)
+        for attribute in ("mod", "nickname", "readonly", "restricted"):
+            if attribute in data:
+                setattr(result, attribute, self._convert(attribute, data[attribute]))
+
+        return result
+
+    def _indexes(self, discord_id: int, data: Dict[str, str]) -> List[str]:
+        if not data:
+            return []
+        result = ["index:users"]
+        for beam, home_id in self._get_home_ids(data).items():
+            result.append(f"index:beam:{beam}:users")
+            result.append(f"index:wormhole:{home_id}:users")
+        for attribute in ("mod", "readonly", "restricted"):
+            if data.get(attribute) == "1":
+                result.append(f"index:user:{attribute}")
+        return result
+
+    def _get_home_ids(self, data: Dict[str, str]) -> Dict[str, int]:
+        return {k.split(":")[1]: int(v) for k, v in data.items() if k.startswith("home_id:")}
+
+    async def _load_legacy(self, discord_id: int) -> Dict[str, str]:
+        data = await super()._load_legacy(discord_id)
+        if data:
+            homes = [k async for k in db.scan_iter(match=f"user:{discord_id}:home_id:*")]
+            if homes:
+                data.update({k.split(":", 2)[2]: v for k, v in zip(homes, await db.mget(homes))})
+        return data
+
+    async def _availability_check(self, discord_id: int):
+        if await self._exists(discord_id):
             raise DatabaseException(f"User ID `{discord_id}` is already known.")
 
-    def _existence_check(self, discord_id: int):
-        result = db.get(f"user:{discord_id}:readonly")
-        if result is None:
+    async def _existence_check(self, discord_id: int):
+        if not await self._exists(discord_id):
             raise DatabaseException(f"User ID `{discord_id}` unknown.")
 
 
 repo_b = BeamRepository()
 repo_w = WormholeRepository()
 repo_u = UserRepository()
+
+
+def _on_keyspace_event(message: dict):
+    # channel is in `__keyspace@0__:wormhole:123[:attribute]` format
+    key = ":".join(message["channel"].split(":")[1:3])
+    for repository in (repo_b, repo_w, repo_u):
+        if key.startswith(repository.prefix + ":"):
+            if not repository.cache.confirm(key):
+                repository.cache.invalidate(key)
+
+
+def _on_index_event(message: dict):
+    # channel is in `__keyspace@0__:index:wormholes` format
+    key = message["channel"].split(":", 1)[1]
+    for members in _members():
+        if members.key == key:
+            members.invalidate()
+
+
+def _members() -> List[Members]:
+    return [m for repository in (repo_b, repo_w, repo_u) for m in repository.members.values()]
+
+
+async def _load_members(members: Members):
+    token = members.token()
+    members.load(await db.smembers(members.key), token)
+
+
+async def listen():
+    """Invalidate cached objects on database changes
+
+    Changes made by other processes (or by hand) are announced by Redis keyspace
+    notifications, which have to be enabled on the server. Index sets held in memory
+    are loaded here and loaded again when they change.
+    When the connection is lost, the subscription is renewed with backoff; everything
+    held in memory is dropped, because the notifications sent meanwhile are lost.
+    This coroutine runs until it is cancelled.
+    """
+    if not CACHE:
+        return
+
+    delay = 1
+    while True:
+        pubsub = db.pubsub(ignore_subscribe_messages=True)
+        try:
+            await _subscribe(pubsub)
+            delay = 1
+            await _receive(pubsub)
+        except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as e:
+            output.warning(f"Lost database notifications ({e}), subscribing again in {delay} s.")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 60)
+        finally:
+            await pubsub.close()
+
+
+async def _enable_notifications():
+    try:
+        flags = await db.config_get("notify-keyspace-events")
+        flags = flags.get("notify-keyspace-events", "")
+        # 'A' is an alias for all event classes
+        missing = "".join(f for f in ("K" if "A" in flags else "Kghs$") if f not in flags)
+        if missing:
+            await db.config_set("notify-keyspace-events", flags + missing)
+    except redis.exceptions.ResponseError as e:
+        output.warning(f"Could not enable keyspace notifications ({e}).")
+        output.warning("Changes made by other processes won't be visible.")
+
+
+async def _subscribe(pubsub):
+    # the server may have been restarted with its default config
+    await _enable_notifications()
+
+    await pubsub.psubscribe(
+        **{
+            f"__keyspace@0__:{repository.prefix}:*": _on_keyspace_event
+            for repository in (repo_b, repo_w, repo_u)
+        }
+    )
+    await pubsub.subscribe(**{f"__keyspace@0__:{m.key}": _on_index_event for m in _members()})
+
+    # changes made while there was no subscription have not been announced
+    for repository in (repo_b, repo_w, repo_u):
+        repository.cache.invalidate()
+    for members in _members():
+        members.invalidate()
+
+
+async def _receive(pubsub):
+    while True:
+        # objects of the legacy layout may be missing from the indexes
+        for members in _members() if not LEGACY else ():
+            if members.ids is None:
+                await _load_members(members)
+        # handlers are called from inside of get_message()
+        await pubsub.get_message(timeout=1.0)
+
+
+# Reads the wormhole, its beam and the author in one round trip and decides whether
+# the message may be relayed: KEYS are the wormhole, its beam and the user key. Every
+# key is declared, so the caller has to know the beam; if the wormhole has been moved
+# to another beam meanwhile, the message is not admitted.
+_ADMIT = """
+local function load(key)
+    local flat = redis.call("HGETALL", key)
+    local fields = {}
+    for i = 1, #flat, 2 do
+        fields[flat[i]] = flat[i + 1]
+    end
+    return flat, fields
+end
+
+local wormhole, w = load(KEYS[1])
+local beam, b = load(KEYS[2])
+local user, u = load(KEYS[3])
+
+local admitted = 0
+if #wormhole > 0 and #beam > 0 and "beam:" .. (w.beam or "") == KEYS[2]
+and b.active == "1" and w.active ~= "0" and w.readonly ~= "1" and u.readonly ~= "1" then
+    admitted = 1
+end
+return {admitted, wormhole, beam, user}
+"""
+
+# EVALSHA; the script is sent with SCRIPT LOAD the first time the server does not know it
+_admit_script = db.register_script(_ADMIT)
+
+
+async def admit(
+    channel_id: int, author_id: int
+) -> Tuple[Optional[objects.Wormhole], Optional[objects.Beam], bool]:
+    """Decide whether the author may send a message to the channel
+
+    Returns the wormhole and its beam (None if the channel is not a wormhole) and the
+    decision. Objects held in the cache are used if all of them are there, otherwise
+    they are read by a server-side script and cached; the wormhole is read first if
+    it is not cached, the script needs the name of its beam.
+    """
+    if repo_w._excludes("index:wormholes", channel_id):
+        return None, None, False
+
+    if LEGACY:
+        # the script only reads hashes
+        db_w = await repo_w.get(channel_id)
+        if db_w is None:
+            return None, None, False
+        db_b = await repo_b.get(db_w.beam)
+        return db_w, db_b, _admits(db_w, db_b) and not await repo_u.is_readonly(author_id)
+
+    if CACHE:
+        data_w = repo_w.cache.data.get(repo_w._key(channel_id))
+        data_b = repo_b.cache.data.get(repo_b._key(data_w.get("beam"))) if data_w else None
+        data_u = repo_u.cache.data.get(repo_u._key(author_id))
+        if data_u is None and repo_u._excludes("index:user:readonly", author_id):
+            data_u = {}
+        if data_w is not None and data_b is not None and data_u is not None:
+            db_w = repo_w._object(channel_id, data_w)
+            db_b = repo_b._object(db_w.beam, data_b)
+            return db_w, db_b, _admits(db_w, db_b) and data_u.get("readonly") != "1"
+
+    # the beam key has to be passed to the script, see _ADMIT
+    beam = (await repo_w._load(channel_id)).get("beam")
+    if beam is None:
+        return None, None, False
+
+    tokens = [repository.cache.token() for repository in (repo_w, repo_b, repo_u)]
+    admitted, *result = await _admit_script(
+        keys=[repo_w._key(channel_id), repo_b._key(beam), repo_u._key(author_id)]
+    )
+    data_w, data_b, data_u = [dict(zip(r[::2], r[1::2])) for r in result]
+    if data_w.get("beam") != beam:
+        # deleted or moved to another beam meanwhile
+        return None, None, False
+    if CACHE:
+        for repository, identifier, data, token in zip(
+            (repo_w, repo_b, repo_u),
+            (channel_id, beam, author_id),
+            (data_w, data_b, data_u),
+            tokens,
+        ):
+            if data:
+                repository.cache.put(repository._key(identifier), data, token)
+    return repo_w._object(channel_id, data_w), repo_b._object(beam, data_b), admitted == 1
+
+
+def _admits(db_w: objects.Wormhole, db_b: Optional[objects.Beam]) -> bool:
+    return db_b is not None and db_b.active != 0 and db_w.active != 0 and db_w.readonly != 1
+
+
+async def migrate() -> Dict[str, int]:
+    """Convert the whole database to the hash-per-entity layout"""
+    result = {
+        "beams": await repo_b.migrate(),
+        "wormholes": await repo_w.migrate(),
+        "users": await repo_u.migrate(),
+    }
+    await reindex()
+    return result
+
+
+async def reindex(*, repair: bool = True) -> List[str]:
+    """Compare indexes with the objects
+
+    The indexes are rebuilt from scratch if `repair` is set.
+    Returns list of found inconsistencies.
+    """
+    expected, expected_unique, result = await _collect_indexes()
+
+    found = {k async for k in db.scan_iter(match="index:*")}
+    found_unique = {i for r in (repo_b, repo_w, repo_u) for i in r.unique.values()} & found
+    found -= found_unique
+
+    for index in sorted(found | set(expected)):
+        members = await db.smembers(index) if index in found else set()
+        missing = expected[index] - members
+        extra = members - expected[index]
+        if missing:
+            result.append(f"{index}: missing {', '.join(sorted(missing))}")
+        if extra:
+            result.append(f"{index}: unexpected {', '.join(sorted(extra))}")
+
+    for index in sorted(expected_unique.keys() | found_unique):
+        mapping = await db.hgetall(index)
+        for value in sorted(expected_unique[index].keys() | mapping.keys()):
+            if mapping.get(value) != expected_unique[index].get(value):
+                result.append(
+                    f"{index}: {value} points to {mapping.get(value)}, "
+                    f"expected {expected_unique[index].get(value)}"
+                )
+
+    if repair and result:
+        pipe = db.pipeline()
+        if found | found_unique:
+            pipe.delete(*(found | found_unique))
+        for index, members in expected.items():
+            pipe.sadd(index, *members)
+        for index, mapping in expected_unique.items():
+            if mapping:
+                pipe.hset(index, mapping=mapping)
+        await pipe.execute()
+
+    return result
+
+
+async def _collect_indexes() -> Tuple[Dict[str, Set[str]], Dict[str, Dict[str, str]], List[str]]:
+    """Compute index content from the objects
+
+    Returns index sets, index hashes and values violating uniqueness.
+    """
+    expected = defaultdict(set)
+    expected_unique = defaultdict(dict)
+    duplicates = []
+    for repository in (repo_b, repo_w, repo_u):
+        for identifier in sorted(await repository._scan_ids()):
+            data = await repository._load(identifier)
+            for index in repository._indexes(identifier, data):
+                expected[index].add(identifier)
+            for attribute, index in repository.unique.items():
+                value = data.get(attribute)
+                if value is None:
+                    continue
+                if value in expected_unique[index]:
+                    owner = expected_unique[index][value]
+                    duplicates.append(f"{index}: {value} is used by both {owner} and {identifier}")
+                    continue
+                expected_unique[index][value] = identifier
+    return expected, expected_unique, duplicates
@@ -23,6 +23,21 @@ class DatabaseException(WormholeException):
         return self.message
 
 
+class RelayException(WormholeException):
+    def __str__(self):
+        return self.message
+
+
+class CircuitOpen(RelayException):
+    def __init__(self):
+        super().__init__("Destination is failing, circuit is open.")
+
+
+class WebhookMissing(RelayException):
+    def __init__(self):
+        super().__init__("Webhook has been deleted.")
+
+
 class BadArgument(WormholeException):
     pass
 
@@ -0,0 +1,92 @@
+import io
+import os
+import tempfile
+from typing import Optional
+
+import aiohttp
+import discord
+
+# bytes read from the response at once
+CHUNK_SIZE = 64 * 1024
+
+
+class SharedFile:
+    """Attachment downloaded once and uploaded to all wormholes
+
+    Files up to `memory` bytes are held as one bytes object; every upload gets its own
+    reader over it, the data is not copied. Larger files are spooled to a temporary
+    file that every upload opens on its own.
+    """
+
+    def __init__(self, filename: str, spoiler: bool = False):
+        self.filename = filename
+        self.spoiler = spoiler
+        self.size = 0
+        self.data: Optional[bytes] = None
+        self.path: Optional[str] = None
+
+    def __repr__(self):
+        where = "in memory" if self.path is None else f"in {self.path}"
+        return f"SharedFile {self.filename}: {self.size} B {where}"
+
+    @classmethod
+    async def download(
+        cls,
+        session: aiohttp.ClientSession,
+        attachment: discord.Attachment,
+        *,
+        limit: int,
+        memory: int,
+    ) -> Optional["SharedFile"]:
+        """Stream the attachment into a buffer
+
+        Returns None if the attachment is larger than `limit` bytes.
+        """
+        if attachment.size > limit:
+            return None
+
+        result = cls(attachment.filename, attachment.is_spoiler())
+        buffer = io.BytesIO()
+        try:
+            async with session.get(attachment.url) as response:
+                response.raise_for_status()
+                async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                    result.size += len(chunk)
+                    if result.size > limit:
+                        result.close()
+                        return None
+                    if result.path is None and result.size > memory:
+                        buffer = result._spool(buffer)
+                    buffer.write(chunk)
+        except Exception:
+            result.close()
+            raise
+        finally:
+            if not isinstance(buffer, io.BytesIO):
+                buffer.close()
+
+        if result.path is None:
+            result.data = buffer.getvalue()
+        return result
+
+    def _spool(self, buffer: io.BytesIO):
+        """Move the data downloaded so far to a temporary file"""
+        fd, self.path = tempfile.mkstemp(prefix="wormhole-")
+        spool = os.fdopen(fd, "wb")
+        spool.write(buffer.getbuffer())
+        return spool
+
+    def file(self) -> discord.File:
+        """Get file for one upload"""
+        fp = io.BytesIO(self.data) if self.path is None else open(self.path, "rb")
+        return discord.File(fp, filename=self.filename, spoiler=self.spoiler)
+
+    def close(self):
+        """Release the buffer"""
+        self.data = None
+        if self.path is not None:
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+            self.path = None
@@ -0,0 +1,304 @@
+import heapq
+import json
+import struct
+import time
+from array import array
+from collections import OrderedDict
+from typing import Collection, Dict, List, Optional, Tuple
+
+from core.database import db_raw
+from core.template import Template
+
+config = json.load(open("config.json"))
+
+
+class Mirror:
+    """Sent message and its copies in other wormholes
+
+    Only IDs are held in memory, see `Wormcog.get_replicas()` for message objects.
+    """
+
+    __slots__ = (
+        "message_id",
+        "channel_id",
+        "author_id",
+        "replaced",
+        "replicas",
+        "template",
+        "plain",
+        "batch",
+        "expires",
+    )
+
+    def __init__(
+        self,
+        *,
+        message_id: int,
+        channel_id: int,
+        author_id: int,
+        template: Template = None,
+        plain: Template = None,
+    ):
+        self.message_id = message_id
+        self.channel_id = channel_id
+        self.author_id = author_id
+        # the original has been deleted and it is only represented by its replicas
+        self.replaced = False
+        # (channel ID, message ID) pairs of the replicas, flattened
+        self.replicas = array("Q")
+        self.template = template
+        # text without prefixes, for wormholes relaying through a webhook
+        self.plain = plain
+        # combined message this one is part of, see Batch
+        self.batch: Optional[Batch] = None
+        self.expires = 0.0
+
+    def __repr__(self):
+        return (
+            f"Mirror {self.message_id}: author {self.author_id}, "
+            f"{len(self.replicas) // 2} replicas, expires {self.expires:.0f}"
+        )
+
+    def add_replica(self, channel_id: int, message_id: int):
+        self.replicas.extend((channel_id, message_id))
+
+    def remove_replica(self, message_id: int):
+        for i in range(1, len(self.replicas), 2):
+            if self.replicas[i] == message_id:
+                del self.replicas[i - 1 : i + 1]
+                return
+
+    def replica_ids(self) -> List[Tuple[int, int]]:
+        """Get (channel ID, message ID) pairs"""
+        return list(zip(self.replicas[::2], self.replicas[1::2]))
+
+
+class Batch:
+    """Messages relayed together, as one message in each wormhole
+
+    Used by beams with `coalesce` set. The combined message is rendered from the
+    templates of its parts, so it can be rebuilt when one of them is edited or deleted.
+    """
+
+    __slots__ = ("messages",)
+
+    def __init__(self):
+        # replica message ID -> mirrors it is made of, in order
+        self.messages: Dict[int, List[Mirror]] = {}
+
+    def __repr__(self):
+        return f"Batch: {len(self.messages)} messages"
+
+    def add(self, message_id: int, mirrors: List[Mirror]):
+        self.messages[message_id] = mirrors
+
+    def render(self, message_id: int, channel_id: int) -> str:
+        return self.join(self.messages.get(message_id, []), channel_id)
+
+    @staticmethod
+    def join(mirrors: List[Mirror], channel_id: int) -> str:
+        """Render the combined message, one part per line"""
+        # the processed text of every part ends with a newline
+        return "\n".join(m.template.render(channel_id).rstrip("\n") for m in mirrors)
+
+    @staticmethod
+    def split(mirrors: List[Mirror], channel_id: int, limit: int = 2000) -> List[List[Mirror]]:
+        """Divide parts into combined messages of up to `limit` characters"""
+        chunks = []
+        length = 0
+        for mirror in mirrors:
+            size = len(mirror.template.render(channel_id).rstrip("\n"))
+            # parts are separated by a newline
+            if not chunks or length + 1 + size > limit:
+                chunks.append([])
+                length = -1
+            chunks[-1].append(mirror)
+            length += 1 + size
+        return chunks
+
+    def discard(self, message_id: int, mirror: Mirror) -> bool:
+        """Remove part of the combined message, return whether any parts are left"""
+        mirrors = self.messages.get(message_id, [])
+        if mirror in mirrors:
+            mirrors.remove(mirror)
+        if not mirrors:
+            self.messages.pop(message_id, None)
+            return False
+        return True
+
+
+class MirrorStore:
+    """Sent messages held in memory for editing and deletion
+
+    Mirrors can be found by the original message ID, by ID of any replica or as the
+    latest message of the author. They are dropped when their timeout runs out or,
+    least recently used first, when there are more than `limit` of them.
+    """
+
+    def __init__(self, limit: int = 1000):
+        self.limit = limit
+        # original message ID -> mirror, least recently used first
+        self.mirrors: Dict[int, Mirror] = OrderedDict()
+        # replica message ID -> original message ID
+        self.replicas: Dict[int, int] = {}
+        # author ID -> original message IDs, oldest first
+        self.authors: Dict[int, List[int]] = {}
+        # (expiration time, original message ID)
+        self.expirations: List[Tuple[float, int]] = []
+
+    def __repr__(self):
+        return f"MirrorStore: {len(self.mirrors)} mirrors, {len(self.replicas)} replicas"
+
+    def __len__(self):
+        self.expire()
+        return len(self.mirrors)
+
+    def add(self, mirror: Mirror, timeout: float):
+        self.expire()
+
+        mirror.expires = time.monotonic() + timeout
+        self.mirrors[mirror.message_id] = mirror
+        for _, replica_id in mirror.replica_ids():
+            # combined messages are found by their first part
+            self.replicas.setdefault(replica_id, mirror.message_id)
+        self.authors.setdefault(mirror.author_id, []).append(mirror.message_id)
+        heapq.heappush(self.expirations, (mirror.expires, mirror.message_id))
+
+        while len(self.mirrors) > self.limit:
+            self.remove(next(iter(self.mirrors.values())))
+        if len(self.expirations) > 2 * self.limit:
+            # forget expirations of mirrors dropped as least recently used
+            self.expirations = [(m.expires, i) for i, m in self.mirrors.items()]
+            heapq.heapify(self.expirations)
+
+    def get(self, message_id: int) -> Optional[Mirror]:
+        """Get mirror by ID of the original message"""
+        self.expire()
+        mirror = self.mirrors.get(message_id)
+        if mirror is not None:
+            self.mirrors.move_to_end(message_id)
+        return mirror
+
+    def get_by_replica(self, message_id: int) -> Optional[Mirror]:
+        self.expire()
+        return self.get(self.replicas[message_id]) if message_id in self.replicas else None
+
+    def get_latest(self, author_id: int) -> Optional[Mirror]:
+        """Get the last message of the user"""
+        mirrors = self.list_latest(author_id, 1)
+        return mirrors[0] if mirrors else None
+
+    def list_latest(
+        self, author_id: int, count: int, channel_ids: Collection[int] = None
+    ) -> List[Mirror]:
+        """Get the last messages of the user, newest first
+
+        If `channel_ids` is set, only messages sent to these channels are counted.
+        """
+        self.expire()
+        result = []
+        for message_id in reversed(self.authors.get(author_id, [])):
+            if len(result) >= count:
+                break
+            mirror = self.mirrors[message_id]
+            if channel_ids is None or mirror.channel_id in channel_ids:
+                result.append(mirror)
+        for mirror in result:
+            self.mirrors.move_to_end(mirror.message_id)
+        return result
+
+    def remove(self, mirror: Mirror):
+        if self.mirrors.pop(mirror.message_id, None) is None:
+            return
+        for _, replica_id in mirror.replica_ids():
+            if self.replicas.get(replica_id) != mirror.message_id:
+                continue
+            # hand combined message over to its next part
+            parts = mirror.batch.messages.get(replica_id, []) if mirror.batch else []
+            parts = [m for m in parts if m.message_id in self.mirrors]
+            if parts:
+                self.replicas[replica_id] = parts[0].message_id
+            else:
+                del self.replicas[replica_id]
+
+        message_ids = self.authors.get(mirror.author_id, [])
+        if mirror.message_id in message_ids:
+            message_ids.remove(mirror.message_id)
+        if not message_ids:
+            self.authors.pop(mirror.author_id, None)
+
+    def remove_replica(self, message_id: int):
+        """Forget replica that has been deleted"""
+        mirror = self.get_by_replica(message_id)
+        if mirror is None:
+            return
+        self.replicas.pop(message_id)
+        if mirror.batch is None:
+            mirror.remove_replica(message_id)
+            return
+        for part in mirror.batch.messages.pop(message_id, [mirror]):
+            part.remove_replica(message_id)
+
+    def expire(self):
+        now = time.monotonic()
+        while self.expirations and self.expirations[0][0] <= now:
+            expires, message_id = heapq.heappop(self.expirations)
+            mirror = self.mirrors.get(message_id)
+            if mirror is not None and mirror.expires == expires:
+                self.remove(mirror)
+
+
+class MirrorIndex:
+    """Replicas of sent messages stored in Redis
+
+    The index survives restarts and reloads of the bot and is shared by all its
+    processes. The key `mirror:[message ID]` holds the author ID followed by
+    (channel ID, message ID) pairs of the replicas, packed as 64-bit integers; it
+    expires with the beam timeout.
+
+    Parts of combined messages (see Batch) are not stored, the other parts would be
+    lost when one of them is edited. Neither are mirrors whose original the bot has
+    replaced: the record would not know it, and the bot's own deletion would be taken
+    for the author's.
+    """
+
+    def _key(self, message_id: int) -> str:
+        return f"mirror:{message_id}"
+
+    def _pack(self, mirror: Mirror) -> bytes:
+        return struct.pack(f"<{1 + len(mirror.replicas)}Q", mirror.author_id, *mirror.replicas)
+
+    async def save(self, mirror: Mirror, timeout: int):
+        # replaced originals can't be edited or deleted by their author
+        if not mirror.replicas or mirror.batch is not None or mirror.replaced:
+            return
+        await db_raw.set(self._key(mirror.message_id), self._pack(mirror), ex=timeout)
+
+    async def update(self, mirror: Mirror):
+        """Store the replicas that are left, keep the expiration"""
+        if mirror.batch is not None:
+            return
+        if not mirror.replicas:
+            await self.delete(mirror.message_id)
+            return
+        # an expired record is not written again
+        await db_raw.set(self._key(mirror.message_id), self._pack(mirror), xx=True, keepttl=True)
+
+    async def load(self, message_id: int) -> Optional[Mirror]:
+        data = await db_raw.get(self._key(message_id))
+        if not data:
+            return None
+        values = struct.unpack(f"<{len(data) // 8}Q", data)
+        # the original channel is not stored, it is known to the caller
+        mirror = Mirror(message_id=message_id, channel_id=0, author_id=values[0])
+        mirror.replicas.extend(values[1:])
+        return mirror
+
+    async def delete(self, message_id: int):
+        await db_raw.delete(self._key(message_id))
+
+
+# sent messages still held in memory, shared by all cogs
+sent = MirrorStore(limit=config.get("sent messages", 1000))
+# and in the database, so they can be edited after restart
+index = MirrorIndex() if config.get("persistent mirrors", False) else None
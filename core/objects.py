@@ -4,6 +4,8 @@ class Beam:
     anonymity = "none"
     replace = 1
     timeout = 60
+    coalesce = 0
+    attachments = 0
 
     def __init__(self, name: str = None):
         self.name = name
@@ -12,7 +14,8 @@ class Beam:
         return (
             f"Beam {self.name}: "
             f"active {self.active}, anonymity {self.anonymity}, "
-            f"replace {self.replace}, timeout {self.timeout}"
+            f"replace {self.replace}, timeout {self.timeout}, coalesce {self.coalesce}, "
+            f"attachments {self.attachments}"
         )
 
 
@@ -25,6 +28,7 @@ class Wormhole:
     messages = 0
     readonly = 0
     invite = ""
+    webhook = 0
 
     def __init__(self, discord_id: int = None):
         self.discord_id = discord_id
@@ -33,7 +37,7 @@ class Wormhole:
         return (
             f"Wormhole {self.discord_id}: "
             f"beam {self.beam}, admin {self.admin_id}, "
-            f"active {self.active}, readonly {self.readonly}, "
+            f"active {self.active}, readonly {self.readonly}, webhook {self.webhook}, "
             f"logo '{self.logo}', invite: {self.invite}"
         )
 
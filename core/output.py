@@ -7,6 +7,14 @@ from discord.ext import commands
 config = json.load(open("config.json"))
 
 
+def warning(message: str):
+    """Report problem of the bot's own infrastructure on the console
+
+    Used by modules without access to the log channel, or when it may be unreachable.
+    """
+    print(f"WARNING: {message}")
+
+
 class Event:
     def __init__(self, bot):
         self.bot = bot
@@ -0,0 +1,181 @@
+import asyncio
+from typing import Dict, List, Optional, Set
+
+import aiohttp
+import discord
+from discord.ext import commands
+
+from core import output
+from core.database import repo_w
+
+# name of webhooks created in wormholes with the `webhook` setting
+WEBHOOK_NAME = "Wormhole"
+
+# permissions the bot should have in every wormhole
+PERMISSIONS = (
+    "send_messages",
+    "embed_links",
+    "attach_files",
+    "manage_messages",
+    "add_reactions",
+    "use_external_emojis",
+)
+
+
+class Registry:
+    """Channels of the wormholes, shared by all cogs
+
+    Holds the text channels of every beam and the webhooks of wormholes relaying
+    through one, so messages are sent without resolving them again. All beams are
+    loaded in one pass when the bot gets ready; a beam is loaded again when its
+    wormholes change. Channels the bot can't see (deleted, or in guilds the bot is
+    not in) are left out.
+
+    Permissions of the bot in the channels are held as well, so destinations it can't
+    send to are known before any request is made. They are taken again when roles,
+    channels or the bot's member change, see `refresh()`.
+
+    The HTTP session attachments are downloaded with is shared as well; it is closed
+    when the bot shuts down, see `close()`.
+    """
+
+    def __init__(self):
+        self.bot: Optional[commands.Bot] = None
+        # beam name -> channels of its wormholes
+        self.beams: Dict[str, List[discord.TextChannel]] = {}
+        # channel ID -> webhook, for wormholes relaying through one
+        self.webhooks: Dict[int, discord.Webhook] = {}
+        # channel ID -> permissions of the bot
+        self.permissions: Dict[int, discord.Permissions] = {}
+        # channel IDs whose deleted webhook is being replaced
+        self.replacing: Set[int] = set()
+        # downloads of attachments that are uploaded again, created when needed
+        self.session: Optional[aiohttp.ClientSession] = None
+
+    def __repr__(self):
+        channels = sum(len(c) for c in self.beams.values())
+        return (
+            f"Registry: {len(self.beams)} beams, {channels} channels, "
+            f"{len(self.webhooks)} webhooks"
+        )
+
+    def bind(self, bot: commands.Bot):
+        self.bot = bot
+
+    def get_session(self) -> aiohttp.ClientSession:
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession()
+        return self.session
+
+    async def close(self):
+        """Close the download session"""
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def get(self, beam: str) -> List[discord.TextChannel]:
+        """Get channels of the beam, load them if the beam is not known yet"""
+        if beam not in self.beams:
+            await self.load(beam)
+        return self.beams.get(beam, [])
+
+    async def load(self, beam: str = None):
+        """Resolve channels of the beam, or of all beams if it is omitted"""
+        beams = {} if beam is None else {beam: []}
+        webhooks = {}
+        for wormhole in await repo_w.list_objects(beam):
+            channel = self.bot.get_channel(wormhole.discord_id)
+            if channel is None:
+                continue
+            beams.setdefault(wormhole.beam, []).append(channel)
+
+            if wormhole.webhook:
+                webhook = self.webhooks.get(channel.id) or await self._get_webhook(channel)
+                if webhook is not None:
+                    webhooks[channel.id] = webhook
+
+        if beam is None:
+            self.beams = beams
+            self.webhooks = webhooks
+            self.permissions = {}
+        else:
+            for channel in self.beams.get(beam, []) + beams[beam]:
+                self.webhooks.pop(channel.id, None)
+                self.permissions.pop(channel.id, None)
+            self.beams.update(beams)
+            self.webhooks.update(webhooks)
+        for channels in beams.values():
+            for channel in channels:
+                self._snapshot(channel)
+
+    def drop_webhook(self, webhook: discord.Webhook):
+        """Forget webhook deleted in the guild, get a new one in the background"""
+        if self.webhooks.get(webhook.channel_id) is not webhook:
+            return
+        del self.webhooks[webhook.channel_id]
+        channel = self.bot.get_channel(webhook.channel_id)
+        if channel is not None and channel.id not in self.replacing:
+            self.replacing.add(channel.id)
+            asyncio.ensure_future(self._replace_webhook(channel))
+
+    async def _replace_webhook(self, channel: discord.TextChannel):
+        try:
+            webhook = await self._get_webhook(channel)
+        finally:
+            self.replacing.discard(channel.id)
+        # the setting may have changed in the meantime
+        if webhook is not None and await repo_w.get_attribute(channel.id, "webhook"):
+            self.webhooks.setdefault(channel.id, webhook)
+
+    def get_permissions(self, channel: discord.TextChannel) -> discord.Permissions:
+        result = self.permissions.get(channel.id)
+        return result if result is not None else self._snapshot(channel)
+
+    def missing(self, channel: discord.TextChannel) -> List[str]:
+        """Get PERMISSIONS the bot doesn't have in the channel"""
+        permissions = self.get_permissions(channel)
+        return [p for p in PERMISSIONS if not getattr(permissions, p)]
+
+    def refresh(self, guild_id: int):
+        """Take permissions in the channels of the guild again"""
+        for channels in self.beams.values():
+            for channel in channels:
+                if channel.guild.id == guild_id:
+                    self._snapshot(channel)
+
+    def remove_channel(self, channel_id: int):
+        """Forget deleted channel"""
+        for beam, channels in self.beams.items():
+            self.beams[beam] = [c for c in channels if c.id != channel_id]
+        self.webhooks.pop(channel_id, None)
+        self.permissions.pop(channel_id, None)
+
+    def remove_guild(self, guild_id: int):
+        """Forget channels of a guild the bot has left"""
+        for beam, channels in self.beams.items():
+            for channel in channels:
+                if channel.guild.id == guild_id:
+                    self.permissions.pop(channel.id, None)
+            self.beams[beam] = [c for c in channels if c.guild.id != guild_id]
+        self.webhooks = {i: w for i, w in self.webhooks.items() if w.guild_id != guild_id}
+
+    def _snapshot(self, channel: discord.TextChannel) -> discord.Permissions:
+        self.permissions[channel.id] = channel.permissions_for(channel.guild.me)
+        return self.permissions[channel.id]
+
+    async def _get_webhook(self, channel: discord.TextChannel) -> Optional[discord.Webhook]:
+        """Find the bot's webhook in the channel, create it if there is none"""
+        try:
+            for webhook in await channel.webhooks():
+                if webhook.user == self.bot.user and webhook.token is not None:
+                    return webhook
+            return await channel.create_webhook(name=WEBHOOK_NAME)
+        except discord.HTTPException as e:
+            output.warning(
+                f"Could not get webhook in {channel.guild.name}/{channel.name} "
+                f"({type(e).__name__}), sending as the bot."
+            )
+            return None
+
+
+registry = Registry()
@@ -0,0 +1,282 @@
+import asyncio
+import json
+import random
+import time
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, Optional
+
+import aiohttp
+import discord
+
+from core.errors import CircuitOpen, RelayException
+
+config = json.load(open("config.json"))
+
+
+class TokenBucket:
+    """Allow `rate` requests per `period` seconds, in bursts of up to `rate`"""
+
+    def __init__(self, rate: int, period: float):
+        self.rate = rate
+        self.period = period
+        self.tokens = float(rate)
+        self.updated = time.monotonic()
+
+    def delay(self) -> float:
+        """Take a token; if there is none, return seconds until one is available"""
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate / self.period)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) * self.period / self.rate
+
+    async def acquire(self):
+        delay = self.delay()
+        while delay > 0:
+            await asyncio.sleep(delay)
+            delay = self.delay()
+
+
+class Delivery:
+    """Message waiting in a queue"""
+
+    def __init__(self, send: Callable[[], Awaitable[discord.Message]]):
+        self.send = send
+        self.queued = time.monotonic()
+        self.future = asyncio.get_event_loop().create_future()
+
+
+class Breaker:
+    """Circuit breaker of one destination
+
+    After `threshold` failures in a row the circuit opens and messages for the
+    destination fail at once, for `cooldown` seconds. Then the next message is sent
+    again: the circuit closes if it is delivered and opens again if it is not.
+    """
+
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        # start of the current run of failures, and when the circuit opened
+        self.failing_since: Optional[float] = None
+        self.opened: Optional[float] = None
+
+    def __repr__(self):
+        return f"Breaker: {self.state}, {self.failures} failures"
+
+    @property
+    def state(self) -> str:
+        if self.opened is None:
+            return "closed"
+        if time.monotonic() - self.opened < self.cooldown:
+            return "open"
+        return "half-open"
+
+    def allows(self) -> bool:
+        return self.state != "open"
+
+    def succeed(self):
+        self.failures = 0
+        self.failing_since = None
+        self.opened = None
+
+    def fail(self):
+        now = time.monotonic()
+        self.failures += 1
+        if self.failing_since is None:
+            self.failing_since = now
+        if self.failures >= self.threshold:
+            self.opened = now
+
+    def failing_for(self) -> float:
+        """Seconds since the destination stopped accepting messages"""
+        return time.monotonic() - self.failing_since if self.failing_since is not None else 0.0
+
+
+def is_transient(error: Exception) -> bool:
+    """Whether sending the message again may succeed"""
+    if isinstance(error, discord.HTTPException):
+        return error.status >= 500
+    return isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError))
+
+
+def is_destination_failure(error: Exception) -> bool:
+    """Whether the error is caused by the destination rather than by the message"""
+    return isinstance(error, (discord.Forbidden, discord.NotFound)) or is_transient(error)
+
+
+class ChannelQueue:
+    """Messages for one channel, delivered in order by a single worker"""
+
+    def __init__(self, bucket: TokenBucket):
+        self.bucket = bucket
+        self.deliveries: Deque[Delivery] = deque()
+        self.worker: Optional[asyncio.Task] = None
+
+
+class Relay:
+    """Ordered delivery of messages to wormholes
+
+    Every destination channel has its own queue, so messages arrive in the order they
+    were submitted and a slow channel does not hold the others back. Each queue sends
+    at the channel rate limit (Discord allows 5 messages per 5 seconds), the library
+    only has to sleep on a 429 if the limit is shared with something else.
+
+    When the queue is full, the newest message is refused (policy `drop`) or the oldest
+    waiting message is discarded (policy `oldest`).
+
+    Transient errors (5xx responses, connection problems) are retried up to `retries`
+    times with jittered exponential backoff. Every destination has a Breaker, so one
+    that keeps failing is skipped without a request, see `threshold` and `cooldown`.
+    """
+
+    def __init__(
+        self,
+        *,
+        rate: int = 5,
+        period: float = 5.0,
+        depth: int = 50,
+        policy="drop",
+        retries: int = 2,
+        backoff: float = 1.0,
+        threshold: int = 5,
+        cooldown: float = 60.0,
+    ):
+        if policy not in ("drop", "oldest"):
+            raise ValueError(f"Unknown relay policy: {policy}.")
+        self.rate = rate
+        self.period = period
+        self.depth = depth
+        self.policy = policy
+        self.retries = retries
+        self.backoff = backoff
+        self.threshold = threshold
+        self.cooldown = cooldown
+
+        self.queues: Dict[int, ChannelQueue] = {}
+        self.breakers: Dict[int, Breaker] = {}
+
+        # metrics
+        self.delivered = 0
+        self.dropped = 0
+        self.max_depth = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.retried = 0
+        # refused because the circuit of the destination was open
+        self.rejected = 0
+
+    def __repr__(self):
+        return (
+            f"Relay: {self.queued} queued in {len(self.queues)} channels "
+            f"(max {self.max_depth}), {self.delivered} delivered, {self.dropped} dropped, "
+            f"{self.retried} retried, {self.rejected} rejected, "
+            f"wait {self.wait_average:.2f} s on average, {self.wait_max:.2f} s max"
+        )
+
+    @property
+    def queued(self) -> int:
+        return sum(len(q.deliveries) for q in self.queues.values())
+
+    @property
+    def wait_average(self) -> float:
+        return self.wait_total / self.delivered if self.delivered else 0.0
+
+    def submit(
+        self, channel: discord.TextChannel, send: Callable[[], Awaitable[discord.Message]]
+    ) -> asyncio.Future:
+        """Queue the message
+
+        `send` is called when it is the message's turn. The returned future resolves
+        to the sent message; it fails with RelayException if the message was dropped,
+        or with CircuitOpen if the channel is failing.
+        """
+        queue = self.queues.get(channel.id)
+        if queue is None:
+            queue = self.queues[channel.id] = ChannelQueue(TokenBucket(self.rate, self.period))
+
+        delivery = Delivery(send)
+        if not self.get_breaker(channel.id).allows():
+            self._reject(delivery)
+            return delivery.future
+        if len(queue.deliveries) >= self.depth:
+            if self.policy == "drop":
+                self._drop(delivery)
+                return delivery.future
+            self._drop(queue.deliveries.popleft())
+
+        queue.deliveries.append(delivery)
+        self.max_depth = max(self.max_depth, len(queue.deliveries))
+        if queue.worker is None or queue.worker.done():
+            queue.worker = asyncio.ensure_future(self._work(queue, self.get_breaker(channel.id)))
+        return delivery.future
+
+    def get_breaker(self, channel_id: int) -> Breaker:
+        breaker = self.breakers.get(channel_id)
+        if breaker is None:
+            breaker = self.breakers[channel_id] = Breaker(self.threshold, self.cooldown)
+        return breaker
+
+    def _drop(self, delivery: Delivery):
+        self.dropped += 1
+        if not delivery.future.done():
+            delivery.future.set_exception(RelayException("Queue is full."))
+
+    def _reject(self, delivery: Delivery):
+        self.rejected += 1
+        if not delivery.future.done():
+            delivery.future.set_exception(CircuitOpen())
+
+    async def _work(self, queue: ChannelQueue, breaker: Breaker):
+        while queue.deliveries:
+            await queue.bucket.acquire()
+            delivery = queue.deliveries.popleft()
+            # the circuit may have opened while the message was waiting
+            if not breaker.allows():
+                self._reject(delivery)
+                continue
+
+            wait = time.monotonic() - delivery.queued
+            try:
+                result = await self._send(queue, breaker, delivery)
+            except Exception as e:
+                if not delivery.future.done():
+                    delivery.future.set_exception(e)
+            else:
+                self.wait_total += wait
+                self.wait_max = max(self.wait_max, wait)
+                self.delivered += 1
+                if not delivery.future.done():
+                    delivery.future.set_result(result)
+
+    async def _send(self, queue: ChannelQueue, breaker: Breaker, delivery: Delivery):
+        for attempt in range(self.retries + 1):
+            try:
+                result = await delivery.send()
+            except Exception as e:
+                if attempt < self.retries and is_transient(e):
+                    self.retried += 1
+                    await asyncio.sleep(self.backoff * 2**attempt * random.uniform(0.5, 1.5))
+                    await queue.bucket.acquire()
+                    continue
+                if is_destination_failure(e):
+                    breaker.fail()
+                raise
+            breaker.succeed()
+            return result
+
+
+# outgoing messages of all cogs, queued per channel
+relay = Relay(
+    rate=config.get("relay rate", 5),
+    period=config.get("relay period", 5),
+    depth=config.get("relay depth", 50),
+    policy=config.get("relay policy", "drop"),
+    retries=config.get("relay retries", 2),
+    backoff=config.get("relay backoff", 1),
+    threshold=config.get("relay failures", 5),
+    cooldown=config.get("relay cooldown", 60),
+)
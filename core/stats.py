@@ -0,0 +1,159 @@
+import asyncio
+import json
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+import redis
+
+from core import output
+from core.database import db, repo_w
+
+config = json.load(open("config.json"))
+
+# traffic resolution -> (bucket length, how long the buckets are kept), in seconds
+RESOLUTIONS = {
+    "minute": (60, 2 * 3600),
+    "hour": (3600, 2 * 86400),
+    "day": (86400, 30 * 86400),
+}
+
+
+class Counters:
+    """Message counters, held in memory and written to the database in batches
+
+    Counting a message costs no round trip; `flush()` writes everything counted since
+    the last flush. Wormhole counters are the `messages` attribute of the wormhole,
+    beam and user counters are stored in the `stats:beams` and `stats:users` hashes.
+
+    Traffic (messages and bytes) is also recorded in time buckets, one hash per bucket:
+    `stats:[resolution]:[bucket start]` with `[beam|wormhole|user]:[ID]:[messages|bytes]`
+    fields. The buckets expire, see RESOLUTIONS.
+    """
+
+    def __init__(self, interval: float = 60):
+        self.interval = interval
+        self.wormholes: Dict[int, int] = defaultdict(int)
+        self.beams: Dict[str, int] = defaultdict(int)
+        self.users: Dict[int, int] = defaultdict(int)
+        # (minute start, field) -> amount
+        self.traffic: Dict[Tuple[int, str], int] = defaultdict(int)
+
+    def __repr__(self):
+        return (
+            f"Counters: {len(self.wormholes)} wormholes, {len(self.beams)} beams, "
+            f"{len(self.users)} users, {len(self.traffic)} traffic fields waiting"
+        )
+
+    def count(self, *, beam: str, wormhole_id: int, user_id: int):
+        self.beams[beam] += 1
+        self.wormholes[wormhole_id] += 1
+        self.users[user_id] += 1
+
+    def record(self, size: int, *, beam: str, wormhole_id: int, user_id: Optional[int] = None):
+        """Add message of `size` bytes to the traffic of the current minute"""
+        minute = int(time.time()) // 60 * 60
+        subjects = [f"beam:{beam}", f"wormhole:{wormhole_id}"]
+        if user_id is not None:
+            subjects.append(f"user:{user_id}")
+        for subject in subjects:
+            self.traffic[(minute, f"{subject}:messages")] += 1
+            self.traffic[(minute, f"{subject}:bytes")] += size
+
+    async def history(
+        self, resolution: str, count: int, field: str = None
+    ) -> List[Tuple[int, Dict[str, int]]]:
+        """Get traffic of the last `count` buckets, oldest first
+
+        Returns (bucket start, {field: amount}) pairs; the last bucket is the current one.
+        If `field` is set, only that field is read; the buckets hold a field for every
+        beam, wormhole and user.
+        """
+        length, _ = RESOLUTIONS[resolution]
+        current = int(time.time()) // length * length
+        starts = [current - i * length for i in range(count - 1, -1, -1)]
+
+        pipe = db.pipeline(transaction=False)
+        for start in starts:
+            if field is None:
+                pipe.hgetall(f"stats:{resolution}:{start}")
+            else:
+                pipe.hget(f"stats:{resolution}:{start}", field)
+        values = await pipe.execute()
+        if field is not None:
+            values = [{field: v} if v is not None else {} for v in values]
+        result = [(s, {k: int(v) for k, v in d.items()}) for s, d in zip(starts, values)]
+
+        # include traffic that has not been written yet
+        buckets = dict(result)
+        for (minute, name), amount in self.traffic.items():
+            bucket = buckets.get(minute // length * length)
+            if bucket is not None and field in (None, name):
+                bucket[name] = bucket.get(name, 0) + amount
+        return result
+
+    async def flush(self):
+        """Write the counters"""
+        wormholes, self.wormholes = self.wormholes, defaultdict(int)
+        beams, self.beams = self.beams, defaultdict(int)
+        users, self.users = self.users, defaultdict(int)
+        traffic, self.traffic = self.traffic, defaultdict(int)
+
+        try:
+            if wormholes:
+                await repo_w.add_messages(wormholes)
+        except redis.exceptions.RedisError:
+            # keep the counts for the next time
+            self._restore(wormholes, beams, users, traffic)
+            raise
+
+        if not beams and not users and not traffic:
+            return
+        pipe = db.pipeline()
+        for beam, amount in beams.items():
+            pipe.hincrby("stats:beams", beam, amount)
+        for user_id, amount in users.items():
+            pipe.hincrby("stats:users", user_id, amount)
+        self._write_traffic(pipe, traffic)
+        try:
+            await pipe.execute()
+        except redis.exceptions.RedisError:
+            self._restore({}, beams, users, traffic)
+            raise
+
+    def _write_traffic(self, pipe, traffic: Dict[Tuple[int, str], int]):
+        buckets = defaultdict(int)
+        for (minute, field), amount in traffic.items():
+            for resolution, (length, _) in RESOLUTIONS.items():
+                buckets[(resolution, minute // length * length, field)] += amount
+
+        for (resolution, start, field), amount in buckets.items():
+            pipe.hincrby(f"stats:{resolution}:{start}", field, amount)
+        for resolution, start in {(r, s) for r, s, _ in buckets}:
+            length, keep = RESOLUTIONS[resolution]
+            pipe.expireat(f"stats:{resolution}:{start}", start + length + keep)
+
+    def _restore(self, wormholes: dict, beams: dict, users: dict, traffic: dict):
+        for pending, counts in (
+            (self.wormholes, wormholes),
+            (self.beams, beams),
+            (self.users, users),
+            (self.traffic, traffic),
+        ):
+            for key, amount in counts.items():
+                pending[key] += amount
+
+    async def run(self):
+        """Flush the counters periodically, and once more when cancelled"""
+        try:
+            while True:
+                await asyncio.sleep(self.interval)
+                try:
+                    await self.flush()
+                except redis.exceptions.RedisError as e:
+                    output.warning(f"Could not save message counters ({e}).")
+        finally:
+            await self.flush()
+
+
+counters = Counters(interval=config.get("stats interval", 60))
@@ -0,0 +1,65 @@
+import re
+from typing import Dict, List, Optional, Tuple
+
+from core import objects
+
+# ((nickname)) tags, see Wormhole._process()
+NICKNAME = re.compile(r"\(\(([^\(\)]*)\)\)")
+
+
+class Template:
+    """Message text prepared for all wormholes of a beam
+
+    The text is split on ((nickname)) tags of users registered in the beam. In user's
+    home wormhole the tag is a ping, everywhere else it is a bold nickname. Wormholes
+    that are not home of any tagged user share one variant, so each variant is only
+    rendered once.
+
+    Templates are held with sent messages until they expire, see MirrorStore, so text
+    without tags is not copied into variants and the instances have no __dict__.
+    """
+
+    __slots__ = ("text", "segments", "slots", "homes", "variants")
+
+    def __init__(self, text: str, beam: str, users: List[objects.User]):
+        self.text = text
+
+        known = {u.nickname: u for u in users if beam in u.home_ids}
+        # static text around the tags
+        self.segments: List[str] = []
+        # (home wormhole ID, ping, bold nickname) between each two segments
+        self.slots: List[tuple] = []
+
+        position = 0
+        for match in NICKNAME.finditer(text):
+            user = known.get(match[1])
+            if user is None:
+                continue
+            self.segments.append(text[position : match.start()])
+            self.slots.append(
+                (user.home_ids[beam], f"<@!{user.discord_id}>", f"**__{user.nickname}__**")
+            )
+            position = match.end()
+        self.segments.append(text[position:])
+
+        self.homes: Tuple[int, ...] = tuple({slot[0] for slot in self.slots})
+        self.variants: Dict[Optional[int], str] = {}
+
+    def __repr__(self):
+        return f"Template: {len(self.slots)} slots, {len(self.variants)} variants rendered"
+
+    @staticmethod
+    def nicknames(text: str) -> List[str]:
+        return list(set(NICKNAME.findall(text)))
+
+    def render(self, wormhole_id: int) -> str:
+        if not self.slots:
+            return self.text
+        key = wormhole_id if wormhole_id in self.homes else None
+        if key not in self.variants:
+            parts = [self.segments[0]]
+            for (home_id, ping, nickname), segment in zip(self.slots, self.segments[1:]):
+                parts.append(ping if home_id == key else nickname)
+                parts.append(segment)
+            self.variants[key] = "".join(parts)
+        return self.variants[key]
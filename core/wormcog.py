@@ -2,18 +2,32 @@ import asyncio
 import datetime
 import json
 import re
-from typing import List, Union
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple, Union
 
 import discord
 from discord.ext import commands
 
-from core import output, objects
-from core.database import repo_b, repo_u, repo_w
+from core import objects, output
+from core.database import admit, repo_b, repo_u, repo_w
+from core.errors import CircuitOpen, RelayException, WebhookMissing
+from core.files import SharedFile
+from core.mirror import Batch, Mirror, index, sent
+from core.registry import registry
+from core.relay import relay
+from core.template import Template
 
-# TODO When the message is removed, remove it from sent[], too
+config = json.load(open("config.json"))
 
+EMOJIS = re.compile(r"<a?:(?P<name>[a-zA-Z0-9_]+):(?P<emoji>[0-9]+)>")
 
-config = json.load(open("config.json"))
+# messages waiting to be relayed together, per beam:
+# (original, mirror, wormhole ID it is not sent to, whether the original is deleted)
+pending: Dict[str, List[tuple]] = {}
+
+# edits running at the same time, in total and in one channel
+edit_limit = asyncio.Semaphore(config.get("concurrent edits", 8))
+channel_locks = defaultdict(asyncio.Lock)
 
 
 async def presence(bot: commands.Bot):
@@ -26,12 +40,6 @@ class Wormcog(commands.Cog):
         super().__init__()
         self.bot = bot
 
-        # active text channels acting as wormholes
-        self.wormholes = {}
-
-        # sent messages still held in memory
-        self.sent = []
-
         # bot management logging
         self.event = output.Event(self.bot)
 
@@ -39,26 +47,16 @@ class Wormcog(commands.Cog):
     ## FUNCTIONS
     ##
 
-    def reconnect(self, beam: str = None):
-        if beam is None:
-            self.wormholes = {}
-        else:
-            self.wormholes[beam] = []
-
-        wormholes = repo_w.list_objects(beam)
-        for wormhole in wormholes:
-            self.wormholes[beam].append(self.bot.get_channel(wormhole.discord_id))
-
     def delay(self, key: str = "user"):
         if key == "user":
             return 20
         if key == "admin":
             return 10
 
-    def get_free_nickname(self, nickname: str) -> str:
+    async def get_free_nickname(self, nickname: str) -> str:
         i = 0
         orig_name = nickname
-        while repo_u.is_nickname_used(nickname):
+        while await repo_u.is_nickname_used(nickname):
             nickname = f"{orig_name}{i}"
             i += 1
         return nickname
@@ -67,7 +65,7 @@ class Wormcog(commands.Cog):
         if content is None and embed is None:
             return
 
-        if hasattr(ctx.channel, "id") and repo_w.get(ctx.channel.id) is not None:
+        if hasattr(ctx.channel, "id") and await repo_w.get(ctx.channel.id) is not None:
             await ctx.send(content=content, embed=embed, delete_after=self.delay())
         else:
             await ctx.send(content=content, embed=embed)
@@ -78,28 +76,46 @@ class Wormcog(commands.Cog):
         message: discord.Message,
         text: str,
         files: list = None,
+        body: str = None,
+        db_w: objects.Wormhole = None,
+        db_b: objects.Beam = None,
     ):
-        """Distribute the message"""
+        """Distribute the message
+
+        Wormholes with a webhook get the `body` without prefixes, sent under the
+        name and avatar of the author, see `_get_identity()`.
+
+        `db_w` and `db_b` are the wormhole and beam of an admitted message, see
+        `database.admit()`; if they are omitted, the message is admitted here.
+        """
         deleted_original = False
 
         # get variables
-        messages = [message]
-        db_w = repo_w.get(message.channel.id)
-        db_b = repo_b.get(db_w.beam)
-
+        mirror = Mirror(
+            message_id=message.id, channel_id=message.channel.id, author_id=message.author.id
+        )
         # access control
-        if db_b.active == 0:
-            return
-        if db_w.active == 0 or db_w.readonly == 1:
-            return
-        if repo_u.get_attribute(message.author.id, "readonly") == 1:
-            return
-
-        # remove the original, if possible
-        manage_messages_perm = message.guild.me.permissions_in(message.channel).manage_messages
-        if manage_messages_perm and db_b.replace == 1 and not files:
+        if db_w is None or db_b is None:
+            db_w, db_b, admitted = await admit(message.channel.id, message.author.id)
+            if not admitted:
+                return
+
+        wormholes = await registry.get(db_b.name)
+
+        # upload attachments again, or link them
+        files = files or []
+        text, body, uploads = await self._attach(db_b, files, text, body)
+        # linked attachments would disappear with the original
+        linked = bool(files) and not uploads
+
+        # remove the original, if possible; with a webhook it looks the same as the copies
+        manage_messages_perm = (
+            registry.get_permissions(message.channel).manage_messages
+            and message.channel.id not in registry.webhooks
+        )
+        if manage_messages_perm and db_b.replace == 1 and not linked:
             try:
-                messages[0] = message.author
+                mirror.replaced = True
                 await self.delete(message)
                 deleted_original = True
             except discord.Forbidden:
@@ -111,12 +127,20 @@ class Wormcog(commands.Cog):
         # if someone intentionally sends a message that will be expanded over 2k characters,
         # it will be rejected by the API
 
-        # update wormhole list
-        if db_b.name not in self.wormholes.keys():
-            self.reconnect(db_b.name)
-        wormholes = self.wormholes[db_b.name]
-
-        users = self._get_users_from_tags(beam_name=db_b.name, text=text)
+        template = await self._get_template(beam_name=db_b.name, text=text)
+        mirror.template = template
+        identity = None
+        if body is not None:
+            mirror.plain = await self._get_plain(db_b.name, wormholes, body[:1900])
+            if mirror.plain is not None:
+                identity = await self._get_identity(message, db_b)
+
+        if db_b.coalesce > 0:
+            if not files:
+                skip_id = 0 if manage_messages_perm else message.channel.id
+                return await self._coalesce(db_b, (message, mirror, skip_id, deleted_original))
+            # keep the order, relay the waiting messages first
+            await self.flush(db_b.name)
 
         # replicate messages
         tasks = []
@@ -125,47 +149,48 @@ class Wormcog(commands.Cog):
                 self.replicate(
                     wormhole,
                     message,
-                    messages,
-                    users,
-                    text,
+                    mirror,
+                    template,
                     files,
-                    db_b,
                     manage_messages_perm,
+                    identity,
+                    uploads,
                 )
             )
             tasks.append(task)
-        await asyncio.gather(*tasks, return_exceptions=True)
+        try:
+            await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            for upload in uploads:
+                upload.close()
 
         # add checkmark to original, if it hasn't been deleted
         if not deleted_original:
-            try:
-                await message.add_reaction("✅")
-            except discord.Forbidden:
-                await message.channel.send(f"_Successfully distributed_ ✅")
+            await self._confirm(message)
 
         # save message objects in case of editing/deletion
         if db_b.timeout > 0:
-            self.sent.append(messages)
-            await asyncio.sleep(db_b.timeout)
-            self.sent.remove(messages)
+            sent.add(mirror, timeout=db_b.timeout)
+            if index is not None:
+                await index.save(mirror, timeout=db_b.timeout)
 
     async def replicate(
         self,
         wormhole,
         message,
-        messages,
-        users,
-        text,
+        mirror,
+        template,
         files,
-        db_b,
         manage_messages_perm,
+        identity=None,
+        uploads=(),
     ):
         # skip not active wormholes
-        if repo_w.get_attribute(wormhole.id, "active") == 0:
+        if await repo_w.get_attribute(wormhole.id, "active") == 0:
             return
 
-        # skip source if message has attachments
-        if wormhole.id == message.channel.id and len(files) > 0:
+        # skip source if message has attachments that are not uploaded again
+        if wormhole.id == message.channel.id and len(files) > 0 and not uploads:
             return
 
         # skip source if bot hasn't got manage_messages permission
@@ -173,45 +198,409 @@ class Wormcog(commands.Cog):
             return
 
         # send message
-        try:
-            m = await wormhole.send(
-                self._process_tags(
-                    beam_name=db_b.name, wormhole_id=wormhole.id, users=users, text=text
+        webhook = registry.webhooks.get(wormhole.id)
+        if webhook is not None and mirror.plain is not None:
+            text = mirror.plain.render(wormhole.id)
+            try:
+                m = await self._relay(
+                    wormhole, message, text, files=uploads, webhook=webhook, identity=identity
                 )
+            except WebhookMissing:
+                # send as the bot until the webhook is created again
+                webhook = None
+        if webhook is None or mirror.plain is None:
+            m = await self._relay(wormhole, message, template.render(wormhole.id), files=uploads)
+        if m is not None:
+            mirror.add_replica(wormhole.id, m.id)
+
+    async def _coalesce(self, beam: objects.Beam, part: tuple):
+        """Hold the message until the beam's coalesce interval runs out"""
+        parts = pending.setdefault(beam.name, [])
+        parts.append(part)
+        if len(parts) > 1:
+            return
+        await asyncio.sleep(beam.coalesce)
+        await self.flush(beam.name)
+
+    async def flush(self, beam_name: str):
+        """Relay messages waiting to be combined"""
+        parts = pending.pop(beam_name, [])
+        if not parts:
+            return
+
+        batch = Batch()
+        for _, mirror, _, _ in parts:
+            mirror.batch = batch
+        await asyncio.gather(
+            *[self._replicate_batch(w, parts, batch) for w in await registry.get(beam_name)],
+            return_exceptions=True,
+        )
+
+        for message, _, _, deleted_original in parts:
+            if not deleted_original:
+                await self._confirm(message)
+
+        # combined messages are only held in memory, see MirrorIndex
+        timeout = await repo_b.get_attribute(beam_name, "timeout")
+        if timeout:
+            for _, mirror, _, _ in parts:
+                sent.add(mirror, timeout=timeout)
+
+    async def _replicate_batch(self, wormhole, parts: List[tuple], batch: Batch):
+        # skip not active wormholes
+        if await repo_w.get_attribute(wormhole.id, "active") == 0:
+            return
+
+        originals = {
+            m.message_id: message for message, m, skip_id, _ in parts if wormhole.id != skip_id
+        }
+        mirrors = [m for _, m, skip_id, _ in parts if wormhole.id != skip_id]
+
+        # split into messages of up to 2000 characters
+        for chunk in Batch.split(mirrors, wormhole.id):
+            m = await self._relay(
+                wormhole, originals[chunk[0].message_id], Batch.join(chunk, wormhole.id)
             )
-            messages.append(m)
+            if m is None:
+                continue
+            batch.add(m.id, chunk)
+            for mirror in chunk:
+                mirror.add_replica(m.channel.id, m.id)
+
+    async def _relay(
+        self,
+        wormhole: discord.TextChannel,
+        message: discord.Message,
+        text: str,
+        *,
+        files: List[SharedFile] = (),
+        webhook: discord.Webhook = None,
+        identity: Tuple[str, Optional[str]] = None,
+    ) -> Optional[discord.Message]:
+        """Send text to the wormhole, log failures
+
+        Webhooks are queued on their own, they don't share the bot's rate limit. Files are
+        opened when the message is sent, so waiting messages don't hold them. Raises
+        WebhookMissing if the webhook has been deleted.
+        """
+        if webhook is None:
+            permissions = registry.get_permissions(wormhole)
+            if not permissions.send_messages:
+                return None
+            text, files = self._degrade(wormhole, permissions, text, files)
+        try:
+            if webhook is None:
+                return await relay.submit(
+                    wormhole,
+                    lambda: wormhole.send(text, files=[f.file() for f in files] or None),
+                )
+            username, avatar_url = identity
+
+            async def send():
+                try:
+                    return await webhook.send(
+                        text,
+                        wait=True,
+                        username=username,
+                        avatar_url=avatar_url,
+                        files=[f.file() for f in files] or None,
+                    )
+                except discord.NotFound:
+                    # not a failure of the channel, it must not open the circuit
+                    raise WebhookMissing()
+
+            return await relay.submit(webhook, send)
+        except CircuitOpen:
+            # the failures have been logged before the circuit opened
+            return None
+        except WebhookMissing:
+            # deleted in the guild, the caller sends the message as the bot
+            registry.drop_webhook(webhook)
+            raise
+        except RelayException:
+            # dropped from a full queue, counted by the relay; logging every drop
+            # would flood the log channel when it is overloaded
+            return None
         except discord.Forbidden:
             await self.event.user(
                 message,
                 (
-                    f"Forbidden to send message to {self.sanitise(message.guild.name)}"
-                    f"/{self.sanitise(message.channel.name)}."
+                    f"Forbidden to send message to {self.sanitise(wormhole.guild.name)}"
+                    f"/{self.sanitise(wormhole.name)}."
                 ),
             )
         except Exception as e:
             await self.event.user(
                 message,
                 (
-                    f"Could not send message to {self.sanitise(message.guild.name)}"
-                    f"/{self.sanitise(message.channel.name)}:\n"
+                    f"Could not send message to {self.sanitise(wormhole.guild.name)}"
+                    f"/{self.sanitise(wormhole.name)}:\n"
                     f">>>{type(e).__name__}\n{str(e)}"
                 ),
             )
+        await self._check_dead(wormhole, webhook or wormhole)
+
+    async def _check_dead(self, wormhole: discord.TextChannel, destination):
+        """Deactivate the wormhole if it hasn't accepted a message for a long time"""
+        breaker = relay.breakers.get(destination.id)
+        if breaker is None or breaker.failing_for() < config.get("relay deactivate", 86400):
+            return
+        # other messages to the wormhole may still be failing, report it only once
+        del relay.breakers[destination.id]
+        await repo_w.set(discord_id=wormhole.id, key="active", value=0)
+        await self.event.get_channel().send(
+            f"Wormhole **{self.sanitise(wormhole.guild.name)}/{self.sanitise(wormhole.name)}**"
+            f" ({wormhole.id}) deactivated: no message delivered for "
+            f"{breaker.failing_for() / 3600:.1f} hours, {breaker.failures} failures."
+        )
+
+    def _degrade(
+        self,
+        wormhole: discord.TextChannel,
+        permissions: discord.Permissions,
+        text: str,
+        files: List[SharedFile],
+    ) -> Tuple[str, List[SharedFile]]:
+        """Leave out what the bot is not allowed to send to the wormhole"""
+        if files and not permissions.attach_files:
+            text += "\n" + "\n".join(f"_{self.sanitise(f.filename)}_" for f in files)
+            files = ()
+        if not permissions.use_external_emojis:
+            local = {e.id for e in wormhole.guild.emojis}
+            text = EMOJIS.sub(
+                lambda m: m[0] if int(m["emoji"]) in local else f":{m['name']}:", text
+            )
+        return text, files
+
+    async def _confirm(self, message: discord.Message):
+        permissions = registry.get_permissions(message.channel)
+        try:
+            if permissions.add_reactions:
+                return await message.add_reaction("✅")
+        except discord.Forbidden:
+            pass
+        if permissions.send_messages:
+            await message.channel.send(f"_Successfully distributed_ ✅")
+
+    async def get_mirror(self, message_id: int) -> Optional[Mirror]:
+        """Get sent message, from the database if it is not held in memory"""
+        mirror = sent.get(message_id)
+        if mirror is not None or index is None:
+            return mirror
+
+        return await index.load(message_id)
+
+    def get_replicas(
+        self, mirror: Mirror, *, original: bool = False
+    ) -> List[discord.PartialMessage]:
+        """Get message objects of the replicas, and of the original if it still exists"""
+        ids = mirror.replica_ids()
+        if original and not mirror.replaced:
+            ids.insert(0, (mirror.channel_id, mirror.message_id))
+
+        result = []
+        for channel_id, message_id in ids:
+            channel = self.bot.get_channel(channel_id)
+            if channel is not None:
+                result.append(channel.get_partial_message(message_id))
+        return result
+
+    async def edit_mirror(
+        self,
+        source: Union[commands.Context, discord.Message],
+        mirror: Mirror,
+        template: Template,
+        plain: Template = None,
+    ) -> List[discord.PartialMessage]:
+        """Edit replicas concurrently, return the ones that could not be edited
+
+        Replicas that no longer exist are forgotten. Failures are logged in one entry.
+        """
+        replicas = self.get_replicas(mirror)
+        # mirrors loaded from the database don't know the previous text
+        previous = {}
+        if mirror.template is not None:
+            previous = {m.id: self._render(mirror, m) for m in replicas}
+        # copies sent by the bot stay that way
+        if mirror.template is None or mirror.plain is not None:
+            mirror.plain = plain
+        mirror.template = template
+
+        messages = [m for m in replicas if previous.get(m.id) != self._render(mirror, m)]
+        results = await asyncio.gather(
+            *[
+                self._edit_replica(m, self._render(mirror, m), self._webhook(mirror, m))
+                for m in messages
+            ],
+            return_exceptions=True,
+        )
 
-    def _get_users_from_tags(self, beam_name: str, text: str) -> List[objects.User]:
-        tags = [repo_u.get_by_nickname(tag) for tag in re.findall(r"\(\(([^\(\)]*)\)\)", text)]
-        users = [user for user in tags if user is not None and beam_name in user.home_ids.keys()]
-        return users
-
-    def _process_tags(
-        self, beam_name: str, wormhole_id: int, users: List[objects.User], text: str
-    ) -> str:
-        for user in users:
-            if wormhole_id == user.home_ids[beam_name]:
-                text = text.replace(f"(({user.nickname}))", f"<@!{user.discord_id}>")
+        failed = []
+        for message, result in zip(messages, results):
+            if result is None:
+                continue
+            if isinstance(result, discord.NotFound):
+                sent.remove_replica(message.id)
+                mirror.remove_replica(message.id)
+            failed.append((message, result))
+        if index is not None and any(isinstance(e, discord.NotFound) for _, e in failed):
+            await index.update(mirror)
+
+        if failed:
+            await self.event.user(
+                source,
+                "Could not edit message in:\n>>> "
+                + "\n".join(
+                    f"{self.sanitise(m.guild.name)}/{self.sanitise(m.channel.name)}: "
+                    f"{type(e).__name__}"
+                    for m, e in failed
+                ),
+            )
+        return [m for m, _ in failed]
+
+    def _webhook(
+        self, mirror: Mirror, message: discord.PartialMessage
+    ) -> Optional[discord.Webhook]:
+        """Get webhook the replica was sent with"""
+        if mirror.batch is not None or mirror.plain is None:
+            return None
+        return registry.webhooks.get(message.channel.id)
+
+    def _render(self, mirror: Mirror, message: discord.PartialMessage) -> str:
+        """Get text of the replica, including other parts of a combined message"""
+        if mirror.batch is not None:
+            return mirror.batch.render(message.id, message.channel.id)
+        if self._webhook(mirror, message) is not None:
+            return mirror.plain.render(message.channel.id)
+        return mirror.template.render(message.channel.id)
+
+    async def _edit_replica(
+        self, message: discord.PartialMessage, text: str, webhook: discord.Webhook = None
+    ):
+        # edits in one channel share a rate limit, don't take a slot while waiting for it
+        async with channel_locks[message.channel.id]:
+            async with edit_limit:
+                if webhook is not None:
+                    await webhook.edit_message(message.id, content=text)
+                else:
+                    await message.edit(content=text)
+
+    async def delete_mirrors(self, mirrors: List[Mirror], *, original: bool = False):
+        """Delete replicas, in bulk where possible
+
+        Combined messages are only deleted when all their parts are, otherwise they are
+        edited to contain the rest.
+        """
+        channels = defaultdict(list)
+        combined = {}
+        for mirror in mirrors:
+            for message in self.get_replicas(mirror, original=original):
+                if mirror.batch is not None and message.id in mirror.batch.messages:
+                    mirror.batch.discard(message.id, mirror)
+                    combined[message.id] = (message, mirror.batch)
+                else:
+                    channels[message.channel].append(message)
+
+        edits = []
+        for message, batch in combined.values():
+            if message.id in batch.messages:
+                edits.append(
+                    self._edit_replica(message, batch.render(message.id, message.channel.id))
+                )
             else:
-                text = text.replace(f"(({user.nickname}))", f"**__{user.nickname}__**")
-        return text
+                channels[message.channel].append(message)
+
+        await asyncio.gather(
+            *[self._delete_messages(c, m) for c, m in channels.items()],
+            *edits,
+            return_exceptions=True,
+        )
+
+    async def _delete_messages(self, channel: discord.TextChannel, messages: list):
+        # bulk deletion requires manage_messages and only works for messages younger than
+        # 14 days, other messages have to be deleted one by one
+        bulk, single = [], messages
+        if channel.permissions_for(channel.guild.me).manage_messages:
+            limit = datetime.datetime.utcnow() - datetime.timedelta(days=13, hours=23)
+            bulk = [m for m in messages if m.created_at > limit]
+            single = [m for m in messages if m.created_at <= limit]
+
+        for i in range(0, len(bulk), 100):
+            try:
+                await channel.delete_messages(bulk[i : i + 100])
+            except discord.HTTPException:
+                single += bulk[i : i + 100]
+        webhook = registry.webhooks.get(channel.id)
+        for message in single:
+            if webhook is not None:
+                # without manage_messages, messages sent by the webhook can only be
+                # deleted through it
+                try:
+                    await webhook.delete_message(message.id)
+                    continue
+                except discord.HTTPException:
+                    pass
+            await self.delete(message)
+
+    async def forget_mirror(self, mirror: Mirror):
+        sent.remove(mirror)
+        if index is not None:
+            await index.delete(mirror.message_id)
+
+    async def _attach(
+        self, beam: objects.Beam, files: list, text: str, body: Optional[str]
+    ) -> Tuple[str, Optional[str], List[SharedFile]]:
+        """Download attachments to upload them again, or add links to them to the text"""
+        if not files:
+            return text, body, []
+
+        if beam.attachments > 0:
+            uploads = await self._download(files, limit=beam.attachments * 1024)
+            if uploads:
+                return text, body, uploads
+
+        # don't add newline if message has only attachments
+        links = " " + "\n".join(f.url for f in files)
+        return text + links, (body + links if body is not None else None), []
+
+    async def _download(self, files: list, limit: int) -> List[SharedFile]:
+        """Download all attachments, or none if any of them can't be"""
+        memory = config.get("attachment memory", 1048576)
+        results = await asyncio.gather(
+            *[
+                SharedFile.download(registry.get_session(), f, limit=limit, memory=memory)
+                for f in files
+            ],
+            return_exceptions=True,
+        )
+        uploads = [r for r in results if isinstance(r, SharedFile)]
+        if len(uploads) < len(files):
+            for upload in uploads:
+                upload.close()
+            return []
+        return uploads
+
+    async def _get_plain(self, beam_name: str, wormholes: list, body: str) -> Optional[Template]:
+        """Get template of the text without prefixes, if any wormhole has a webhook"""
+        if not any(w.id in registry.webhooks for w in wormholes):
+            return None
+        return await self._get_template(beam_name=beam_name, text=body)
+
+    async def _get_identity(
+        self, message: discord.Message, db_b: objects.Beam
+    ) -> Tuple[str, Optional[str]]:
+        """Get webhook username and avatar URL of the author"""
+        if db_b.anonymity == "none":
+            db_u = await repo_u.get(message.author.id)
+            name = db_u.nickname if db_u is not None else message.author.name
+            return f"{name} ({message.guild.name})"[:80], str(message.author.avatar_url)
+        if db_b.anonymity == "guild":
+            return message.guild.name[:80], str(message.guild.icon_url) or None
+        return db_b.name, None
+
+    async def _get_template(self, beam_name: str, text: str) -> Template:
+        users = await repo_u.get_many_by_nickname(Template.nicknames(text))
+        return Template(text, beam_name, users)
 
     async def announce(self, *, beam: str, message: str):
         """Send information to all channels"""
@@ -220,8 +609,14 @@ class Wormcog(commands.Cog):
         else:
             embed = self.get_embed(description=message)
 
-        for db_w in repo_w.list_objects(beam=beam):
-            await self.bot.get_channel(db_w.discord_id).send(embed=embed)
+        for channel in await registry.get(beam):
+            permissions = registry.get_permissions(channel)
+            if not permissions.send_messages:
+                continue
+            if permissions.embed_links:
+                await channel.send(embed=embed)
+            else:
+                await channel.send(f"**{message}**")
 
     async def feedback(self, ctx, *, private: bool = True, message: str):
         target = ctx.author if private else ctx
@@ -6,7 +6,8 @@ from datetime import datetime
 import discord
 from discord.ext import commands
 
-from core import wormcog, output, checks
+from core import wormcog, output, checks, database, stats
+from core.registry import registry
 
 config = json.load(open("config.json"))
 git_repo = git.Repo(search_parent_directories=True)
@@ -110,6 +111,10 @@ async def unload(ctx: commands.Context, cog: str):
 ##
 ## INIT
 ##
+registry.bind(bot)
+bot.loop.create_task(database.listen())
+bot.loop.create_task(stats.counters.run())
+
 bot.load_extension("cogs.errors")
 for c in ["wormhole", "admin", "user", "notifications", "info"]:
     bot.load_extension(f"cogs.{c}")
@@ -0,0 +1,17 @@
+import os
+import shutil
+import tempfile
+
+# core modules read config.json from the working directory on import
+_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_directory = tempfile.mkdtemp()
+shutil.copy(os.path.join(_root, "config.default.json"), os.path.join(_directory, "config.json"))
+_cwd = os.getcwd()
+os.chdir(_directory)
+try:
+    import core.database  # noqa: F401
+    import core.mirror  # noqa: F401
+    import core.relay  # noqa: F401
+finally:
+    os.chdir(_cwd)
+    shutil.rmtree(_directory)
@@ -0,0 +1,40 @@
+import unittest
+
+from core.mirror import Batch, Mirror
+from core.template import Template
+
+
+def mirror(message_id: int, text: str) -> Mirror:
+    # texts are processed line by line, every line ends with a newline
+    template = Template(text + "\n", "main", [])
+    return Mirror(message_id=message_id, channel_id=1, author_id=1, template=template)
+
+
+class TestBatch(unittest.TestCase):
+    def test_join(self):
+        mirrors = [mirror(1, "**a**: one"), mirror(2, "**a**: two\n**a**: three")]
+        self.assertEqual(Batch.join(mirrors, 2), "**a**: one\n**a**: two\n**a**: three")
+
+    def test_render(self):
+        mirrors = [mirror(1, "**a**: one"), mirror(2, "**b**: two")]
+        batch = Batch()
+        batch.add(10, mirrors)
+        self.assertEqual(batch.render(10, 2), "**a**: one\n**b**: two")
+        batch.discard(10, mirrors[0])
+        self.assertEqual(batch.render(10, 2), "**b**: two")
+
+    def test_split_limit(self):
+        # 999 + newline + 1000 characters fit exactly
+        mirrors = [mirror(1, "a" * 999), mirror(2, "b" * 1000), mirror(3, "c")]
+        chunks = Batch.split(mirrors, 2)
+        self.assertEqual([[m.message_id for m in c] for c in chunks], [[1, 2], [3]])
+        self.assertEqual(len(Batch.join(chunks[0], 2)), 2000)
+
+    def test_split_over_limit(self):
+        mirrors = [mirror(1, "a" * 1000), mirror(2, "b" * 1000)]
+        chunks = Batch.split(mirrors, 2)
+        self.assertEqual([[m.message_id for m in c] for c in chunks], [[1], [2]])
+
+
+if __name__ == "__main__":
+    unittest.main()
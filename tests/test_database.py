@@ -0,0 +1,156 @@
+import asyncio
+import unittest
+
+import fakeredis
+import fakeredis.aioredis
+
+from core import database
+from core.database import repo_b, repo_u, repo_w
+from core.errors import DatabaseException
+
+
+class DatabaseTestCase(unittest.TestCase):
+    """Repositories on an empty in-process database"""
+
+    def run_async(self, function):
+        async def main():
+            server = fakeredis.FakeServer()
+            database.db = fakeredis.aioredis.FakeRedis(server=server, decode_responses=True)
+            for repository in (repo_b, repo_w, repo_u):
+                repository.cache.invalidate()
+                for members in repository.members.values():
+                    members.invalidate()
+            await repo_b.add(name="a", admin_id=1)
+            await repo_b.add(name="b", admin_id=1)
+            await repo_w.add(beam="a", discord_id=10)
+            await repo_w.add(beam="a", discord_id=11)
+            return await function()
+
+        return asyncio.run(main())
+
+
+class TestIndexes(DatabaseTestCase):
+    def test_wormholes(self):
+        async def main():
+            await repo_w.add(beam="b", discord_id=12)
+            self.assertEqual(sorted(await repo_w.list_ids()), [10, 11, 12])
+            self.assertEqual(sorted(await repo_w.list_ids(beam="a")), [10, 11])
+
+            await repo_w.set(11, "beam", "b")
+            self.assertEqual(await repo_w.list_ids(beam="a"), [10])
+            self.assertEqual(sorted(await repo_w.list_ids(beam="b")), [11, 12])
+
+            await repo_w.delete(12)
+            self.assertEqual(sorted(await repo_w.list_ids()), [10, 11])
+            self.assertEqual(await repo_w.list_ids(beam="b"), [11])
+            self.assertEqual(await database.reindex(repair=False), [])
+
+        self.run_async(main)
+
+    def test_users(self):
+        async def main():
+            await repo_u.add(discord_id=1, nickname="one")
+            await repo_u.add(discord_id=2, nickname="two")
+            await repo_u.set(1, "home_id:a", 10)
+            await repo_u.set(2, "home_id:a", 11)
+            await repo_u.set(2, "readonly", 1)
+
+            self.assertEqual(sorted(await repo_u.list_ids()), [1, 2])
+            self.assertEqual(sorted(await repo_u.list_ids_by_beam("a")), [1, 2])
+            self.assertEqual(await repo_u.list_ids_by_wormhole(10), [1])
+            self.assertEqual(await repo_u.list_ids_by_attribute("readonly"), [2])
+            self.assertTrue(await repo_u.is_readonly(2))
+
+            await repo_u.set(2, "readonly", 0)
+            self.assertEqual(await repo_u.list_ids_by_attribute("readonly"), [])
+
+            # homes in a deleted wormhole are reset
+            await repo_w.delete(10)
+            self.assertEqual(await repo_u.get_home(1), {})
+            self.assertEqual(await repo_u.list_ids_by_beam("a"), [2])
+
+            await repo_u.delete(2)
+            self.assertEqual(await repo_u.list_ids(), [1])
+            self.assertEqual(await repo_u.list_ids_by_beam("a"), [])
+            self.assertEqual(await database.reindex(repair=False), [])
+
+        self.run_async(main)
+
+    def test_reindex(self):
+        async def main():
+            await database.db.srem("index:wormholes", 11)
+            self.assertNotEqual(await database.reindex(repair=True), [])
+            self.assertEqual(await database.reindex(repair=False), [])
+            self.assertEqual(sorted(await repo_w.list_ids()), [10, 11])
+
+        self.run_async(main)
+
+
+class TestNicknames(DatabaseTestCase):
+    def test_unique(self):
+        async def main():
+            await repo_u.add(discord_id=1, nickname="one")
+            with self.assertRaises(DatabaseException):
+                await repo_u.add(discord_id=2, nickname="one")
+            self.assertFalse(await repo_u.exists(2))
+
+            await repo_u.add(discord_id=2, nickname="two")
+            with self.assertRaises(DatabaseException):
+                await repo_u.set(2, "nickname", "one")
+            self.assertEqual((await repo_u.get(2)).nickname, "two")
+
+        self.run_async(main)
+
+    def test_rename(self):
+        async def main():
+            await repo_u.add(discord_id=1, nickname="one")
+            await repo_u.set(1, "nickname", "first")
+            self.assertFalse(await repo_u.is_nickname_used("one"))
+            self.assertEqual((await repo_u.get_by_nickname("first")).discord_id, 1)
+            self.assertIsNone(await repo_u.get_by_nickname("one"))
+
+            # the old nickname is free again
+            await repo_u.add(discord_id=2, nickname="one")
+            await repo_u.delete(1)
+            self.assertFalse(await repo_u.is_nickname_used("first"))
+
+        self.run_async(main)
+
+
+class TestCache(DatabaseTestCase):
+    def notify(self, key: str):
+        database._on_keyspace_event({"channel": f"__keyspace@0__:{key}", "data": "hset"})
+
+    def test_own_writes(self):
+        async def main():
+            self.notify("wormhole:10")
+            self.notify("wormhole:11")
+            await repo_w.get(10)
+            await repo_w.set(10, "logo", "x")
+
+            # the notification of the write keeps the entry
+            self.notify("wormhole:10")
+            self.assertEqual(repo_w.cache.data["wormhole:10"]["logo"], "x")
+
+            # a change made by another process drops it
+            self.notify("wormhole:10")
+            self.assertNotIn("wormhole:10", repo_w.cache.data)
+            self.assertEqual((await repo_w.get(10)).logo, "x")
+
+        self.run_async(main)
+
+    def test_unregistered_user(self):
+        async def main():
+            await repo_u.add(discord_id=1, nickname="one")
+            await database._load_members(repo_u.members["index:users"])
+            self.assertTrue(repo_u.members["index:users"].excludes(2))
+            self.assertIsNone(await repo_u.get(2))
+            # added by this process, the set held in memory is updated
+            await repo_u.add(discord_id=2, nickname="two")
+            self.assertEqual((await repo_u.get(2)).nickname, "two")
+
+        self.run_async(main)
+
+
+if __name__ == "__main__":
+    unittest.main()
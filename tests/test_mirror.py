@@ -0,0 +1,124 @@
+import unittest
+from unittest import mock
+
+from core.mirror import Batch, Mirror, MirrorStore
+
+
+def mirror(message_id: int, channel_id: int = 1, author_id: int = 1, replicas=()) -> Mirror:
+    result = Mirror(message_id=message_id, channel_id=channel_id, author_id=author_id)
+    for replica_channel_id, replica_id in replicas:
+        result.add_replica(replica_channel_id, replica_id)
+    return result
+
+
+class TestMirrorStore(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch("core.mirror.time.monotonic", lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_get(self):
+        store = MirrorStore()
+        m = mirror(1, replicas=[(2, 10), (3, 11)])
+        store.add(m, timeout=60)
+        self.assertIs(store.get(1), m)
+        self.assertIs(store.get_by_replica(11), m)
+        self.assertIsNone(store.get(10))
+        self.assertIsNone(store.get_by_replica(1))
+
+    def test_expire(self):
+        store = MirrorStore()
+        store.add(mirror(1, replicas=[(2, 10)]), timeout=60)
+        store.add(mirror(2), timeout=120)
+        self.now += 60
+        self.assertIsNone(store.get(1))
+        self.assertIsNone(store.get_by_replica(10))
+        self.assertIsNotNone(store.get(2))
+        self.assertEqual(len(store), 1)
+        self.now += 60
+        self.assertEqual(len(store), 0)
+        self.assertEqual(store.authors, {})
+
+    def test_expire_added_again(self):
+        # the expiration of the first add is outdated
+        store = MirrorStore()
+        m = mirror(1)
+        store.add(m, timeout=60)
+        self.now += 30
+        store.add(m, timeout=60)
+        self.now += 45
+        self.assertIs(store.get(1), m)
+
+    def test_limit(self):
+        store = MirrorStore(limit=2)
+        store.add(mirror(1, replicas=[(2, 10)]), timeout=60)
+        store.add(mirror(2), timeout=60)
+        # used recently, the other one is dropped
+        store.get(1)
+        store.add(mirror(3), timeout=60)
+        self.assertEqual(list(store.mirrors), [1, 3])
+        self.assertEqual(store.replicas, {10: 1})
+        store.add(mirror(4), timeout=60)
+        self.assertEqual(list(store.mirrors), [3, 4])
+        self.assertEqual(store.replicas, {})
+
+    def test_list_latest(self):
+        store = MirrorStore()
+        for message_id, channel_id, author_id in ((1, 5, 1), (2, 6, 1), (3, 5, 2), (4, 5, 1)):
+            store.add(mirror(message_id, channel_id, author_id), timeout=60)
+
+        def latest(*args):
+            return [m.message_id for m in store.list_latest(*args)]
+
+        self.assertEqual(latest(1, 2), [4, 2])
+        self.assertEqual(latest(1, 10), [4, 2, 1])
+        self.assertEqual(latest(1, 2, {5}), [4, 1])
+        self.assertEqual(latest(1, 1, {7}), [])
+        self.assertEqual(latest(3, 1), [])
+        self.assertEqual(store.get_latest(2).message_id, 3)
+
+    def test_remove(self):
+        store = MirrorStore()
+        m = mirror(1, replicas=[(2, 10)])
+        store.add(m, timeout=60)
+        store.remove(m)
+        self.assertIsNone(store.get(1))
+        self.assertEqual((store.replicas, store.authors), ({}, {}))
+        # removed twice
+        store.remove(m)
+
+    def test_remove_replica(self):
+        store = MirrorStore()
+        m = mirror(1, replicas=[(2, 10), (3, 11)])
+        store.add(m, timeout=60)
+        store.remove_replica(10)
+        self.assertEqual(m.replica_ids(), [(3, 11)])
+        self.assertIsNone(store.get_by_replica(10))
+        # not a replica
+        store.remove_replica(12)
+        self.assertEqual(m.replica_ids(), [(3, 11)])
+
+    def test_batch(self):
+        store = MirrorStore()
+        first, second = mirror(1), mirror(2)
+        batch = Batch()
+        for m in (first, second):
+            m.batch = batch
+            m.add_replica(5, 10)
+        batch.add(10, [first, second])
+        store.add(first, timeout=60)
+        store.add(second, timeout=60)
+        self.assertIs(store.get_by_replica(10), first)
+
+        # the combined message is handed over to the next part
+        store.remove(first)
+        self.assertIs(store.get_by_replica(10), second)
+
+        store.remove_replica(10)
+        self.assertEqual(second.replica_ids(), [])
+        self.assertNotIn(10, batch.messages)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,197 @@
+import asyncio
+import types
+import unittest
+from unittest import mock
+
+import discord
+
+from core.errors import CircuitOpen, RelayException, WebhookMissing
+from core.relay import Breaker, Relay, TokenBucket, is_destination_failure, is_transient
+
+
+class Response:
+    def __init__(self, status: int):
+        self.status = status
+        self.reason = "Reason"
+
+
+def channel(channel_id: int = 1):
+    return types.SimpleNamespace(id=channel_id)
+
+
+class FrozenClockTestCase(unittest.TestCase):
+    """time.monotonic() of the relay is `self.now`"""
+
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch("core.relay.time.monotonic", lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+class TestTokenBucket(FrozenClockTestCase):
+    def test_delay(self):
+        bucket = TokenBucket(rate=2, period=10)
+        self.assertEqual(bucket.delay(), 0)
+        self.assertEqual(bucket.delay(), 0)
+        # one token per 5 seconds
+        self.assertAlmostEqual(bucket.delay(), 5)
+        self.now += 5
+        self.assertEqual(bucket.delay(), 0)
+
+    def test_burst(self):
+        bucket = TokenBucket(rate=2, period=10)
+        self.now += 100
+        # no more than `rate` tokens are saved
+        self.assertEqual([bucket.delay() for _ in range(2)], [0, 0])
+        self.assertGreater(bucket.delay(), 0)
+
+
+class TestBreaker(FrozenClockTestCase):
+    def test_transitions(self):
+        breaker = Breaker(threshold=2, cooldown=60)
+        self.assertEqual(breaker.state, "closed")
+        breaker.fail()
+        self.assertTrue(breaker.allows())
+        breaker.fail()
+        self.assertEqual(breaker.state, "open")
+        self.assertFalse(breaker.allows())
+
+        self.now += 60
+        self.assertEqual(breaker.state, "half-open")
+        self.assertTrue(breaker.allows())
+        # failed again, open for another cooldown
+        breaker.fail()
+        self.assertEqual(breaker.state, "open")
+
+        self.now += 60
+        breaker.succeed()
+        self.assertEqual((breaker.state, breaker.failures), ("closed", 0))
+
+    def test_failing_for(self):
+        breaker = Breaker(threshold=2, cooldown=60)
+        self.assertEqual(breaker.failing_for(), 0)
+        breaker.fail()
+        self.now += 30
+        breaker.fail()
+        self.now += 30
+        self.assertEqual(breaker.failing_for(), 60)
+        breaker.succeed()
+        self.assertEqual(breaker.failing_for(), 0)
+
+
+class TestErrors(unittest.TestCase):
+    def test_classification(self):
+        self.assertTrue(is_transient(discord.HTTPException(Response(502), "")))
+        self.assertTrue(is_transient(asyncio.TimeoutError()))
+        self.assertFalse(is_transient(discord.HTTPException(Response(400), "")))
+        self.assertTrue(is_destination_failure(discord.NotFound(Response(404), "")))
+        self.assertFalse(is_destination_failure(discord.HTTPException(Response(400), "")))
+        # the channel still accepts messages from the bot
+        self.assertFalse(is_destination_failure(WebhookMissing()))
+
+
+class TestRelay(unittest.TestCase):
+    def test_deliver_in_order(self):
+        async def main():
+            relay = Relay(rate=100, period=1)
+            sent = []
+
+            def send(i):
+                async def call():
+                    sent.append(i)
+                    return i
+
+                return call
+
+            results = await asyncio.gather(*[relay.submit(channel(), send(i)) for i in range(5)])
+            return results, sent, relay.delivered
+
+        self.assertEqual(asyncio.run(main()), ([0, 1, 2, 3, 4], [0, 1, 2, 3, 4], 5))
+
+    def full_queue(self, policy: str):
+        """Submit three messages to a queue of one while the first is being sent"""
+
+        async def main():
+            relay = Relay(rate=100, period=1, depth=1, policy=policy)
+            release = asyncio.Event()
+
+            async def first():
+                await release.wait()
+                return "first"
+
+            async def other(name):
+                return name
+
+            futures = [relay.submit(channel(), first)]
+            # let the worker take the first message
+            await asyncio.sleep(0)
+            futures.append(relay.submit(channel(), lambda: other("second")))
+            futures.append(relay.submit(channel(), lambda: other("third")))
+            release.set()
+            results = await asyncio.gather(*futures, return_exceptions=True)
+            return [r if isinstance(r, str) else type(r) for r in results], relay.dropped
+
+        return asyncio.run(main())
+
+    def test_drop_newest(self):
+        self.assertEqual(self.full_queue("drop"), (["first", "second", RelayException], 1))
+
+    def test_drop_oldest(self):
+        self.assertEqual(self.full_queue("oldest"), (["first", RelayException, "third"], 1))
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            Relay(policy="random")
+
+    def test_retry(self):
+        async def main():
+            relay = Relay(rate=100, period=1, retries=2, backoff=0)
+            attempts = []
+
+            async def send():
+                attempts.append(1)
+                if len(attempts) < 3:
+                    raise discord.HTTPException(Response(503), "")
+                return "sent"
+
+            result = await relay.submit(channel(), send)
+            return result, len(attempts), relay.retried, relay.breakers[1].failures
+
+        self.assertEqual(asyncio.run(main()), ("sent", 3, 2, 0))
+
+    def test_circuit(self):
+        async def main():
+            relay = Relay(rate=100, period=1, retries=0, threshold=2, cooldown=60)
+
+            async def send():
+                raise discord.Forbidden(Response(403), "")
+
+            results = []
+            for _ in range(3):
+                try:
+                    await relay.submit(channel(), send)
+                except Exception as e:
+                    results.append(type(e))
+            return results, relay.rejected
+
+        self.assertEqual(
+            asyncio.run(main()), ([discord.Forbidden, discord.Forbidden, CircuitOpen], 1)
+        )
+
+    def test_webhook_missing(self):
+        async def main():
+            relay = Relay(rate=100, period=1, retries=0, threshold=1)
+
+            async def send():
+                raise WebhookMissing()
+
+            with self.assertRaises(WebhookMissing):
+                await relay.submit(channel(), send)
+            return relay.breakers[1].state
+
+        self.assertEqual(asyncio.run(main()), "closed")
+
+
+if __name__ == "__main__":
+    unittest.main()